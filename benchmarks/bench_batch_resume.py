@@ -0,0 +1,93 @@
+"""
+Kill-and-resume benchmark for the durable batch job store
+Starts a batch job in a worker process (offline fake model with a fixed
+per-call delay), SIGKILLs it part-way through, starts a fresh worker on the
+same store and reports restart-to-resume time, rows recovered from
+checkpoints and how many rows had to be generated again
+Usage: python benchmarks/bench_batch_resume.py [companies] [kill after rows]   (default: 40 15)
+"""
+
+import json
+import os
+import signal
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+MODEL_DELAY_SECONDS = 0.1
+
+WORKER = """
+import json, sys, time
+import main
+
+delay = float(sys.argv[2])
+generate = main.FakeGenerativeModel.generate_content
+def slow_generate(self, *args, **kwargs):
+    time.sleep(delay)
+    return generate(self, *args, **kwargs)
+main.FakeGenerativeModel.generate_content = slow_generate
+
+job_id = 'bench-resume'
+if sys.argv[1] == 'start':
+    companies = [{'company_name': f'Company {i}', 'directive': 'Expand cloud footprint'} for i in range(int(sys.argv[3]))]
+    options = {'mode': 'full', 'analyzed_by': 'bench'}
+    main.batch_jobs[job_id] = main._new_batch_job(len(companies))
+    main.batch_job_store.create_job(job_id, main.batch_jobs[job_id], companies, options)
+    main.process_batch_analysis(job_id, companies, options)
+else:
+    # Startup resume runs on its own thread; wait for it to finish the job
+    while main.batch_jobs.get(job_id, {}).get('status') != 'completed':
+        time.sleep(0.05)
+    job = main.batch_jobs[job_id]
+    calls = sum(1 for request in main.FakeGenerativeModel.requests if request['model_name'] == main.ANALYSIS_MODEL_NAME)
+    print(json.dumps({'resume': job['resume'], 'results': len(job['results']), 'model_calls': calls}))
+"""
+
+def checkpointed_rows(path):
+    try:
+        conn = sqlite3.connect(path)
+        try:
+            return conn.execute("SELECT COUNT(*) FROM batch_job_rows").fetchone()[0]
+        finally:
+            conn.close()
+    except sqlite3.OperationalError:
+        return 0
+
+if __name__ == '__main__':
+    companies = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    kill_after = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+    work_dir = tempfile.mkdtemp(prefix='bench_resume_')
+    store_path = os.path.join(work_dir, 'jobs.db')
+    env = dict(
+        os.environ, PYTHONPATH=SRC, GEMINI_MODEL_BACKEND='fake', GCP_PROJECT_ID='', LLM_CACHE_PATH='',
+        ALIAS_DB_PATH='', WRITEBACK_SPILL_PATH='', BATCH_JOB_STORE_PATH=store_path, BATCH_MAX_WORKERS='2'
+    )
+
+    worker = subprocess.Popen(
+        [sys.executable, '-c', WORKER, 'start', str(MODEL_DELAY_SECONDS), str(companies)],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    while checkpointed_rows(store_path) < kill_after:
+        if worker.poll() is not None:
+            sys.exit('worker finished before it could be killed; use more companies')
+        time.sleep(0.01)
+    worker.send_signal(signal.SIGKILL)
+    worker.wait()
+    killed_at = time.time()
+    saved = checkpointed_rows(store_path)
+
+    output = subprocess.run(
+        [sys.executable, '-c', WORKER, 'resume', str(MODEL_DELAY_SECONDS)],
+        env=env, capture_output=True, text=True, check=True
+    ).stdout
+    report = json.loads(next(line for line in reversed(output.splitlines()) if line.startswith('{')))
+    resume = report['resume']
+
+    print(f"{companies} companies, killed after {saved} checkpointed rows")
+    print(f"rows recovered {resume['rows_recovered']} | regenerated {report['model_calls']} "
+          f"| results {report['results']}/{companies}")
+    print(f"restart-to-resume {resume['restart_to_resume_seconds']:.2f}s after worker start "
+          f"| {resume['downtime_seconds']:.2f}s since last heartbeat | kill-to-complete {time.time() - killed_at:.2f}s")
@@ -0,0 +1,89 @@
+"""
+Benchmark for CompanyMatchIndex lookups
+Usage: python benchmarks/bench_company_matcher.py [sizes...]   (default: 10000 100000 1000000)
+"""
+
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from difflib import SequenceMatcher
+
+from main import CompanyMatchIndex
+
+WORDS = [
+    'acme', 'global', 'united', 'pacific', 'northern', 'digital', 'capital', 'green', 'blue', 'summit',
+    'river', 'atlas', 'apex', 'prime', 'nova', 'vertex', 'quantum', 'silver', 'golden', 'metro'
+]
+SUFFIXES = ['Corp', 'Inc', 'Ltd', 'Group', 'Holdings', 'Systems', 'Labs', 'Partners', 'Industries', '']
+
+def linear_match(input_name, table_name_list):
+    """The original per-lookup scan, kept here as the baseline"""
+    input_name_clean = input_name.lower().strip()
+    best_match = None
+    best_ratio = 0.0
+    for table_name in table_name_list:
+        table_name_clean = str(table_name).lower().strip()
+        if input_name_clean == table_name_clean:
+            return table_name
+        if input_name_clean in table_name_clean or table_name_clean in input_name_clean:
+            return table_name
+        ratio = SequenceMatcher(None, input_name_clean, table_name_clean).ratio()
+        if ratio > best_ratio and ratio > 0.8:
+            best_ratio = ratio
+            best_match = table_name
+    return best_match
+
+def make_names(count, seed=42):
+    rng = random.Random(seed)
+    names = []
+    for i in range(count):
+        stem = ' '.join(rng.choice(WORDS).title() for _ in range(rng.randint(1, 2)))
+        tag = ''.join(rng.choice(string.ascii_lowercase) for _ in range(4))
+        names.append(f"{stem} {tag.title()} {rng.choice(SUFFIXES)}".strip())
+    return names
+
+def make_queries(names, count, seed=7):
+    """Mix of exact hits, one-character typos and misses"""
+    rng = random.Random(seed)
+    queries = []
+    for i in range(count):
+        name = rng.choice(names)
+        kind = i % 3
+        if kind == 0:
+            queries.append(name.upper())
+        elif kind == 1:
+            pos = rng.randrange(len(name))
+            queries.append(name[:pos] + rng.choice(string.ascii_lowercase) + name[pos + 1:])
+        else:
+            queries.append(''.join(rng.choice(string.ascii_lowercase) for _ in range(12)))
+    return queries
+
+def bench(size, query_count=2000, linear_queries=20):
+    names = make_names(size)
+    queries = make_queries(names, query_count)
+    
+    started = time.perf_counter()
+    index = CompanyMatchIndex(names)
+    build_seconds = time.perf_counter() - started
+    
+    started = time.perf_counter()
+    matched = sum(1 for q in queries if index.lookup(q)[0] is not None)
+    indexed_rate = len(queries) / (time.perf_counter() - started)
+    
+    started = time.perf_counter()
+    for q in queries[:linear_queries]:
+        linear_match(q, names)
+    linear_rate = linear_queries / (time.perf_counter() - started)
+    
+    print(f"{size:>9,} names | build {build_seconds:6.2f}s | indexed {indexed_rate:10,.0f} lookups/s "
+          f"| matched {matched}/{len(queries)} | linear scan {linear_rate:8,.1f} lookups/s")
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+    for size in sizes:
+        bench(size)
@@ -0,0 +1,227 @@
+"""
+Benchmark for parse_structured_data
+Compares the single-pass section parser with the original regex-per-field
+version on full-length reports plus the saved responses in
+tests/data/saved_responses.jsonl, and exits non-zero unless both return
+identical output (tests/test_parse_structured_data.py asserts the same)
+Usage: python benchmarks/bench_parse_structured_data.py [saved responses .db or .jsonl]
+  A SQLite file from LLM_CACHE_PATH or a JSONL file with a "text" field per
+  line adds those saved responses to the corpus
+"""
+
+import json
+import os
+import random
+import re
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from main import FakeGenerativeModel, parse_structured_data
+
+SAVED_RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tests', 'data', 'saved_responses.jsonl')
+
+FILLER = [
+    'Strong alignment with our cloud migration offering and an active modernization budget.',
+    'Recent leadership changes suggest an open window for new vendor evaluations.',
+    'Our campaign in this industry converted at 4.2% against a 2.8% benchmark.',
+    'Expansion into APAC creates demand for compliance and data residency tooling.',
+    'Procurement cycles typically run 3-6 months; executive sponsorship is critical.',
+]
+
+def legacy_parse_structured_data(analysis_text):
+    """The original regex-per-field parser, kept here as the baseline"""
+    data = {
+        'prospect_level': 'Medium',
+        'prospect_score': 'Unknown',
+        'industry': 'Unknown - needs manual research',
+        'location': 'Unknown - needs manual research',
+        'employees': 'Unknown - needs manual research',
+        'revenue': 'Unknown - needs manual research',
+        'auditor_status': 'Unknown - needs manual research',
+        'win_themes': 'Unknown - needs manual research',
+        'key_personnel': 'Unknown - needs manual research',
+        'engagement_strategy': 'Unknown - needs manual research',
+        'gtm_immediate': 'Unknown - needs manual research',
+        'gtm_short_term': 'Unknown - needs manual research',
+        'gtm_mid_term': 'Unknown - needs manual research',
+        'gtm_long_term': 'Unknown - needs manual research',
+        'recommended_solutions': 'Unknown - needs manual research'
+    }
+    
+    # Extract from Company Overview section
+    overview_match = re.search(r'## 1\. COMPANY OVERVIEW(.*?)(?=## \d+\.)', analysis_text, re.DOTALL | re.IGNORECASE)
+    if overview_match:
+        overview_text = overview_match.group(1)
+        
+        industry_match = re.search(r'Industry[:\s]*\*?\*?([^\n]+)', overview_text, re.IGNORECASE)
+        if industry_match:
+            data['industry'] = industry_match.group(1).strip().replace('*', '')
+        
+        location_match = re.search(r'Location[:\s]*\*?\*?([^\n]+)', overview_text, re.IGNORECASE)
+        if location_match:
+            data['location'] = location_match.group(1).strip().replace('*', '')
+        
+        employees_match = re.search(r'Employees[:\s]*\*?\*?([^\n]+)', overview_text, re.IGNORECASE)
+        if employees_match:
+            data['employees'] = employees_match.group(1).strip().replace('*', '')
+    
+    # Extract from Financial Health section
+    financial_match = re.search(r'## 2\. FINANCIAL HEALTH(.*?)(?=## \d+\.)', analysis_text, re.DOTALL | re.IGNORECASE)
+    if financial_match:
+        financial_text = financial_match.group(1)
+        revenue_match = re.search(r'Revenue[:\s]*\*?\*?([^\n]+)', financial_text, re.IGNORECASE)
+        if revenue_match:
+            data['revenue'] = revenue_match.group(1).strip().replace('*', '')
+    
+    # Extract from Prospect Analysis section
+    prospect_match = re.search(r'## 3\. PROSPECT ANALYSIS(.*?)(?=## \d+\.)', analysis_text, re.DOTALL | re.IGNORECASE)
+    if prospect_match:
+        prospect_text = prospect_match.group(1)
+        
+        level_patterns = [
+            r'\*?\*?Prospect\s+Level\*?\*?[:\s]*\*?\*?\s*([A-Za-z]+)',
+            r'Prospect\s+Level[:\s]+([A-Za-z]+)',
+            r'Level[:\s]*\*?\*?\s*(High|Medium|Low)',
+        ]
+        
+        for pattern in level_patterns:
+            level_match = re.search(pattern, prospect_text, re.IGNORECASE)
+            if level_match:
+                data['prospect_level'] = level_match.group(1).strip()
+                break
+        
+        score_patterns = [
+            r'\*?\*?Prospect\s+Score\*?\*?[:\s]*\*?\*?\s*(\d+)',
+            r'Prospect\s+Score[:\s]+(\d+)',
+            r'Score[:\s]*\*?\*?\s*(\d+)/100',
+            r'Score[:\s]*\*?\*?\s*(\d+)\s*/\s*100',
+        ]
+        
+        for pattern in score_patterns:
+            score_match = re.search(pattern, prospect_text, re.IGNORECASE)
+            if score_match:
+                try:
+                    data['prospect_score'] = int(score_match.group(1))
+                    break
+                except:
+                    pass
+    
+    # Fallback extractions
+    if data['prospect_level'] == 'Medium':
+        level_patterns = [r'\*?\*?Prospect\s+Level\*?\*?[:\s]*\*?\*?\s*([A-Za-z]+)']
+        for pattern in level_patterns:
+            level_match = re.search(pattern, analysis_text, re.IGNORECASE)
+            if level_match:
+                data['prospect_level'] = level_match.group(1).strip()
+                break
+    
+    if data['prospect_score'] == 'Unknown':
+        score_patterns = [r'\*?\*?Prospect\s+Score\*?\*?[:\s]*\*?\*?\s*(\d+)']
+        for pattern in score_patterns:
+            score_match = re.search(pattern, analysis_text, re.IGNORECASE)
+            if score_match:
+                try:
+                    data['prospect_score'] = int(score_match.group(1))
+                    break
+                except:
+                    pass
+    
+    # Extract Auditor Status
+    auditor_match = re.search(r'\*?\*?Auditor Status\*?\*?[:\s]*([^\n]+)', analysis_text, re.IGNORECASE)
+    if auditor_match:
+        status = auditor_match.group(1).strip()
+        if 'CHECK' in status or 'DESC' in status or '⚠' in status:
+            data['auditor_status'] = '⚠️ CHECK DESC'
+        elif 'Other' in status or '✓' in status:
+            data['auditor_status'] = '✓ Other Auditor'
+        else:
+            data['auditor_status'] = status
+    
+    # Extract sections
+    win_themes_match = re.search(r'## 4\. WIN THEMES(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
+    if win_themes_match:
+        data['win_themes'] = win_themes_match.group(1).strip()
+    
+    personnel_match = re.search(r'## 6\. KEY PERSONNEL(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
+    if personnel_match:
+        data['key_personnel'] = personnel_match.group(1).strip()
+    
+    engagement_match = re.search(r'## 7\. ENGAGEMENT STRATEGY(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
+    if engagement_match:
+        data['engagement_strategy'] = engagement_match.group(1).strip()
+    
+    gtm_match = re.search(r'## 8\. GO-TO-MARKET ACTION PLAN(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
+    if gtm_match:
+        gtm_text = gtm_match.group(1)
+        
+        immediate_match = re.search(r'### Immediate Actions.*?\n(.*?)(?=###|$)', gtm_text, re.DOTALL | re.IGNORECASE)
+        if immediate_match:
+            data['gtm_immediate'] = immediate_match.group(1).strip()
+        
+        short_match = re.search(r'### Short-term Actions.*?\n(.*?)(?=###|$)', gtm_text, re.DOTALL | re.IGNORECASE)
+        if short_match:
+            data['gtm_short_term'] = short_match.group(1).strip()
+        
+        mid_match = re.search(r'### Mid-term Actions.*?\n(.*?)(?=###|$)', gtm_text, re.DOTALL | re.IGNORECASE)
+        if mid_match:
+            data['gtm_mid_term'] = mid_match.group(1).strip()
+        
+        long_match = re.search(r'### Long-term Actions.*?\n(.*?)(?=###|$)', gtm_text, re.DOTALL | re.IGNORECASE)
+        if long_match:
+            data['gtm_long_term'] = long_match.group(1).strip()
+    
+    solutions_match = re.search(r'## 5\. RECOMMENDED SOLUTIONS(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
+    if solutions_match:
+        data['recommended_solutions'] = solutions_match.group(1).strip()
+    
+    return data
+
+
+def make_report(seed, target_chars=32000):
+    """Fake report padded to roughly 8k tokens, like a full gemini-2.5-pro response"""
+    rng = random.Random(seed)
+    report = FakeGenerativeModel._report(f"COMPANY TO ANALYZE: Company {seed}\n")
+    sections = re.split(r'(?=\n## \d+\.|\n### )', report)
+    per_section = target_chars // len(sections)
+    padded = []
+    for section in sections:
+        lines = [section.rstrip('\n')]
+        while sum(len(line) for line in lines) < per_section:
+            lines.append(f"- {rng.choice(FILLER)}")
+        padded.append('\n'.join(lines) + '\n')
+    return ''.join(padded)
+
+def load_saved_responses(path):
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as handle:
+            return [json.loads(line)['text'] for line in handle if line.strip()]
+    conn = sqlite3.connect(path)
+    try:
+        return [row[0] for row in conn.execute("SELECT response_text FROM llm_responses")]
+    finally:
+        conn.close()
+
+def rate(parser, corpus, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        for text in corpus:
+            parser(text)
+    return rounds * len(corpus) / (time.perf_counter() - started)
+
+if __name__ == '__main__':
+    corpus = [make_report(seed) for seed in range(50)]
+    for path in [SAVED_RESPONSES] + sys.argv[1:]:
+        corpus.extend(load_saved_responses(path))
+    
+    mismatches = sum(1 for text in corpus if parse_structured_data(text) != legacy_parse_structured_data(text))
+    print(f"{len(corpus)} reports, average {sum(len(t) for t in corpus) / len(corpus):,.0f} chars | mismatches: {mismatches}")
+    if mismatches:
+        sys.exit(1)
+    
+    legacy_rate = rate(legacy_parse_structured_data, corpus, 5)
+    single_pass_rate = rate(parse_structured_data, corpus, 5)
+    print(f"legacy {legacy_rate:10,.0f} parses/s | single-pass {single_pass_rate:10,.0f} parses/s "
+          f"| speedup {single_pass_rate / legacy_rate:5.1f}x")
@@ -3,25 +3,44 @@ Strategic GTM Agent - Enhanced Version
 Integrates Vertex AI (Gemini), BigQuery with intelligent data matching and write-back
 """
 
-from flask import Flask, request, jsonify, send_file, redirect, url_for, session, render_template_string
-from google.cloud import aiplatform, bigquery
+from flask import Flask, request, jsonify, send_file, redirect, url_for, session, render_template_string, Response, stream_with_context
+from google.cloud import aiplatform, bigquery, storage
+import google.auth
 from google.oauth2 import id_token
+from google.api_core.exceptions import (
+    ResourceExhausted, TooManyRequests, ServiceUnavailable, InternalServerError,
+    DeadlineExceeded, GatewayTimeout, Aborted
+)
 from google.auth.transport import requests as google_requests
 import vertexai
-from vertexai.preview.generative_models import GenerativeModel
+from vertexai.preview.generative_models import GenerativeModel, GenerationConfig
+from vertexai.preview import caching
+from vertexai.preview.batch_prediction import BatchPredictionJob
 import pandas as pd
 import json
+import hashlib
 import re
 import os
 import threading
+import atexit
+import time
+import sqlite3
+import unicodedata
 import uuid
-from datetime import datetime
+import socket
+import zipfile
+from datetime import datetime, timedelta
 import openpyxl
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side
 from openpyxl.utils import get_column_letter
+from openpyxl.utils.exceptions import InvalidFileException
 from io import BytesIO
 from functools import wraps
 from difflib import SequenceMatcher
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
+import heapq
+import random
 import uuid
 from io import BytesIO
 import openpyxl
@@ -52,7 +71,9 @@ if PROJECT_ID:
 else:
     print("⚠ Warning: GCP_PROJECT_ID not set")
     bigquery_client = None
+# In-memory view of running batch jobs; batch_job_store keeps the durable copy
 batch_jobs = {}
+PROCESS_STARTED_AT = time.time()
 def login_required(f):
     """Decorator to require login"""
     @wraps(f)
@@ -64,149 +85,765 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# Minimum SequenceMatcher ratio for a fuzzy company match
+FUZZY_MATCH_THRESHOLD = 0.8
+
+def _clean_company_name(name):
+    """Lowercase/strip a company name, returning '' for blanks and NaN"""
+    if name is None or (isinstance(name, float) and pd.isna(name)):
+        return ''
+    return str(name).lower().strip()
+
+# Trailing legal-form tokens dropped by normalize_company_name
+LEGAL_SUFFIXES = {
+    'inc', 'incorporated', 'corp', 'corporation', 'co', 'company', 'ltd', 'limited',
+    'llc', 'llp', 'lp', 'plc', 'gmbh', 'ag', 'sa', 'sas', 'srl', 'spa', 'bv', 'nv',
+    'oy', 'ab', 'as', 'kk', 'pty', 'pte', 'pvt', 'sdn', 'bhd'
+}
+
+def normalize_company_name(name):
+    """
+    Canonical form of a company name used for alias keys and exact matching
+    Folds unicode, case, punctuation and whitespace and strips trailing legal
+    suffixes, so "Acme Corp.", "ACME Corporation" and "Acme, Inc." all become "acme"
+    """
+    clean = _clean_company_name(name)
+    if not clean:
+        return ''
+    
+    folded = unicodedata.normalize('NFKD', clean)
+    folded = ''.join(ch for ch in folded if not unicodedata.combining(ch)).casefold()
+    folded = folded.replace('&', ' and ')
+    folded = re.sub(r"['’.]", '', folded)
+    folded = re.sub(r'[\W_]+', ' ', folded)
+    
+    tokens = folded.split()
+    if len(tokens) > 1 and tokens[0] == 'the':
+        tokens = tokens[1:]
+    while len(tokens) > 1 and tokens[-1] in LEGAL_SUFFIXES:
+        tokens.pop()
+    return ' '.join(tokens)
+
+def _trigrams(text, padded=False):
+    if padded:
+        text = f"  {text} "
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class CompanyMatchIndex:
+    """
+    Prebuilt index for fuzzy company matching
+    Same precedence as the original linear scan: the earliest row that equals
+    or contains the input (or is contained in it) wins, otherwise the best
+    SequenceMatcher ratio > 0.8 with the earliest name winning ties. Only a
+    shortlist of candidates sharing character trigrams with the input is
+    scored. One addition: a row equal to the input after
+    normalize_company_name ("Acme Inc" vs "ACME Corp.") also counts as an
+    exact match at its row position, with confidence 1.0.
+    """
+    
+    def __init__(self, names, shortlist_size=50, common_gram_fraction=0.02):
+        self.names = list(names)
+        self._shortlist_size = shortlist_size
+        # Trigrams found in more names than this ("inc", "cor", ...) are ignored
+        # when counting shared trigrams for the fuzzy shortlist
+        self._common_gram_limit = max(1000, int(len(self.names) * common_gram_fraction))
+        self._clean = []
+        self._exact = {}
+        self._normalized = {}
+        self._postings = {}
+        
+        for position, name in enumerate(self.names):
+            clean = _clean_company_name(name)
+            self._clean.append(clean)
+            if not clean:
+                continue
+            self._exact.setdefault(clean, position)
+            self._normalized.setdefault(normalize_company_name(clean), position)
+            # Padded trigrams include every interior trigram plus the word edges,
+            # which keeps short names reachable from the fuzzy shortlist
+            for gram in _trigrams(clean, padded=True):
+                self._postings.setdefault(gram, []).append(position)
+    
+    def __len__(self):
+        return len(self.names)
+    
+    def lookup(self, input_name):
+        """
+        Find the best matching row for input_name
+        Returns (position, confidence) or (None, 0.0)
+        """
+        clean = _clean_company_name(input_name)
+        if not clean or not self._exact:
+            return None, 0.0
+        
+        # Exact and contains matches compete on row order like the linear scan:
+        # the earliest row where either name contains the other wins
+        candidates = []
+        # Same name once legal suffixes and punctuation are folded away
+        normalized = normalize_company_name(clean)
+        normalized_position = self._normalized.get(normalized) if normalized else None
+        if normalized_position is not None:
+            candidates.append(normalized_position)
+        
+        for start in range(len(clean)):
+            for end in range(start + 1, len(clean) + 1):
+                position = self._exact.get(clean[start:end])
+                if position is not None:
+                    candidates.append(position)
+        
+        grams = _trigrams(clean)
+        if grams:
+            postings = [self._postings.get(gram) for gram in grams]
+            if all(postings):
+                rarest = min(postings, key=len)
+                position = next((p for p in rarest if clean in self._clean[p]), None)
+                if position is not None:
+                    candidates.append(position)
+        else:
+            position = next((p for p, name in enumerate(self._clean) if name and clean in name), None)
+            if position is not None:
+                candidates.append(position)
+        
+        if candidates:
+            position = min(candidates)
+            if position == normalized_position:
+                return position, 1.0
+            return position, SequenceMatcher(None, clean, self._clean[position]).ratio()
+        
+        # Fuzzy match - score only the candidates sharing the most trigrams
+        postings = sorted(
+            (self._postings[gram] for gram in _trigrams(clean, padded=True) if gram in self._postings),
+            key=len
+        )
+        selective = [p for p in postings if len(p) <= self._common_gram_limit] or postings[:3]
+        shared = Counter()
+        for posting in selective:
+            shared.update(posting)
+        
+        # ratio can never exceed 2*min/(a+b), so skip hopeless lengths
+        input_length = len(clean)
+        min_length = input_length * FUZZY_MATCH_THRESHOLD / (2 - FUZZY_MATCH_THRESHOLD)
+        max_length = input_length * (2 - FUZZY_MATCH_THRESHOLD) / FUZZY_MATCH_THRESHOLD
+        shortlist = heapq.nlargest(
+            self._shortlist_size,
+            (p for p in shared if min_length < len(self._clean[p]) < max_length),
+            key=shared.__getitem__
+        )
+        
+        best_position = None
+        best_ratio = 0.0
+        matcher = SequenceMatcher(None, clean, '')
+        for position in sorted(shortlist):
+            matcher.set_seq2(self._clean[position])
+            if matcher.real_quick_ratio() <= max(best_ratio, FUZZY_MATCH_THRESHOLD):
+                continue
+            if matcher.quick_ratio() <= max(best_ratio, FUZZY_MATCH_THRESHOLD):
+                continue
+            ratio = matcher.ratio()
+            if ratio > best_ratio and ratio > FUZZY_MATCH_THRESHOLD:
+                best_ratio = ratio
+                best_position = position
+        
+        return best_position, best_ratio
+    
+    def match(self, input_name):
+        """Returns (matched name, confidence) or (None, 0.0)"""
+        position, confidence = self.lookup(input_name)
+        if position is None:
+            return None, 0.0
+        return self.names[position], confidence
+
 def fuzzy_match_company(input_name, table_name_list):
     """
     Fuzzy match company name to find best match in table
     Returns the matched name or None
+    For repeated lookups build a CompanyMatchIndex once instead
     """
     if not input_name or not table_name_list:
         return None
     
-    input_name_clean = input_name.lower().strip()
-    best_match = None
-    best_ratio = 0.0
+    matched_name, _ = CompanyMatchIndex(table_name_list).match(input_name)
+    return matched_name
+
+def _normalize_industry(industry):
+    """Lowercase an industry value, returning None for missing values"""
+    if industry is None or (isinstance(industry, float) and pd.isna(industry)):
+        return None
+    return str(industry).lower()
+
+class IndustryContextIndex:
+    """
+    Industry -> relevant products/campaigns/sales plays, precomputed once per
+    reference data load. Uses the same substring rule as the original
+    str.contains filters on target_industries / target_industry, with the
+    same head(5)/head(3)/head(5) fallbacks when nothing matches.
+    """
     
-    for table_name in table_name_list:
-        if not table_name:
-            continue
-            
-        table_name_clean = str(table_name).lower().strip()
+    SECTIONS = (
+        ('relevant_products', 'products', 'target_industries', 5),
+        ('relevant_campaigns', 'campaigns', 'target_industry', 3),
+        ('relevant_sales_plays', 'sales_plays', 'target_industry', 5),
+    )
+    
+    def __init__(self, reference_data, industries=()):
+        self._sections = []
+        self._defaults = {}
+        for context_key, table, column, fallback_count in self.SECTIONS:
+            df = reference_data[table]
+            records = df.to_dict('records') if not df.empty else []
+            keys = [_normalize_industry(value) for value in df[column]] if not df.empty else []
+            self._sections.append((context_key, records, keys))
+            self._defaults[context_key] = records[:fallback_count]
+        
+        self._by_industry = {}
+        for industry in industries:
+            self.lookup(industry)
+    
+    def __len__(self):
+        return len(self._by_industry)
+    
+    def lookup(self, industry):
+        """
+        Relevant items for a customer industry
+        Pass None when there is no customer match to get the default lists
+        """
+        if industry is None:
+            return self._defaults
+        
+        key = _normalize_industry(industry) or ''
+        relevant = self._by_industry.get(key)
+        if relevant is None:
+            relevant = {}
+            for context_key, records, keys in self._sections:
+                matches = [record for record, target in zip(records, keys) if target is not None and key in target]
+                relevant[context_key] = matches or self._defaults[context_key]
+            self._by_industry[key] = relevant
+        return relevant
+
+# Reference data cache configuration
+REFERENCE_CACHE_TTL_SECONDS = int(os.environ.get('REFERENCE_CACHE_TTL_SECONDS', 3600))
+REFERENCE_CACHE_RETRY_SECONDS = int(os.environ.get('REFERENCE_CACHE_RETRY_SECONDS', 60))
+REFERENCE_PARALLEL_FETCH = os.environ.get('REFERENCE_PARALLEL_FETCH', 'true').lower() == 'true'
+REFERENCE_QUERY_TIMEOUT_SECONDS = float(os.environ.get('REFERENCE_QUERY_TIMEOUT_SECONDS', 60))
+
+# Customer lookup strategy: 'cache' keeps the whole customers table in memory,
+# 'pushdown' resolves each company with a parameterized BigQuery query instead
+CUSTOMER_LOOKUP_MODE = os.environ.get('CUSTOMER_LOOKUP_MODE', 'cache').lower()
+CUSTOMER_PUSHDOWN_MAX_CANDIDATES = int(os.environ.get('CUSTOMER_PUSHDOWN_MAX_CANDIDATES', 200))
+
+CUSTOMER_COLUMNS = """company_name, industry, account_manager, relationship_status, 
+               last_interaction_date, auditor_firm, annual_revenue, employee_count,
+               headquarters_location"""
+
+REFERENCE_TABLE_QUERIES = {
+    'customers': """
+        SELECT """ + CUSTOMER_COLUMNS + """
+        FROM `{project}.{dataset}.customers`
+        """,
+    'products': """
+        SELECT product_name, product_category, target_industries, features, 
+               competitive_advantage, base_price
+        FROM `{project}.{dataset}.products`
+        """,
+    'campaigns': """
+        SELECT campaign_name, target_industry, budget_allocated, 
+               conversion_rate, end_date
+        FROM `{project}.{dataset}.marketing_budget`
+        ORDER BY conversion_rate DESC, budget_allocated DESC
+        """,
+    'sales_plays': """
+        SELECT play_name, target_persona, target_industry, value_proposition,
+               engagement_strategy, success_metrics, recommended_products
+        FROM `{project}.{dataset}.sales_plays`
+        """
+}
+
+def _fetch_reference_table(job, timeout):
+    """Wait for a submitted query job and download its rows"""
+    job.result(timeout=timeout)
+    return job.to_dataframe()
+
+def load_reference_data(previous=None):
+    """
+    Load the customers, products, marketing_budget and sales_plays tables
+    Returns a dict of DataFrames keyed by REFERENCE_TABLE_QUERIES name
+    
+    With REFERENCE_PARALLEL_FETCH all four jobs are submitted up front and
+    gathered concurrently. A table that fails or exceeds
+    REFERENCE_QUERY_TIMEOUT_SECONDS falls back to its copy in `previous`
+    (or an empty DataFrame) and is listed under 'failed_tables'.
+    """
+    queries = {name: query.format(project=PROJECT_ID, dataset=DATASET_ID)
+               for name, query in REFERENCE_TABLE_QUERIES.items()
+               if not (name == 'customers' and CUSTOMER_LOOKUP_MODE == 'pushdown')}
+    started = time.time()
+    reference_data = {}
+    failed_tables = []
+    
+    def fallback(name, error):
+        print(f"⚠ Could not load reference table {name}: {str(error)}")
+        failed_tables.append(name)
+        if previous is not None and name in previous:
+            reference_data[name] = previous[name]
+        else:
+            reference_data[name] = pd.DataFrame()
+    
+    if REFERENCE_PARALLEL_FETCH:
+        # The BigQuery client is thread-safe: submit every job, then gather
+        deadline = started + REFERENCE_QUERY_TIMEOUT_SECONDS
+        executor = ThreadPoolExecutor(max_workers=len(queries), thread_name_prefix='reference-fetch')
+        futures = {}
+        for name, query in queries.items():
+            try:
+                job = bigquery_client.query(query)
+                futures[name] = (job, executor.submit(_fetch_reference_table, job, REFERENCE_QUERY_TIMEOUT_SECONDS))
+            except Exception as e:
+                fallback(name, e)
+        
+        for name, (job, future) in futures.items():
+            try:
+                reference_data[name] = future.result(timeout=max(0, deadline - time.time()))
+            except Exception as e:
+                if isinstance(e, FutureTimeoutError):
+                    e = f"timed out after {REFERENCE_QUERY_TIMEOUT_SECONDS}s"
+                    try:
+                        job.cancel()
+                    except Exception:
+                        pass
+                fallback(name, e)
         
-        # Exact match
-        if input_name_clean == table_name_clean:
-            return table_name
+        # Don't wait on stragglers; their results are no longer needed
+        executor.shutdown(wait=False, cancel_futures=True)
+    else:
+        for name, query in queries.items():
+            try:
+                reference_data[name] = _fetch_reference_table(bigquery_client.query(query), REFERENCE_QUERY_TIMEOUT_SECONDS)
+            except Exception as e:
+                fallback(name, e)
+    
+    reference_data = {name: reference_data[name] for name in queries}
+    print(f"✓ Loaded reference data in {time.time() - started:.2f}s: "
+          + ", ".join(f"{name}={len(df)}" for name, df in reference_data.items()))
+    
+    if len(failed_tables) == len(queries):
+        raise RuntimeError(f"All reference queries failed: {', '.join(failed_tables)}")
+    
+    reference_data['failed_tables'] = failed_tables
+    build_reference_indexes(reference_data)
+    return reference_data
+
+def build_reference_indexes(reference_data):
+    """Precompute lookup structures derived from the reference tables"""
+    # In pushdown mode the customers table is never loaded
+    customers_df = reference_data.get('customers', pd.DataFrame())
+    if customers_df.empty:
+        reference_data['customer_index'] = CompanyMatchIndex([])
+        reference_data['customer_records'] = []
+    else:
+        reference_data['customer_index'] = CompanyMatchIndex(customers_df['company_name'].tolist())
+        reference_data['customer_records'] = customers_df.to_dict('records')
+    
+    industries = customers_df['industry'].dropna().unique() if not customers_df.empty else []
+    reference_data['industry_index'] = IndustryContextIndex(reference_data, industries)
+    return reference_data
+
+class ReferenceDataCache:
+    """
+    Process-wide cache of the reference tables used by get_bigquery_context.
+    The first caller loads synchronously; after the TTL expires callers keep
+    getting the stale copy while a background thread reloads it.
+    """
+    
+    def __init__(self, loader, ttl_seconds, retry_seconds=60):
+        self._loader = loader
+        self._ttl_seconds = ttl_seconds
+        self._retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._data = None
+        self._loaded_at = None
+        self._next_refresh_at = None
+        self._refreshing = False
+        self._hits = 0
+        self._misses = 0
+        self._stale_hits = 0
+        self._loads = 0
+        self._load_errors = 0
+        self._last_load_seconds = None
+        self._last_error = None
+    
+    def get(self):
+        """Return the cached reference data, loading it on first use"""
+        with self._lock:
+            if self._data is not None:
+                self._hits += 1
+                if time.time() >= self._next_refresh_at:
+                    self._stale_hits += 1
+                    if not self._refreshing:
+                        self._refreshing = True
+                        thread = threading.Thread(target=self._refresh_in_background)
+                        thread.daemon = True
+                        thread.start()
+                return self._data
+            self._misses += 1
         
-        # Contains match
-        if input_name_clean in table_name_clean or table_name_clean in input_name_clean:
-            return table_name
+        # Cold path: only one thread hits BigQuery, the rest wait for its result
+        with self._load_lock:
+            with self._lock:
+                if self._data is not None:
+                    return self._data
+            return self._load()
+    
+    def invalidate(self):
+        """Force the next get() to trigger a reload"""
+        with self._lock:
+            if self._data is not None:
+                self._next_refresh_at = 0
+    
+    def _load(self):
+        started = time.time()
+        try:
+            data = self._loader(self._data)
+        except Exception as e:
+            with self._lock:
+                self._load_errors += 1
+                self._last_error = str(e)
+                if self._data is not None:
+                    self._next_refresh_at = time.time() + self._retry_seconds
+            raise
         
-        # Fuzzy match using SequenceMatcher
-        ratio = SequenceMatcher(None, input_name_clean, table_name_clean).ratio()
-        if ratio > best_ratio and ratio > 0.8:  # 80% similarity threshold
-            best_ratio = ratio
-            best_match = table_name
+        with self._lock:
+            self._data = data
+            self._loaded_at = time.time()
+            self._next_refresh_at = self._loaded_at + self._ttl_seconds
+            if data.get('failed_tables'):
+                # Partial load: keep serving it but retry the missing tables soon
+                self._next_refresh_at = min(self._next_refresh_at, self._loaded_at + self._retry_seconds)
+            self._loads += 1
+            self._last_load_seconds = self._loaded_at - started
+            self._last_error = None
+        return data
+    
+    def _refresh_in_background(self):
+        try:
+            with self._load_lock:
+                self._load()
+            print("✓ Reference data cache refreshed")
+        except Exception as e:
+            print(f"⚠ Reference data refresh failed, serving stale data: {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing = False
     
-    return best_match
+    def stats(self):
+        """Hit/miss counters and age of the cached data"""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'loaded': self._data is not None,
+                'ttl_seconds': self._ttl_seconds,
+                'age_seconds': round(time.time() - self._loaded_at, 1) if self._loaded_at else None,
+                'hits': self._hits,
+                'misses': self._misses,
+                'stale_hits': self._stale_hits,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else None,
+                'loads': self._loads,
+                'load_errors': self._load_errors,
+                'last_load_seconds': round(self._last_load_seconds, 3) if self._last_load_seconds is not None else None,
+                'refreshing': self._refreshing,
+                'failed_tables': self._data.get('failed_tables', []) if self._data is not None else [],
+                'last_error': self._last_error
+            }
 
-def get_bigquery_context(company_name):
+reference_cache = ReferenceDataCache(load_reference_data, REFERENCE_CACHE_TTL_SECONDS, REFERENCE_CACHE_RETRY_SECONDS)
+
+def lookup_customers_pushdown(company_names):
     """
-    Retrieve relevant context from BigQuery datasets with intelligent matching
+    Resolve companies against the customers table inside BigQuery
+    Only the exact / contains / same-prefix candidates for each name are
+    returned and then scored locally with CompanyMatchIndex, so cost scales
+    with the number of candidates rather than the size of the table
+    Returns {company_name: (customer_data, confidence)}, (None, 0.0) when unmatched
+    """
+    results = {name: (None, 0.0) for name in company_names}
+    names_by_key = {}
+    for name in company_names:
+        name_key = _clean_company_name(name)
+        if name_key:
+            names_by_key.setdefault(name_key, []).append(name)
+    if not names_by_key:
+        return results
+    
+    query = f"""
+    WITH customers AS (
+        SELECT {CUSTOMER_COLUMNS}, LOWER(TRIM(company_name)) AS clean_name
+        FROM `{PROJECT_ID}.{DATASET_ID}.customers`
+        WHERE TRIM(company_name) != ''
+    )
+    SELECT lookup.name_key AS match_key, customers.* EXCEPT (clean_name)
+    FROM customers, UNNEST(@lookups) AS lookup
+    WHERE customers.clean_name = lookup.name_key
+       OR STRPOS(customers.clean_name, lookup.name_key) > 0
+       OR STRPOS(lookup.name_key, customers.clean_name) > 0
+       OR STARTS_WITH(customers.clean_name, lookup.normalized_key)
+       OR (STARTS_WITH(customers.clean_name, lookup.prefix)
+           AND LENGTH(customers.clean_name) BETWEEN lookup.min_length AND lookup.max_length)
+    QUALIFY ROW_NUMBER() OVER (
+        PARTITION BY lookup.name_key
+        ORDER BY customers.clean_name = lookup.name_key DESC, LENGTH(customers.clean_name)
+    ) <= @max_candidates
+    """
+    
+    name_keys = list(names_by_key)
+    for offset in range(0, len(name_keys), 500):
+        lookups = []
+        for name_key in name_keys[offset:offset + 500]:
+            # Same length window CompanyMatchIndex uses to rule out fuzzy candidates
+            min_length = int(len(name_key) * FUZZY_MATCH_THRESHOLD / (2 - FUZZY_MATCH_THRESHOLD))
+            max_length = int(len(name_key) * (2 - FUZZY_MATCH_THRESHOLD) / FUZZY_MATCH_THRESHOLD) + 1
+            lookups.append(bigquery.StructQueryParameter(
+                None,
+                bigquery.ScalarQueryParameter('name_key', 'STRING', name_key),
+                bigquery.ScalarQueryParameter('normalized_key', 'STRING', normalize_company_name(name_key) or name_key),
+                bigquery.ScalarQueryParameter('prefix', 'STRING', name_key[:3]),
+                bigquery.ScalarQueryParameter('min_length', 'INT64', min_length),
+                bigquery.ScalarQueryParameter('max_length', 'INT64', max_length),
+            ))
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ArrayQueryParameter('lookups', 'STRUCT', lookups),
+            bigquery.ScalarQueryParameter('max_candidates', 'INT64', CUSTOMER_PUSHDOWN_MAX_CANDIDATES),
+        ])
+        candidates_df = bigquery_client.query(query, job_config=job_config).to_dataframe()
+        if candidates_df.empty:
+            continue
+        
+        for name_key, group in candidates_df.groupby('match_key'):
+            group = group.drop(columns=['match_key'])
+            index = CompanyMatchIndex(group['company_name'].tolist())
+            for name in names_by_key.get(name_key, []):
+                position, confidence = index.lookup(name)
+                if position is not None:
+                    results[name] = (group.iloc[position].to_dict(), confidence)
+    
+    return results
+
+class CompanyAliasStore:
+    """
+    Persistent input name -> customer name mappings (SQLite)
+    Keys are normalize_company_name() of the input; a known alias skips fuzzy
+    matching entirely and resolves straight to the recorded customer
+    """
+    
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._hits = 0
+        self._misses = 0
+        self._stale = 0
+        self._writes = 0
+        if not path:
+            return
+        try:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS company_aliases (
+                    alias_key TEXT PRIMARY KEY,
+                    customer_name TEXT NOT NULL,
+                    confidence REAL,
+                    updated_at TEXT
+                )
+            """)
+            self._conn.commit()
+            print(f"✓ Company alias store: {path}")
+        except Exception as e:
+            print(f"⚠ Warning: Could not open company alias store {path}: {str(e)}")
+            self._conn = None
+    
+    def get_many(self, alias_keys):
+        """Returns {alias_key: (customer_name, confidence)} for the known keys"""
+        alias_keys = [key for key in set(alias_keys) if key]
+        found = {}
+        if self._conn is None or not alias_keys:
+            return found
+        with self._lock:
+            for offset in range(0, len(alias_keys), 500):
+                chunk = alias_keys[offset:offset + 500]
+                rows = self._conn.execute(
+                    f"SELECT alias_key, customer_name, confidence FROM company_aliases "
+                    f"WHERE alias_key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                for alias_key, customer_name, confidence in rows:
+                    found[alias_key] = (customer_name, confidence if confidence is not None else 1.0)
+            self._hits += len(found)
+            self._misses += len(alias_keys) - len(found)
+        return found
+    
+    def put_many(self, aliases):
+        """Record (alias_key, customer_name, confidence) resolutions"""
+        aliases = [alias for alias in aliases if alias[0]]
+        if self._conn is None or not aliases:
+            return
+        now = datetime.utcnow().isoformat()
+        try:
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO company_aliases (alias_key, customer_name, confidence, updated_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(key, name, confidence, now) for key, name, confidence in aliases]
+                )
+                self._conn.commit()
+                self._writes += len(aliases)
+        except Exception as e:
+            print(f"⚠ Could not record company aliases: {str(e)}")
+    
+    def forget(self, alias_key):
+        """Drop an alias whose customer no longer exists"""
+        if self._conn is None:
+            return
+        try:
+            with self._lock:
+                self._conn.execute("DELETE FROM company_aliases WHERE alias_key = ?", (alias_key,))
+                self._conn.commit()
+                self._stale += 1
+        except Exception as e:
+            print(f"⚠ Could not drop company alias: {str(e)}")
+    
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            size = None
+            if self._conn is not None:
+                size = self._conn.execute("SELECT COUNT(*) FROM company_aliases").fetchone()[0]
+            return {
+                'enabled': self._conn is not None,
+                'aliases': size,
+                'hits': self._hits - self._stale,
+                'misses': self._misses + self._stale,
+                'stale': self._stale,
+                'writes': self._writes,
+                'hit_rate': round((self._hits - self._stale) / lookups, 4) if lookups else None
+            }
+
+ALIAS_DB_PATH = os.environ.get('ALIAS_DB_PATH', '/tmp/gtm_company_aliases.db')
+company_alias_store = CompanyAliasStore(ALIAS_DB_PATH)
+
+def _match_customers(company_names, reference_data):
+    """Fuzzy-match company names using CUSTOMER_LOOKUP_MODE, ignoring aliases"""
+    if CUSTOMER_LOOKUP_MODE == 'pushdown':
+        return lookup_customers_pushdown(company_names)
+    
+    results = {}
+    for name in company_names:
+        position, confidence = reference_data['customer_index'].lookup(name)
+        if position is None:
+            results[name] = (None, 0.0)
+        else:
+            results[name] = (dict(reference_data['customer_records'][position]), confidence)
+    return results
+
+def resolve_customers(company_names, reference_data):
+    """
+    Match company names to customer rows
+    Known aliases resolve directly to their recorded customer; everything
+    else is fuzzy matched and successful resolutions are written back
+    Returns {company_name: (customer_data, confidence)}, (None, 0.0) when unmatched
+    """
+    names = list(dict.fromkeys(company_names))
+    alias_keys = {name: normalize_company_name(name) for name in names}
+    aliases = company_alias_store.get_many(alias_keys.values())
+    
+    results = {}
+    pending = [name for name in names if alias_keys[name] not in aliases]
+    aliased = [name for name in names if alias_keys[name] in aliases]
+    
+    if aliased:
+        canonical_names = list({aliases[alias_keys[name]][0] for name in aliased})
+        # A miss only proves an alias stale when the customer data actually
+        # loaded; after a failed load or query the alias is kept for next time
+        customers_loaded = 'customers' not in reference_data.get('failed_tables', [])
+        try:
+            canonical = _match_customers(canonical_names, reference_data)
+        except Exception as e:
+            print(f"⚠ Could not verify company aliases: {str(e)}")
+            canonical = {}
+            customers_loaded = False
+        for name in aliased:
+            customer_name, confidence = aliases[alias_keys[name]]
+            customer_data, _ = canonical.get(customer_name, (None, 0.0))
+            if customer_data and _clean_company_name(customer_data['company_name']) == _clean_company_name(customer_name):
+                results[name] = (customer_data, confidence)
+            else:
+                if customers_loaded:
+                    company_alias_store.forget(alias_keys[name])
+                pending.append(name)
+    
+    if pending:
+        matched = _match_customers(pending, reference_data)
+        results.update(matched)
+        company_alias_store.put_many([
+            (alias_keys[name], customer_data['company_name'], confidence)
+            for name, (customer_data, confidence) in matched.items() if customer_data
+        ])
+    
+    return results
+
+def resolve_customer(company_name, reference_data):
+    """
+    Match a company name to a customer row
+    Returns (customer_data, confidence) or (None, 0.0)
     """
-    context = {
+    return resolve_customers([company_name], reference_data)[company_name]
+
+def _empty_context():
+    return {
         'customer_match': None,
         'customer_data': {},
         'relevant_products': [],
         'relevant_campaigns': [],
-        'relevant_sales_plays': []
+        'relevant_sales_plays': [],
+        'match_confidence': 0.0
     }
+
+def build_customer_context(customer_data, confidence, reference_data):
+    """Assemble the context for a resolved customer (or None when unmatched)"""
+    context = _empty_context()
+    
+    if customer_data:
+        context['customer_match'] = customer_data['company_name']
+        context['customer_data'] = customer_data
+        context['match_confidence'] = round(confidence, 4)
+    
+    # Products, campaigns and sales plays relevant to the customer's industry
+    industry = customer_data.get('industry') if customer_data else None
+    relevant = reference_data['industry_index'].lookup(industry)
+    for key, items in relevant.items():
+        context[key] = list(items)
+    
+    return context
+
+def get_bigquery_context(company_name):
+    """
+    Retrieve relevant context from BigQuery datasets with intelligent matching
+    Reference tables are served from reference_cache rather than queried per call
+    """
+    context = _empty_context()
     
     if not bigquery_client:
         print("BigQuery client not available")
         return context
     
     try:
-        # 1. Find matching customer with fuzzy matching
-        query = f"""
-        SELECT company_name, industry, account_manager, relationship_status, 
-               last_interaction_date, auditor_firm, annual_revenue, employee_count,
-               headquarters_location
-        FROM `{PROJECT_ID}.{DATASET_ID}.customers`
-        """
-        customers_df = bigquery_client.query(query).to_dataframe()
-        
-        if not customers_df.empty:
-            customer_names = customers_df['company_name'].tolist()
-            matched_name = fuzzy_match_company(company_name, customer_names)
-            
-            if matched_name:
-                customer_data = customers_df[customers_df['company_name'] == matched_name].iloc[0].to_dict()
-                context['customer_match'] = matched_name
-                context['customer_data'] = customer_data
-                print(f"✓ Found customer match: {matched_name}")
-                
-                # Get customer industry for product/campaign matching
-                customer_industry = customer_data.get('industry', '')
+        reference_data = reference_cache.get()
         
-        # 2. Get relevant products based on target industries
-        query = f"""
-        SELECT product_name, product_category, target_industries, features, 
-               competitive_advantage, base_price
-        FROM `{PROJECT_ID}.{DATASET_ID}.products`
-        """
-        products_df = bigquery_client.query(query).to_dataframe()
-        
-        if not products_df.empty:
-            # Filter products by industry relevance if we have customer data
-            if context['customer_data']:
-                customer_industry = context['customer_data'].get('industry', '').lower()
-                relevant_products = products_df[
-                    products_df['target_industries'].str.lower().str.contains(customer_industry, na=False, regex=False)
-                ]
-                if not relevant_products.empty:
-                    context['relevant_products'] = relevant_products.to_dict('records')
-                    print(f"✓ Found {len(context['relevant_products'])} relevant products")
-            
-            # If no industry match or no customer, get all products
-            if not context['relevant_products']:
-                context['relevant_products'] = products_df.head(5).to_dict('records')
+        # Find matching customer with fuzzy matching
+        customer_data, confidence = resolve_customer(company_name, reference_data)
+        context = build_customer_context(customer_data, confidence, reference_data)
         
-        # 3. Get relevant marketing campaigns based on target industry
-        query = f"""
-        SELECT campaign_name, target_industry, budget_allocated, 
-               conversion_rate, end_date
-        FROM `{PROJECT_ID}.{DATASET_ID}.marketing_budget`
-        ORDER BY conversion_rate DESC, budget_allocated DESC
-        """
-        campaigns_df = bigquery_client.query(query).to_dataframe()
-        
-        if not campaigns_df.empty:
-            # Filter campaigns by industry if we have customer data
-            if context['customer_data']:
-                customer_industry = context['customer_data'].get('industry', '').lower()
-                relevant_campaigns = campaigns_df[
-                    campaigns_df['target_industry'].str.lower().str.contains(customer_industry, na=False, regex=False)
-                ]
-                if not relevant_campaigns.empty:
-                    context['relevant_campaigns'] = relevant_campaigns.to_dict('records')
-                    print(f"✓ Found {len(context['relevant_campaigns'])} relevant campaigns")
-            
-            # If no industry match, get top campaigns by conversion rate
-            if not context['relevant_campaigns']:
-                context['relevant_campaigns'] = campaigns_df.head(3).to_dict('records')
+        if customer_data:
+            print(f"✓ Found customer match: {context['customer_match']} (confidence {confidence:.2f})")
         
-        # 4. Get relevant sales plays based on target industry
-        query = f"""
-        SELECT play_name, target_persona, target_industry, value_proposition,
-               engagement_strategy, success_metrics, recommended_products
-        FROM `{PROJECT_ID}.{DATASET_ID}.sales_plays`
-        """
-        plays_df = bigquery_client.query(query).to_dataframe()
-        
-        if not plays_df.empty:
-            # Filter plays by industry if we have customer data
-            if context['customer_data']:
-                customer_industry = context['customer_data'].get('industry', '').lower()
-                relevant_plays = plays_df[
-                    plays_df['target_industry'].str.lower().str.contains(customer_industry, na=False, regex=False)
-                ]
-                if not relevant_plays.empty:
-                    context['relevant_sales_plays'] = relevant_plays.to_dict('records')
-                    print(f"✓ Found {len(context['relevant_sales_plays'])} relevant sales plays")
-            
-            # If no industry match, get all plays
-            if not context['relevant_sales_plays']:
-                context['relevant_sales_plays'] = plays_df.head(5).to_dict('records')
-            
     except Exception as e:
         print(f"Error querying BigQuery: {str(e)}")
         import traceback
@@ -214,87 +851,70 @@ def get_bigquery_context(company_name):
     
     return context
 
-def create_enhanced_analysis_prompt(company, directive, bq_context):
+def resolve_batch_contexts(company_names, shared=None):
     """
-    Create comprehensive prompt with mandatory BigQuery data usage
+    Batch pre-pass: resolve every distinct company in an upload against the
+    customer table in one step and build each distinct context once
+    Companies matching the same customer share the same product/campaign/play
+    lists; unmatched companies share the default context
+    Uploads read in chunks pass the same shared dict for every chunk, so
+    contexts built for earlier chunks are reused, companies already resolved
+    are skipped and stats cover the whole upload so far
+    Returns ({company_name: context}, stats)
     """
+    started = time.time()
+    shared = shared if shared is not None else {}
+    seen = shared.setdefault('names', set())
+    by_customer = shared.setdefault('by_customer', {})
+    industries = shared.setdefault('industries', set())
+    stats = shared.setdefault('stats', {
+        'companies': 0,
+        'matched': 0,
+        'distinct_contexts': 0,
+        'industries': 0,
+        'seconds': 0.0
+    })
+    names = [name for name in dict.fromkeys(name for name in company_names if name) if name not in seen]
+    seen.update(names)
+    stats['companies'] += len(names)
+    contexts = {}
     
-    # Build customer context section
-    customer_section = ""
-    if bq_context['customer_match']:
-        customer_data = bq_context['customer_data']
-        auditor_firm = customer_data.get('auditor_firm', 'Not specified')
-        customer_section = f"""
-**EXISTING CUSTOMER FOUND: {bq_context['customer_match']}**
-- Industry: {customer_data.get('industry', 'N/A')}
-- Account Manager: {customer_data.get('account_manager', 'Info Missing')}
-- Relationship Status: {customer_data.get('relationship_status', 'Info Missing')}
-- Last Interaction: {customer_data.get('last_interaction_date', 'Info Missing')}
-- Annual Revenue: {customer_data.get('annual_revenue', 'N/A')}
-- Employee Count: {customer_data.get('employee_count', 'N/A')}
-- Headquarters: {customer_data.get('headquarters_location', 'N/A')}
-- **Auditor Firm**: {auditor_firm}
-
-**CRITICAL: This is an EXISTING CUSTOMER. Your analysis must reflect this relationship.**
-**AUDITOR STATUS: Our records show their auditor is "{auditor_firm}". Use this in your Auditor Status field. Do NOT say "Unknown" if we have this information.**
-"""
-    
-    # Build products section
-    products_section = ""
-    if bq_context['relevant_products']:
-        products_section = "\n**RELEVANT PRODUCTS FROM OUR CATALOG:**\n"
-        for idx, product in enumerate(bq_context['relevant_products'], 1):
-            products_section += f"""
-{idx}. **{product.get('product_name', 'N/A')}** ({product.get('product_category', 'N/A')})
-   - Target Industries: {product.get('target_industries', 'N/A')}
-   - Key Features: {product.get('features', 'N/A')}
-   - Competitive Advantage: {product.get('competitive_advantage', 'N/A')}
-   - Pricing Tier: {product.get('base_price', 'N/A')}
-   
-"""
-    
-    # Build campaigns section
-    campaigns_section = ""
-    if bq_context['relevant_campaigns']:
-        campaigns_section = "\n**RELEVANT MARKETING CAMPAIGNS:**\n"
-        for idx, campaign in enumerate(bq_context['relevant_campaigns'], 1):
-            campaigns_section += f"""
-{idx}. **{campaign.get('campaign_name', 'N/A')}**
-   - Target Industry: {campaign.get('target_industry', 'N/A')}
-   - Budget Allocated: {campaign.get('budget_allocated', 'N/A')}
-   - Conversion Rate: {campaign.get('conversion_rate', 'N/A')}%
-   - End Date: {campaign.get('end_date', 'N/A')}
-   
-"""
+    if not bigquery_client or not names:
+        return contexts, stats
     
-    # Build sales plays section
-    plays_section = ""
-    if bq_context['relevant_sales_plays']:
-        plays_section = "\n**RELEVANT SALES PLAYS:**\n"
-        for idx, play in enumerate(bq_context['relevant_sales_plays'], 1):
-            plays_section += f"""
-{idx}. **{play.get('play_name', 'N/A')}**
-   - Target Persona: {play.get('target_persona', 'N/A')}
-   - Target Industry: {play.get('target_industry', 'N/A')}
-   - Value Proposition: {play.get('value_proposition', 'N/A')}
-   - Engagement Strategy: {play.get('engagement_strategy', 'N/A')}
-   - Success Metrics: {play.get('success_metrics', 'N/A')}
-   - Recommended Products: {play.get('recommended_products', 'N/A')}
-   
-"""
+    try:
+        reference_data = reference_cache.get()
+        resolved = resolve_customers(names, reference_data)
+        
+        for name, (customer_data, confidence) in resolved.items():
+            customer_key = customer_data['company_name'] if customer_data else None
+            if customer_key not in by_customer:
+                by_customer[customer_key] = build_customer_context(customer_data, confidence, reference_data)
+            context = by_customer[customer_key]
+            if customer_data:
+                stats['matched'] += 1
+                industries.add(_normalize_industry(customer_data.get('industry')))
+                # Shallow copy so each company keeps its own confidence
+                context = dict(context, match_confidence=round(confidence, 4))
+            contexts[name] = context
+        
+        stats['distinct_contexts'] = len(by_customer)
+        stats['industries'] = len(industries)
+    except Exception as e:
+        print(f"✗ Batch context pre-pass failed, falling back to per-company lookups: {str(e)}")
+        contexts = {}
     
-    prompt = f"""You are a world-class business intelligence analyst with access to internal company data.
-
-COMPANY TO ANALYZE: {company}
-ANALYSIS DIRECTIVE: {directive}
+    stats['seconds'] = round(stats['seconds'] + time.time() - started, 3)
+    print(f"✓ Batch pre-pass: {stats['matched']}/{stats['companies']} companies matched, "
+          f"{stats['distinct_contexts']} distinct contexts, {stats['industries']} industries in {stats['seconds']}s")
+    return contexts, stats
 
-{customer_section}
+# Static instruction block shared by every analysis prompt. Nothing company
+# specific may go in here: it is sent first (or registered as cached content)
+# so identical bytes can be reused across calls.
+ANALYSIS_INSTRUCTIONS = """You are a world-class business intelligence analyst with access to internal company data.
 
-=== INTERNAL DATA FROM YOUR COMPANY SYSTEMS ===
-{products_section}
-{campaigns_section}
-{plays_section}
-===================================================
+Each request gives you a COMPANY TO ANALYZE, an ANALYSIS DIRECTIVE, INTERNAL DATA FROM YOUR COMPANY SYSTEMS (existing customer record, relevant products, marketing campaigns and sales plays) and COMPANY-SPECIFIC NOTES. Write the report described below for that company.
 
 **CRITICAL INSTRUCTIONS FOR USING INTERNAL DATA:**
 
@@ -304,7 +924,7 @@ ANALYSIS DIRECTIVE: {directive}
    - Consider annual revenue and employee count when scoring
 
 2. **PRODUCT RECOMMENDATIONS:**
-   - You MUST recommend specific products from "RELEVANT PRODUCTS" section above
+   - You MUST recommend specific products from the "RELEVANT PRODUCTS" section of the internal data
    - Match products to customer needs based on target industries and features
    - Explain why each product's competitive advantage fits this customer
    - Reference pricing tier and implementation time in your recommendations. Use web search for implementation time estimate.
@@ -315,7 +935,7 @@ ANALYSIS DIRECTIVE: {directive}
    - Reference budget allocation to show company commitment to this market
 
 4. **SALES PLAY INTEGRATION:**
-   - Identify which sales play(s) from above are most relevant
+   - Identify which sales play(s) from the internal data are most relevant
    - Use the value proposition from the sales play in your win themes
    - Incorporate engagement strategy from sales plays into your recommendations
    - Reference success metrics when discussing potential outcomes
@@ -331,6 +951,10 @@ ANALYSIS DIRECTIVE: {directive}
    - DO NOT make up numbers. If data unavailable, state "Unknown - needs manual research"
    - Clearly distinguish between INTERNAL DATA and PUBLIC INFORMATION
 
+7. **COMPANY-SPECIFIC NOTES:**
+   - Apply every note given for a section exactly where the response format below points to it
+   - Notes taken from our customer records (such as the auditor firm) override public information
+
 **RESPONSE FORMAT - USE THESE EXACT HEADERS:**
 
 ## 1. COMPANY OVERVIEW
@@ -342,9 +966,7 @@ ANALYSIS DIRECTIVE: {directive}
 - Status: [Public/Private or "Unknown - needs manual research"]
 - Description: [2-3 sentences]
 - Key Products/Services: [List 3-5]
-{f"- **Relationship Status**: {bq_context['customer_data'].get('relationship_status', 'Info Missing')}" if bq_context['customer_match'] else ""}
-{f"- **Account Manager**: {bq_context['customer_data'].get('account_manager', 'Info Missing')}" if bq_context['customer_match'] else ""}
-{f"- **Last Interaction Date**: {bq_context['customer_data'].get('last_interaction_date', 'Info Missing')}" if bq_context['customer_match'] else ""}
+[Add any relationship lines listed under Section 1 in the COMPANY-SPECIFIC NOTES]
 
 ## 2. FINANCIAL HEALTH
 - Revenue: [Most recent annual revenue or "Unknown - needs manual research"]
@@ -360,8 +982,8 @@ ANALYSIS DIRECTIVE: {directive}
 **Prospect Score:** [0-100 numeric value]
 
 **Scoring Breakdown:**
-- Strategic Fit: [score]/30 {f"(+5 bonus if existing customer: {'+5' if bq_context['customer_match'] else '+0'})" if bq_context['customer_match'] else ""}
-- Market Readiness: [score]/25 {f"(Influenced by {bq_context['relevant_campaigns'][0]['conversion_rate']}% campaign conversion rate)" if bq_context['relevant_campaigns'] else ""}
+- Strategic Fit: [score]/30
+- Market Readiness: [score]/25
 - Financial Capacity: [score]/20
 - Competitive Position: [score]/15
 - Urgency/Timing: [score]/10
@@ -373,14 +995,13 @@ ANALYSIS DIRECTIVE: {directive}
 - Existing relationship if customer
 - Sales play alignment]
 
-**Auditor Status:** {f'✓ {bq_context["customer_data"].get("auditor_firm", "Unknown")} (from our customer records - DO NOT change this)' if bq_context['customer_match'] and bq_context["customer_data"].get("auditor_firm") else '[Based on public information or "Unknown - needs manual research"]'}
+**Auditor Status:** [As given under Section 3 in the COMPANY-SPECIFIC NOTES]
 
 ## 4. WIN THEMES
 
 **Identify 3-5 compelling win themes based on INTERNAL DATA:**
 
-{f"**Recommended Sales Play**: {bq_context['relevant_sales_plays'][0]['play_name']}" if bq_context['relevant_sales_plays'] else ""}
-{f"**Value Proposition**: {bq_context['relevant_sales_plays'][0]['value_proposition']}" if bq_context['relevant_sales_plays'] else ""}
+[Start with the Recommended Sales Play and Value Proposition listed under Section 4 in the COMPANY-SPECIFIC NOTES, if any]
 
 1. [Win Theme 1 - Must reference relevant products or campaigns]
 2. [Win Theme 2 - Must reference competitive advantages from product catalog]
@@ -391,7 +1012,7 @@ ANALYSIS DIRECTIVE: {directive}
 
 **Products from Our Catalog:**
 
-{f"Based on the analysis, recommend products from our catalog, explaining:" if bq_context['relevant_products'] else "Recommend products based on customer needs:"}
+[Follow the Section 5 note in the COMPANY-SPECIFIC NOTES]
 
 1. **[Product Name from Catalog]**
    - **Why It Fits:** [Explain the match between the prospect's needs and this product's features and target industry.]
@@ -405,20 +1026,18 @@ ANALYSIS DIRECTIVE: {directive}
 [Research public information to identify key decision-makers. **Prioritize finding individuals who match the 'Target Persona' from the relevant sales play, if available.**]
 
 - **Executive Sponsor (CEO/C-Suite):** [Name and Title]
-- **Primary Decision Maker ({f"e.g., a {bq_context['relevant_sales_plays'][0]['target_persona']}" if bq_context['relevant_sales_plays'] else "e.g., VP of Operations"}):** [Name and Title]
+- **Primary Decision Maker ([persona given under Section 6 in the COMPANY-SPECIFIC NOTES]):** [Name and Title]
 - **Key Influencers/Department Heads:** [Name and Title]
 
 ## 7. ENGAGEMENT STRATEGY
 
-**Based on Sales Play: {bq_context['relevant_sales_plays'][0]['play_name'] if bq_context['relevant_sales_plays'] else 'Standard Enterprise'}**
+**Based on Sales Play: [sales play given under Section 7 in the COMPANY-SPECIFIC NOTES]**
 
 **Recommended Approach:**
-{f"- Target Persona: {bq_context['relevant_sales_plays'][0]['target_persona']}" if bq_context['relevant_sales_plays'] else ""}
-{f"- Engagement Strategy: {bq_context['relevant_sales_plays'][0]['engagement_strategy']}" if bq_context['relevant_sales_plays'] else ""}
-{f"- Expected Product Fit: {bq_context['relevant_sales_plays'][0]['recommended_products']}" if bq_context['relevant_sales_plays'] else ""}
+[Target persona, engagement strategy and expected product fit listed under Section 7 in the COMPANY-SPECIFIC NOTES]
 
 **Campaign Alignment:**
-{f"- Align with our internal '{bq_context['relevant_campaigns'][0]['campaign_name']}' campaign where relevant." if bq_context['relevant_campaigns'] else "- No specific internal campaign to align with."}
+[Campaign alignment listed under Section 7 in the COMPANY-SPECIFIC NOTES]
 - **Generated Key Message:** [Based on the win themes and recommended solutions, create a concise and compelling message for the target persona.]
 - **Suggested Channels:** [Recommend 2-3 marketing and sales channels (e.g., LinkedIn outreach, targeted ads, industry webinar) that are suitable for delivering the key message to this prospect.]
 
@@ -446,47 +1065,1565 @@ ANALYSIS DIRECTIVE: {directive}
 2. [Partnership development]
 3. [Additional actions]
 
-**Success Metrics** {f"(from {bq_context['relevant_sales_plays'][0]['play_name']} playbook):" if bq_context['relevant_sales_plays'] else ":"}
-{f"- {bq_context['relevant_sales_plays'][0]['success_metrics']}" if bq_context['relevant_sales_plays'] else "- [Define specific KPIs]"}
+**Success Metrics** [from the playbook named under Section 8 in the COMPANY-SPECIFIC NOTES, if any]:
+[Success metrics listed under Section 8 in the COMPANY-SPECIFIC NOTES]
 """
-    
-    return prompt
 
-# [Previous Flask routes: /login, /auth/google, /logout remain the same]
-# [Copy lines 61-241 from main_session_auth.py]
+def _format_customer_section(bq_context):
+    if not bq_context['customer_match']:
+        return ""
+    customer_data = bq_context['customer_data']
+    auditor_firm = customer_data.get('auditor_firm', 'Not specified')
+    return f"""
+**EXISTING CUSTOMER FOUND: {bq_context['customer_match']}**
+- Industry: {customer_data.get('industry', 'N/A')}
+- Account Manager: {customer_data.get('account_manager', 'Info Missing')}
+- Relationship Status: {customer_data.get('relationship_status', 'Info Missing')}
+- Last Interaction: {customer_data.get('last_interaction_date', 'Info Missing')}
+- Annual Revenue: {customer_data.get('annual_revenue', 'N/A')}
+- Employee Count: {customer_data.get('employee_count', 'N/A')}
+- Headquarters: {customer_data.get('headquarters_location', 'N/A')}
+- **Auditor Firm**: {auditor_firm}
 
-@app.route('/login')
-def login():
-    """Login page with Google Sign-In"""
-    if 'user_email' in session:
-        return redirect('/')
-    
-    login_html = '''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Login - Strategic GTM Agent</title>
-        <script src="https://accounts.google.com/gsi/client" async defer></script>
-        <style>
-            * { margin: 0; padding: 0; box-sizing: border-box; }
-            body {
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', sans-serif;
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                min-height: 100vh;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                padding: 20px;
-            }
-            .login-card {
-                background: white;
-                border-radius: 20px;
-                box-shadow: 0 20px 60px rgba(0,0,0,0.3);
-                padding: 60px 40px;
-                max-width: 440px;
-                width: 100%;
+**CRITICAL: This is an EXISTING CUSTOMER. Your analysis must reflect this relationship.**
+**AUDITOR STATUS: Our records show their auditor is "{auditor_firm}". Use this in your Auditor Status field. Do NOT say "Unknown" if we have this information.**
+"""
+
+def _format_product(idx, product):
+    return f"""
+{idx}. **{product.get('product_name', 'N/A')}** ({product.get('product_category', 'N/A')})
+   - Target Industries: {product.get('target_industries', 'N/A')}
+   - Key Features: {product.get('features', 'N/A')}
+   - Competitive Advantage: {product.get('competitive_advantage', 'N/A')}
+   - Pricing Tier: {product.get('base_price', 'N/A')}
+   
+"""
+
+def _format_campaign(idx, campaign):
+    return f"""
+{idx}. **{campaign.get('campaign_name', 'N/A')}**
+   - Target Industry: {campaign.get('target_industry', 'N/A')}
+   - Budget Allocated: {campaign.get('budget_allocated', 'N/A')}
+   - Conversion Rate: {campaign.get('conversion_rate', 'N/A')}%
+   - End Date: {campaign.get('end_date', 'N/A')}
+   
+"""
+
+def _format_sales_play(idx, play):
+    return f"""
+{idx}. **{play.get('play_name', 'N/A')}**
+   - Target Persona: {play.get('target_persona', 'N/A')}
+   - Target Industry: {play.get('target_industry', 'N/A')}
+   - Value Proposition: {play.get('value_proposition', 'N/A')}
+   - Engagement Strategy: {play.get('engagement_strategy', 'N/A')}
+   - Success Metrics: {play.get('success_metrics', 'N/A')}
+   - Recommended Products: {play.get('recommended_products', 'N/A')}
+   
+"""
+
+def _format_items_section(title, items, formatter):
+    if not items:
+        return ""
+    return f"\n**{title}:**\n" + "".join(formatter(idx, item) for idx, item in enumerate(items, 1))
+
+def _format_company_notes(bq_context):
+    """Per-company hints for the response format in ANALYSIS_INSTRUCTIONS"""
+    customer_match = bq_context['customer_match']
+    customer_data = bq_context['customer_data']
+    campaigns = bq_context['relevant_campaigns']
+    plays = bq_context['relevant_sales_plays']
+    top_play = plays[0] if plays else None
+    
+    notes = ["**COMPANY-SPECIFIC NOTES:**", ""]
+    
+    notes.append("Section 1 (Company Overview):")
+    if customer_match:
+        notes.append(f"- **Relationship Status**: {customer_data.get('relationship_status', 'Info Missing')}")
+        notes.append(f"- **Account Manager**: {customer_data.get('account_manager', 'Info Missing')}")
+        notes.append(f"- **Last Interaction Date**: {customer_data.get('last_interaction_date', 'Info Missing')}")
+    else:
+        notes.append("- Not an existing customer; no relationship lines")
+    
+    notes.append("")
+    notes.append("Section 3 (Prospect Analysis):")
+    if customer_match:
+        notes.append("- Strategic Fit: (+5 bonus if existing customer: +5)")
+    if campaigns:
+        notes.append(f"- Market Readiness: (Influenced by {campaigns[0]['conversion_rate']}% campaign conversion rate)")
+    if customer_match and customer_data.get('auditor_firm'):
+        notes.append(f"- Auditor Status: ✓ {customer_data.get('auditor_firm', 'Unknown')} (from our customer records - DO NOT change this)")
+    else:
+        notes.append('- Auditor Status: [Based on public information or "Unknown - needs manual research"]')
+    
+    notes.append("")
+    notes.append("Section 4 (Win Themes):")
+    if top_play:
+        notes.append(f"- **Recommended Sales Play**: {top_play['play_name']}")
+        notes.append(f"- **Value Proposition**: {top_play['value_proposition']}")
+    else:
+        notes.append("- No recommended sales play")
+    
+    notes.append("")
+    notes.append("Section 5 (Recommended Solutions):")
+    if bq_context['relevant_products']:
+        notes.append("- Based on the analysis, recommend products from our catalog, explaining:")
+    else:
+        notes.append("- Recommend products based on customer needs:")
+    
+    notes.append("")
+    notes.append("Section 6 (Key Personnel):")
+    if top_play:
+        notes.append(f"- Primary Decision Maker persona: e.g., a {top_play['target_persona']}")
+    else:
+        notes.append("- Primary Decision Maker persona: e.g., VP of Operations")
+    
+    notes.append("")
+    notes.append("Section 7 (Engagement Strategy):")
+    notes.append(f"- Based on Sales Play: {top_play['play_name'] if top_play else 'Standard Enterprise'}")
+    if top_play:
+        notes.append(f"- Target Persona: {top_play['target_persona']}")
+        notes.append(f"- Engagement Strategy: {top_play['engagement_strategy']}")
+        notes.append(f"- Expected Product Fit: {top_play['recommended_products']}")
+    if campaigns:
+        notes.append(f"- Align with our internal '{campaigns[0]['campaign_name']}' campaign where relevant.")
+    else:
+        notes.append("- No specific internal campaign to align with.")
+    
+    notes.append("")
+    notes.append("Section 8 (Go-to-Market Action Plan):")
+    if top_play:
+        notes.append(f"- Success Metrics (from {top_play['play_name']} playbook):")
+        notes.append(f"- {top_play['success_metrics']}")
+    else:
+        notes.append("- Success Metrics: [Define specific KPIs]")
+    
+    return "\n".join(notes) + "\n"
+
+def build_analysis_prompt_parts(company, directive, bq_context):
+    """
+    Split the analysis prompt into a stable prefix and a per-company suffix
+    The prefix is always ANALYSIS_INSTRUCTIONS, byte for byte, so it can be
+    registered as cached content; everything that varies lives in the suffix
+    Returns (prefix, suffix)
+    """
+    suffix = f"""
+COMPANY TO ANALYZE: {company}
+ANALYSIS DIRECTIVE: {directive}
+""" + render_context_block(bq_context)
+    return ANALYSIS_INSTRUCTIONS, suffix
+
+def render_context_block(bq_context):
+    """Customer record, internal data sections and company notes as prompt text"""
+    return f"""
+{_format_customer_section(bq_context)}
+
+=== INTERNAL DATA FROM YOUR COMPANY SYSTEMS ===
+{_format_items_section('RELEVANT PRODUCTS FROM OUR CATALOG', bq_context['relevant_products'], _format_product)}
+{_format_items_section('RELEVANT MARKETING CAMPAIGNS', bq_context['relevant_campaigns'], _format_campaign)}
+{_format_items_section('RELEVANT SALES PLAYS', bq_context['relevant_sales_plays'], _format_sales_play)}
+===================================================
+
+{_format_company_notes(bq_context)}"""
+
+# Input token budget for the full analysis prompt (instructions + company part)
+PROMPT_INPUT_TOKEN_BUDGET = int(os.environ.get('PROMPT_INPUT_TOKEN_BUDGET', 12000))
+
+def estimate_tokens(text):
+    """Rough token count for Gemini prompts (~4 characters per token)"""
+    return (len(text) + 3) // 4
+
+def _as_number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return float('-inf')
+    return number if not pd.isna(number) else float('-inf')
+
+def _industry_match_strength(target, industry):
+    """2 = listed industry equals the customer's, 1 = substring match, 0 = none"""
+    target = _normalize_industry(target)
+    if not industry or not target:
+        return 0
+    if industry in (part.strip() for part in re.split(r'[,;/|]', target)):
+        return 2
+    return 1 if industry in target else 0
+
+def rank_context_items(bq_context):
+    """
+    Order each context section by relevance: products and sales plays by
+    industry match strength, campaigns by conversion rate then budget
+    Ties keep their original order
+    """
+    industry = _normalize_industry(bq_context['customer_data'].get('industry')) if bq_context['customer_data'] else None
+    return {
+        'relevant_products': sorted(
+            bq_context['relevant_products'],
+            key=lambda p: -_industry_match_strength(p.get('target_industries'), industry)
+        ),
+        'relevant_campaigns': sorted(
+            bq_context['relevant_campaigns'],
+            key=lambda c: (-_as_number(c.get('conversion_rate')), -_as_number(c.get('budget_allocated')))
+        ),
+        'relevant_sales_plays': sorted(
+            bq_context['relevant_sales_plays'],
+            key=lambda p: -_industry_match_strength(p.get('target_industry'), industry)
+        ),
+    }
+
+PROMPT_SECTION_FORMATTERS = {
+    'relevant_products': _format_product,
+    'relevant_campaigns': _format_campaign,
+    'relevant_sales_plays': _format_sales_play,
+}
+
+def apply_prompt_budget(company, directive, bq_context, budget_tokens=None):
+    """
+    Trim the product/campaign/sales play sections so the rendered prompt fits
+    the input token budget. Items are ranked with rank_context_items and
+    admitted round-robin across sections; the top item of each non-empty
+    section is always kept because the company notes reference it
+    Returns (budgeted context, prompt stats); bq_context is not modified
+    """
+    budget_tokens = budget_tokens or PROMPT_INPUT_TOKEN_BUDGET
+    ranked = rank_context_items(bq_context)
+    kept = {key: items[:1] for key, items in ranked.items()}
+    
+    budgeted = dict(bq_context, **kept)
+    prefix, suffix = build_analysis_prompt_parts(company, directive, budgeted)
+    used = estimate_tokens(prefix) + estimate_tokens(suffix)
+    
+    next_index = {key: 1 for key in ranked}
+    open_sections = [key for key in ranked if len(ranked[key]) > 1]
+    while open_sections:
+        for key in list(open_sections):
+            item = ranked[key][next_index[key]]
+            cost = estimate_tokens(PROMPT_SECTION_FORMATTERS[key](next_index[key] + 1, item))
+            if used + cost > budget_tokens:
+                open_sections.remove(key)
+                continue
+            kept[key].append(item)
+            used += cost
+            next_index[key] += 1
+            if next_index[key] >= len(ranked[key]):
+                open_sections.remove(key)
+    
+    budgeted = dict(bq_context, **kept)
+    prefix, suffix = build_analysis_prompt_parts(company, directive, budgeted)
+    prompt_stats = {
+        'budget_tokens': budget_tokens,
+        'prompt_chars': len(prefix) + len(suffix),
+        'prompt_tokens': estimate_tokens(prefix) + estimate_tokens(suffix),
+        'items_kept': {key: len(items) for key, items in kept.items()},
+        'items_trimmed': {key: len(ranked[key]) - len(kept[key]) for key in ranked}
+    }
+    return budgeted, prompt_stats
+
+class PromptSizeStats:
+    """Running totals of rendered prompt sizes for /api/metrics"""
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._count = 0
+        self._total_tokens = 0
+        self._max_tokens = 0
+        self._over_budget = 0
+        self._items_trimmed = 0
+    
+    def record(self, prompt_stats):
+        with self._lock:
+            self._count += 1
+            self._total_tokens += prompt_stats['prompt_tokens']
+            self._max_tokens = max(self._max_tokens, prompt_stats['prompt_tokens'])
+            self._items_trimmed += sum(prompt_stats['items_trimmed'].values())
+            if prompt_stats['prompt_tokens'] > prompt_stats['budget_tokens']:
+                self._over_budget += 1
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'budget_tokens': PROMPT_INPUT_TOKEN_BUDGET,
+                'prompts': self._count,
+                'avg_prompt_tokens': round(self._total_tokens / self._count) if self._count else None,
+                'max_prompt_tokens': self._max_tokens,
+                'over_budget': self._over_budget,
+                'items_trimmed': self._items_trimmed
+            }
+
+prompt_size_stats = PromptSizeStats()
+
+def create_enhanced_analysis_prompt(company, directive, bq_context):
+    """
+    Create comprehensive prompt with mandatory BigQuery data usage
+    Context sections are trimmed to PROMPT_INPUT_TOKEN_BUDGET
+    """
+    budgeted_context, _ = apply_prompt_budget(company, directive, bq_context)
+    prefix, suffix = build_analysis_prompt_parts(company, directive, budgeted_context)
+    return prefix + suffix
+
+# Gemini model configuration
+ANALYSIS_MODEL_NAME = os.environ.get('GEMINI_MODEL_NAME', 'gemini-2.5-pro')
+ANALYSIS_GENERATION_CONFIG = {
+    'temperature': float(os.environ.get('GEMINI_TEMPERATURE', 0.2)),
+    'max_output_tokens': int(os.environ.get('GEMINI_MAX_OUTPUT_TOKENS', 8000)),
+}
+GEMINI_WARMUP_ON_BOOT = os.environ.get('GEMINI_WARMUP_ON_BOOT', 'false').lower() == 'true'
+# 'vertex' calls Gemini; 'fake' uses FakeGenerativeModel for local development
+GEMINI_MODEL_BACKEND = os.environ.get('GEMINI_MODEL_BACKEND', 'vertex').lower()
+PROMPT_CACHE_ENABLED = os.environ.get('PROMPT_CACHE_ENABLED', 'false').lower() == 'true'
+PROMPT_CACHE_TTL_SECONDS = int(os.environ.get('PROMPT_CACHE_TTL_SECONDS', 3600))
+
+# Structured output: Gemini returns the report plus its fields as JSON matching this schema
+STRUCTURED_OUTPUT_ENABLED = os.environ.get('STRUCTURED_OUTPUT_ENABLED', 'false').lower() == 'true'
+STRUCTURED_TEXT_FIELDS = [
+    'industry', 'location', 'employees', 'revenue', 'auditor_status', 'win_themes', 'key_personnel',
+    'engagement_strategy', 'gtm_immediate', 'gtm_short_term', 'gtm_mid_term', 'gtm_long_term',
+    'recommended_solutions'
+]
+ANALYSIS_RESPONSE_SCHEMA = {
+    'type': 'object',
+    'properties': dict(
+        {
+            'report_markdown': {'type': 'string', 'description': 'The full report in the RESPONSE FORMAT above'},
+            'prospect_level': {'type': 'string', 'enum': ['High', 'Medium', 'Low']},
+            'prospect_score': {'type': 'integer', 'description': '0-100'},
+        },
+        **{field: {'type': 'string'} for field in STRUCTURED_TEXT_FIELDS}
+    ),
+    'required': ['report_markdown', 'prospect_level', 'prospect_score'] + STRUCTURED_TEXT_FIELDS
+}
+STRUCTURED_OUTPUT_NOTE = """
+**OUTPUT:** Return a JSON object matching the response schema. Put the complete report, formatted exactly as the RESPONSE FORMAT above, in report_markdown, and copy each value (prospect level and score, industry, location, employees, revenue, auditor status, win themes, key personnel, engagement strategy, the four GTM phases and recommended solutions) into its field.
+"""
+
+def analysis_generation_config(structured=None):
+    """generate_content config; with structured output on, asks for JSON matching ANALYSIS_RESPONSE_SCHEMA"""
+    structured = STRUCTURED_OUTPUT_ENABLED if structured is None else structured
+    if not structured:
+        return ANALYSIS_GENERATION_CONFIG
+    return GenerationConfig(
+        response_mime_type='application/json',
+        response_schema=ANALYSIS_RESPONSE_SCHEMA,
+        **ANALYSIS_GENERATION_CONFIG
+    )
+
+def _generation_config_key(structured):
+    # Plain-data form of analysis_generation_config() for response cache keys
+    if not structured:
+        return ANALYSIS_GENERATION_CONFIG
+    return dict(ANALYSIS_GENERATION_CONFIG, response_mime_type='application/json', response_schema=ANALYSIS_RESPONSE_SCHEMA)
+
+def split_structured_response(response_text):
+    """
+    (markdown report, structured fields) from a structured-output response
+    Anything that is not a JSON object with report_markdown comes back as
+    (response_text, None) so the regex parser handles it
+    """
+    try:
+        payload = json.loads(response_text)
+    except (TypeError, ValueError):
+        return response_text, None
+    if not isinstance(payload, dict) or not isinstance(payload.get('report_markdown'), str):
+        return response_text, None
+    return payload['report_markdown'], payload
+
+def apply_structured_fields(structured_data, fields):
+    """Overwrite regex results with valid schema values; returns the names taken from the schema"""
+    taken = set()
+    level = fields.get('prospect_level')
+    if isinstance(level, str) and level.strip().capitalize() in ('High', 'Medium', 'Low'):
+        structured_data['prospect_level'] = level.strip().capitalize()
+        taken.add('prospect_level')
+    
+    score = fields.get('prospect_score')
+    if isinstance(score, str) and score.strip().isdigit():
+        score = int(score.strip())
+    if isinstance(score, (int, float)) and not isinstance(score, bool) and 0 <= score <= 100:
+        structured_data['prospect_score'] = int(score)
+        taken.add('prospect_score')
+    
+    for field in STRUCTURED_TEXT_FIELDS:
+        value = fields.get(field)
+        if isinstance(value, str) and value.strip():
+            value = value.strip()
+            structured_data[field] = _normalize_auditor_status(value) if field == 'auditor_status' else value
+            taken.add(field)
+    return taken
+
+class FieldExtractionStats:
+    """Per-field extraction outcome counts: from the schema, recovered by regex, or left at the default"""
+    
+    FIELDS = ['prospect_level', 'prospect_score'] + STRUCTURED_TEXT_FIELDS
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._reports = 0
+        self._structured_reports = 0
+        self._counts = {field: Counter() for field in self.FIELDS}
+    
+    def record(self, schema_fields, regex_fields, structured):
+        with self._lock:
+            self._reports += 1
+            if structured:
+                self._structured_reports += 1
+            for field in self.FIELDS:
+                if field in schema_fields:
+                    self._counts[field]['schema'] += 1
+                elif field in regex_fields:
+                    self._counts[field]['regex'] += 1
+                else:
+                    self._counts[field]['default'] += 1
+    
+    def stats(self):
+        with self._lock:
+            reports = self._reports
+            return {
+                'structured_output_enabled': STRUCTURED_OUTPUT_ENABLED,
+                'reports': reports,
+                'structured_reports': self._structured_reports,
+                'fields': {
+                    field: {
+                        'schema': counts['schema'],
+                        'regex': counts['regex'],
+                        'default': counts['default'],
+                        'success_rate': round((counts['schema'] + counts['regex']) / reports, 4) if reports else None
+                    }
+                    for field, counts in self._counts.items()
+                }
+            }
+
+field_extraction_stats = FieldExtractionStats()
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeCachedContent:
+    """Local stand-in for vertexai caching.CachedContent"""
+    
+    def __init__(self, model_name, system_instruction):
+        self.name = f"fake-cache-{hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()[:12]}"
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+
+class FakeGenerativeModel:
+    """
+    Offline stand-in for GenerativeModel (GEMINI_MODEL_BACKEND=fake)
+    Returns a deterministic report in the expected section format and logs
+    every request in FakeGenerativeModel.requests, so prompt assembly and
+    prefix caching can be checked without calling Vertex AI
+    """
+    
+    requests = deque(maxlen=1000)
+    
+    def __init__(self, model_name, system_instruction=None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction
+    
+    @classmethod
+    def from_cached_content(cls, cached_content, **kwargs):
+        return cls(cached_content.model_name, system_instruction=cached_content.system_instruction)
+    
+    def generate_content(self, contents, generation_config=None, stream=False, **kwargs):
+        FakeGenerativeModel.requests.append({
+            'model_name': self.model_name,
+            'system_instruction': self.system_instruction,
+            'contents': contents,
+            'generation_config': generation_config
+        })
+        text = self._report(contents if isinstance(contents, str) else str(contents))
+        config = generation_config.to_dict() if hasattr(generation_config, 'to_dict') else (generation_config or {})
+        if config.get('response_mime_type') == 'application/json':
+            fields = parse_structured_data(text)
+            text = json.dumps(dict({field: str(fields[field]) for field in STRUCTURED_TEXT_FIELDS},
+                                   report_markdown=text, prospect_level=fields['prospect_level'],
+                                   prospect_score=fields['prospect_score']))
+        if stream:
+            return (_FakeResponse(text[i:i + 200]) for i in range(0, len(text), 200))
+        return _FakeResponse(text)
+    
+    @staticmethod
+    def _report(prompt):
+        company_match = re.search(r'COMPANY TO ANALYZE: ([^\n]+)', prompt)
+        company = company_match.group(1).strip() if company_match else 'Unknown'
+        score = 40 + int(hashlib.sha256(company.encode('utf-8')).hexdigest(), 16) % 60
+        level = 'High' if score >= 75 else 'Medium' if score >= 50 else 'Low'
+        return f"""## 1. COMPANY OVERVIEW
+- Company: {company}
+- Industry: Unknown - needs manual research
+- Location: Unknown - needs manual research
+- Employees: Unknown - needs manual research
+
+## 2. FINANCIAL HEALTH
+- Revenue: Unknown - needs manual research
+
+## 3. PROSPECT ANALYSIS
+
+**Prospect Level:** {level}
+**Prospect Score:** {score}
+
+**Auditor Status:** Unknown - needs manual research
+
+## 4. WIN THEMES
+1. Offline test response for {company}
+
+## 5. RECOMMENDED SOLUTIONS
+1. **Offline test product**
+
+## 6. KEY PERSONNEL
+- **Executive Sponsor (CEO/C-Suite):** Unknown
+
+## 7. ENGAGEMENT STRATEGY
+**Based on Sales Play: Standard Enterprise**
+
+## 8. GO-TO-MARKET ACTION PLAN
+
+### Immediate Actions (Week 1-2)
+1. Offline test action
+
+### Short-term Actions (Month 1)
+1. Offline test action
+
+### Mid-term Actions (Months 2-3)
+1. Offline test action
+
+### Long-term Actions (Months 4-6)
+1. Offline test action
+"""
+
+def _model_class():
+    return FakeGenerativeModel if GEMINI_MODEL_BACKEND == 'fake' else GenerativeModel
+
+class ModelRegistry:
+    """
+    Process-wide GenerativeModel instances, built once per model name and
+    shared by all request and batch threads (the underlying gRPC client is
+    thread-safe). warm_up() refreshes credentials, registers the cached prompt
+    prefix and sends a tiny probe so a cold instance does not charge channel
+    setup to the first real analysis
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._models = {}
+        self._warmup = {'status': 'not_started', 'seconds': None, 'error': None}
+    
+    def get(self, model_name):
+        with self._lock:
+            model = self._models.get(model_name)
+            if model is None:
+                model = _model_class()(model_name)
+                self._models[model_name] = model
+                print(f"✓ Created GenerativeModel: {model_name}")
+            return model
+    
+    def warm_up(self, model_names):
+        started = time.time()
+        with self._lock:
+            self._warmup['status'] = 'running'
+        try:
+            if GEMINI_MODEL_BACKEND != 'fake':
+                credentials, _ = google.auth.default(scopes=['https://www.googleapis.com/auth/cloud-platform'])
+                credentials.refresh(google_requests.Request())
+            for model_name in model_names:
+                model = self.get(model_name)
+                if PROMPT_CACHE_ENABLED:
+                    prompt_prefix_cache.model_for(model_name, ANALYSIS_INSTRUCTIONS)
+                vertex_rate_limiter.call(
+                    lambda: model.generate_content('ping', generation_config={'max_output_tokens': 1}),
+                    16
+                )
+            status, error = 'completed', None
+            print(f"✓ Gemini warm-up complete in {time.time() - started:.2f}s")
+        except Exception as e:
+            status, error = 'failed', str(e)
+            print(f"⚠ Gemini warm-up failed: {str(e)}")
+        with self._lock:
+            self._warmup = {'status': status, 'seconds': round(time.time() - started, 2), 'error': error}
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'backend': GEMINI_MODEL_BACKEND,
+                'models': sorted(self._models),
+                'warmup': dict(self._warmup)
+            }
+
+model_registry = ModelRegistry()
+
+class PromptPrefixCache:
+    """
+    Registers the static ANALYSIS_INSTRUCTIONS prefix as Vertex AI cached
+    content so each call only sends the per-company suffix
+    model_for() returns None whenever caching is unavailable (prefix below the
+    minimum cacheable size, API errors, ...) and callers send the full prompt
+    Only one thread creates (or refreshes) a given prefix, outside the lock;
+    during a refresh other threads keep using the still-valid entry, and
+    without one they wait for the create to finish
+    """
+    
+    def __init__(self, ttl_seconds, retry_seconds=600):
+        self._ttl_seconds = ttl_seconds
+        self._retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._creating = {}
+        self._disabled_until = 0
+        self._prefix_hashes = set()
+        self._hits = 0
+        self._creates = 0
+        self._failures = 0
+        self._fallbacks = 0
+        self._last_error = None
+    
+    def model_for(self, model_name, prefix):
+        """GenerativeModel bound to the cached prefix, or None to fall back"""
+        digest = hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+        with self._lock:
+            self._prefix_hashes.add(digest)
+            if time.time() < self._disabled_until:
+                self._fallbacks += 1
+                return None
+            
+            key = (model_name, digest)
+            model, expires_at = self._entries.get(key, (None, 0))
+            # Recreate slightly before expiry so calls never race the server TTL
+            if model is not None and expires_at - 60 > time.time():
+                self._hits += 1
+                return model
+            in_flight = self._creating.get(key)
+            if in_flight is not None and model is not None and expires_at > time.time():
+                # Another thread is refreshing; the current entry is still valid
+                self._hits += 1
+                return model
+            if in_flight is None:
+                in_flight = self._creating[key] = threading.Event()
+                creator = True
+            else:
+                creator = False
+        
+        if not creator:
+            in_flight.wait(timeout=120)
+            with self._lock:
+                model, expires_at = self._entries.get(key, (None, 0))
+                if model is None or expires_at <= time.time():
+                    self._fallbacks += 1
+                    return None
+                self._hits += 1
+                return model
+        
+        try:
+            if GEMINI_MODEL_BACKEND == 'fake':
+                cached = FakeCachedContent(model_name, prefix)
+            else:
+                cached = caching.CachedContent.create(
+                    model_name=model_name,
+                    system_instruction=prefix,
+                    ttl=timedelta(seconds=self._ttl_seconds)
+                )
+            # Bind the model once per cached prefix and share it across threads
+            model = _model_class().from_cached_content(cached_content=cached)
+        except Exception as e:
+            with self._lock:
+                self._failures += 1
+                self._fallbacks += 1
+                self._last_error = str(e)
+                self._disabled_until = time.time() + self._retry_seconds
+                del self._creating[key]
+            in_flight.set()
+            print(f"⚠ Prompt prefix caching unavailable, sending full prompts: {str(e)}")
+            return None
+        
+        with self._lock:
+            self._entries[key] = (model, time.time() + self._ttl_seconds)
+            self._creates += 1
+            del self._creating[key]
+        in_flight.set()
+        print(f"✓ Registered cached prompt prefix for {model_name}")
+        return model
+    
+    def invalidate(self, model_name, prefix, error):
+        """Drop a cached prefix that failed at generation time"""
+        digest = hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+        with self._lock:
+            self._entries.pop((model_name, digest), None)
+            self._failures += 1
+            self._fallbacks += 1
+            self._last_error = str(error)
+            self._disabled_until = time.time() + self._retry_seconds
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'enabled': PROMPT_CACHE_ENABLED,
+                'distinct_prefixes': len(self._prefix_hashes),
+                'hits': self._hits,
+                'creates': self._creates,
+                'failures': self._failures,
+                'fallbacks': self._fallbacks,
+                'last_error': self._last_error
+            }
+
+prompt_prefix_cache = PromptPrefixCache(PROMPT_CACHE_TTL_SECONDS)
+
+# Persistent Gemini response cache
+LLM_CACHE_PATH = os.environ.get('LLM_CACHE_PATH', '/tmp/gtm_llm_cache.db')
+LLM_CACHE_TTL_SECONDS = int(os.environ.get('LLM_CACHE_TTL_SECONDS', 7 * 24 * 3600))
+LLM_CACHE_MAX_BYTES = int(os.environ.get('LLM_CACHE_MAX_BYTES', 200 * 1024 * 1024))
+
+class LLMResponseCache:
+    """
+    On-disk (SQLite) cache of analysis reports with TTL expiry and
+    least-recently-used eviction once LLM_CACHE_MAX_BYTES is exceeded
+    Keys come from llm_cache_key(): same company, directive, rendered
+    context, instructions, model and generation config -> same report
+    """
+    
+    def __init__(self, path, ttl_seconds, max_bytes):
+        self._path = path
+        self._ttl_seconds = ttl_seconds
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = None
+        self._hits = 0
+        self._misses = 0
+        self._writes = 0
+        self._evictions = 0
+        if not path:
+            return
+        try:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS llm_responses (
+                    cache_key TEXT PRIMARY KEY,
+                    company TEXT,
+                    directive TEXT,
+                    model_name TEXT,
+                    response_text TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_accessed REAL NOT NULL
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS llm_responses_lru ON llm_responses (last_accessed)")
+            self._conn.commit()
+            print(f"✓ LLM response cache: {path}")
+        except Exception as e:
+            print(f"⚠ Warning: Could not open LLM response cache {path}: {str(e)}")
+            self._conn = None
+    
+    def get(self, cache_key):
+        """Cached report text, or None if missing or expired"""
+        if self._conn is None:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response_text, created_at FROM llm_responses WHERE cache_key = ?", (cache_key,)
+            ).fetchone()
+            if row is None or now - row[1] > self._ttl_seconds:
+                if row is not None:
+                    self._conn.execute("DELETE FROM llm_responses WHERE cache_key = ?", (cache_key,))
+                    self._conn.commit()
+                self._misses += 1
+                return None
+            self._conn.execute("UPDATE llm_responses SET last_accessed = ? WHERE cache_key = ?", (now, cache_key))
+            self._conn.commit()
+            self._hits += 1
+            return row[0]
+    
+    def put(self, cache_key, response_text, company='', directive='', model_name=''):
+        if self._conn is None or not response_text:
+            return
+        now = time.time()
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO llm_responses "
+                    "(cache_key, company, directive, model_name, response_text, size_bytes, created_at, last_accessed) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (cache_key, company, directive, model_name, response_text,
+                     len(response_text.encode('utf-8')), now, now)
+                )
+                self._writes += 1
+                self._evict(now)
+                self._conn.commit()
+        except Exception as e:
+            print(f"⚠ Could not write LLM response cache: {str(e)}")
+    
+    def _evict(self, now):
+        cursor = self._conn.execute("DELETE FROM llm_responses WHERE created_at < ?", (now - self._ttl_seconds,))
+        self._evictions += cursor.rowcount
+        total = self._conn.execute("SELECT COALESCE(SUM(size_bytes), 0) FROM llm_responses").fetchone()[0]
+        if total <= self._max_bytes:
+            return
+        for cache_key, size_bytes in self._conn.execute(
+            "SELECT cache_key, size_bytes FROM llm_responses ORDER BY last_accessed"
+        ).fetchall():
+            if total <= self._max_bytes:
+                break
+            self._conn.execute("DELETE FROM llm_responses WHERE cache_key = ?", (cache_key,))
+            total -= size_bytes
+            self._evictions += 1
+    
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            entries, size = (None, None)
+            if self._conn is not None:
+                entries, size = self._conn.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM llm_responses"
+                ).fetchone()
+            return {
+                'enabled': self._conn is not None,
+                'entries': entries,
+                'size_bytes': size,
+                'max_bytes': self._max_bytes,
+                'ttl_seconds': self._ttl_seconds,
+                'hits': self._hits,
+                'misses': self._misses,
+                'writes': self._writes,
+                'evictions': self._evictions,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else None
+            }
+
+llm_response_cache = LLMResponseCache(LLM_CACHE_PATH, LLM_CACHE_TTL_SECONDS, LLM_CACHE_MAX_BYTES)
+
+def llm_cache_key(company, directive, budgeted_context, model_name, generation_config, instructions=None):
+    """Response cache key: normalized company + directive + context fingerprint + model settings"""
+    key_material = json.dumps({
+        'company': normalize_company_name(company),
+        'directive': ' '.join(directive.lower().split()),
+        'instructions': hashlib.sha256((instructions or ANALYSIS_INSTRUCTIONS).encode('utf-8')).hexdigest(),
+        'context': hashlib.sha256(render_context_block(budgeted_context).encode('utf-8')).hexdigest(),
+        'model': model_name,
+        'generation_config': generation_config
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+# Vertex AI quota limits shared by every Gemini call in this process
+BATCH_MAX_WORKERS = max(1, int(os.environ.get('BATCH_MAX_WORKERS', 4)))
+VERTEX_REQUESTS_PER_MINUTE = int(os.environ.get('VERTEX_REQUESTS_PER_MINUTE', 60))
+VERTEX_TOKENS_PER_MINUTE = int(os.environ.get('VERTEX_TOKENS_PER_MINUTE', 500000))
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get('RATE_LIMIT_MAX_RETRIES', 5))
+# Stream full batch analyses so each row's score/level is published as soon as section 3 closes
+BATCH_STREAMING = os.environ.get('BATCH_STREAMING', 'false').lower() == 'true'
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute
+    acquire() blocks until the requested amount is available; requests larger
+    than the bucket are clamped to its capacity so they cannot wait forever
+    """
+    
+    def __init__(self, rate_per_minute):
+        self.capacity = float(rate_per_minute)
+        self.rate_per_minute = float(rate_per_minute)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate_per_minute / 60.0)
+        self._updated = now
+    
+    def set_rate(self, rate_per_minute):
+        with self._lock:
+            self._refill()
+            self.rate_per_minute = max(1.0, min(self.capacity, float(rate_per_minute)))
+    
+    def try_acquire(self, amount=1):
+        """Take amount tokens only if they are available right now"""
+        amount = min(float(amount), self.capacity)
+        with self._lock:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return True
+            return False
+    
+    def refund(self, amount=1):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + min(float(amount), self.capacity))
+    
+    def acquire(self, amount=1):
+        """Take amount tokens, sleeping as needed; returns seconds waited"""
+        amount = min(float(amount), self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= amount:
+                    self._tokens -= amount
+                    return waited
+                delay = (amount - self._tokens) * 60.0 / self.rate_per_minute
+            delay = min(delay, 5.0)
+            time.sleep(delay)
+            waited += delay
+
+def _is_rate_limit_error(error):
+    if isinstance(error, (ResourceExhausted, TooManyRequests)):
+        return True
+    message = str(error).lower()
+    return '429' in message or 'resource exhausted' in message or 'quota' in message
+
+class VertexRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limiter for Gemini calls
+    Each call reserves one request plus its estimated prompt and output tokens.
+    A 429/resource-exhausted response halves the request rate and pauses all
+    callers with exponential, jittered backoff; successes restore the rate
+    step by step (AIMD) so we settle just under the effective quota
+    """
+    
+    def __init__(self, requests_per_minute, tokens_per_minute, max_retries=5,
+                 base_backoff_seconds=2.0, max_backoff_seconds=60.0):
+        self._requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self._tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self._max_rpm = float(requests_per_minute)
+        self._current_rpm = float(requests_per_minute)
+        self._max_retries = max_retries
+        self._base_backoff = base_backoff_seconds
+        self._max_backoff = max_backoff_seconds
+        self._lock = threading.Lock()
+        self._paused_until = 0.0
+        self._consecutive_throttles = 0
+        self._calls = 0
+        self._throttled = 0
+        self._retries = 0
+        self._wait_seconds = 0.0
+        self._tokens_reserved = 0
+    
+    def _acquire(self, estimated_tokens):
+        waited = 0.0
+        with self._lock:
+            pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            time.sleep(pause)
+            waited += pause
+        if self._requests is not None:
+            waited += self._requests.acquire(1)
+        if self._tokens is not None:
+            waited += self._tokens.acquire(estimated_tokens)
+        with self._lock:
+            self._calls += 1
+            self._wait_seconds += waited
+            self._tokens_reserved += estimated_tokens
+    
+    def try_acquire(self, estimated_tokens):
+        """Reserve capacity for an optional extra call without waiting (used for hedges)"""
+        with self._lock:
+            if self._paused_until > time.monotonic():
+                return False
+        if self._requests is not None and not self._requests.try_acquire(1):
+            return False
+        if self._tokens is not None and not self._tokens.try_acquire(estimated_tokens):
+            if self._requests is not None:
+                self._requests.refund(1)
+            return False
+        with self._lock:
+            self._calls += 1
+            self._tokens_reserved += estimated_tokens
+        return True
+    
+    def _record_success(self):
+        with self._lock:
+            self._consecutive_throttles = 0
+            if self._requests is not None and self._current_rpm < self._max_rpm:
+                self._current_rpm = min(self._max_rpm, self._current_rpm + max(1.0, self._max_rpm / 20))
+                self._requests.set_rate(self._current_rpm)
+    
+    def _record_throttle(self):
+        with self._lock:
+            self._throttled += 1
+            self._consecutive_throttles += 1
+            # Concurrent calls throttled by the same burst only cut the rate once
+            if self._requests is not None and time.monotonic() >= self._paused_until:
+                self._current_rpm = max(1.0, self._current_rpm / 2)
+                self._requests.set_rate(self._current_rpm)
+            backoff = min(self._max_backoff, self._base_backoff * (2 ** (self._consecutive_throttles - 1)))
+            backoff *= 0.5 + random.random()
+            self._paused_until = max(self._paused_until, time.monotonic() + backoff)
+            return backoff
+    
+    def call(self, fn, estimated_tokens):
+        """Run fn() under the limits, retrying rate-limit errors with backoff"""
+        for attempt in range(self._max_retries + 1):
+            self._acquire(estimated_tokens)
+            try:
+                result = fn()
+            except Exception as e:
+                if not _is_rate_limit_error(e) or attempt == self._max_retries:
+                    raise
+                backoff = self._record_throttle()
+                with self._lock:
+                    self._retries += 1
+                print(f"⚠ Vertex AI rate limited, backing off {backoff:.1f}s (attempt {attempt + 1}): {str(e)}")
+                continue
+            self._record_success()
+            return result
+    
+    def stats(self):
+        with self._lock:
+            return {
+                'requests_per_minute_limit': self._max_rpm,
+                'requests_per_minute_current': self._current_rpm,
+                'tokens_per_minute_limit': self._tokens.capacity if self._tokens is not None else 0,
+                'calls': self._calls,
+                'throttled': self._throttled,
+                'retries': self._retries,
+                'wait_seconds': round(self._wait_seconds, 2),
+                'tokens_reserved': self._tokens_reserved,
+                'paused': self._paused_until > time.monotonic()
+            }
+
+vertex_rate_limiter = VertexRateLimiter(
+    VERTEX_REQUESTS_PER_MINUTE, VERTEX_TOKENS_PER_MINUTE, max_retries=RATE_LIMIT_MAX_RETRIES
+)
+
+# Deadlines, retries and hedging for blocking Gemini calls
+GEMINI_CALL_TIMEOUT_SECONDS = float(os.environ.get('GEMINI_CALL_TIMEOUT_SECONDS', 120))
+GEMINI_CALL_MAX_RETRIES = int(os.environ.get('GEMINI_CALL_MAX_RETRIES', 1))
+GEMINI_HEDGE_ENABLED = os.environ.get('GEMINI_HEDGE_ENABLED', 'false').lower() == 'true'
+# Fixed hedge delay in seconds; 0 uses the observed p95 latency
+GEMINI_HEDGE_DELAY_SECONDS = float(os.environ.get('GEMINI_HEDGE_DELAY_SECONDS', 0))
+GEMINI_CALL_POOL_SIZE = int(os.environ.get('GEMINI_CALL_POOL_SIZE', 32))
+# Extra pool threads for abandoned attempts that are still running
+GEMINI_CALL_MAX_ABANDONED = int(os.environ.get('GEMINI_CALL_MAX_ABANDONED', 32))
+# A streamed response that sends no chunk for this long is aborted
+GEMINI_STREAM_IDLE_TIMEOUT_SECONDS = float(os.environ.get('GEMINI_STREAM_IDLE_TIMEOUT_SECONDS', 60))
+
+TRANSIENT_GEMINI_ERRORS = (
+    ServiceUnavailable, InternalServerError, DeadlineExceeded, GatewayTimeout, Aborted,
+    TimeoutError, ConnectionError
+)
+
+def _is_transient_error(error):
+    return isinstance(error, TRANSIENT_GEMINI_ERRORS)
+
+class GeminiCallPolicy:
+    """
+    Per-call deadline, jittered retries and optional hedging for generate_content
+    Each attempt runs on a shared pool and is abandoned once the deadline
+    passes. With hedging on, a second identical request is sent if the first
+    has not answered after the hedge delay (fixed, or the observed p95 once
+    enough samples exist) and there is spare rate-limit capacity; the first
+    success wins. The SDK cannot interrupt a call already in flight, so a
+    timed-out or losing attempt is abandoned: it keeps its pool thread until
+    the SDK returns and its result is dropped (or handed to discard). The pool
+    has max_abandoned threads on top of pool_size for these, abandoned
+    attempts still running are reported as abandoned_in_flight, and no hedges
+    are sent while that headroom is used up
+    """
+    
+    def __init__(self, timeout_seconds, max_retries, hedge_enabled, hedge_delay_seconds,
+                 pool_size=32, max_abandoned=32, min_samples=20, base_backoff_seconds=1.0, max_backoff_seconds=20.0):
+        self._timeout = timeout_seconds
+        self._max_retries = max_retries
+        self._hedge_enabled = hedge_enabled
+        self._hedge_delay = hedge_delay_seconds
+        self._min_samples = min_samples
+        self._base_backoff = base_backoff_seconds
+        self._max_backoff = max_backoff_seconds
+        self._max_abandoned = max_abandoned
+        self._executor = ThreadPoolExecutor(max_workers=pool_size + max_abandoned, thread_name_prefix='gemini-call')
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=500)
+        self._counters = Counter()
+        self._abandoned = set()
+    
+    def _count(self, key, amount=1):
+        with self._lock:
+            self._counters[key] += amount
+    
+    def _percentile(self, fraction):
+        with self._lock:
+            samples = sorted(self._latencies)
+        if not samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+    
+    def hedge_delay(self):
+        """Seconds to wait before hedging, or None when hedging is off or not yet calibrated"""
+        if not self._hedge_enabled:
+            return None
+        if self._hedge_delay > 0:
+            return self._hedge_delay
+        with self._lock:
+            if len(self._latencies) < self._min_samples:
+                return None
+        return self._percentile(0.95)
+    
+    def _run(self, generate):
+        started = time.monotonic()
+        self._count('attempts')
+        return generate(), time.monotonic() - started
+    
+    def _abandon(self, future, discard=None):
+        # cancel() only stops an attempt that has not started yet
+        if future.cancel():
+            return
+        with self._lock:
+            self._abandoned.add(future)
+            self._counters['abandoned'] += 1
+        
+        def release(finished):
+            with self._lock:
+                self._abandoned.discard(finished)
+            if discard is not None and not finished.cancelled() and finished.exception() is None:
+                try:
+                    discard(finished.result())
+                except Exception as e:
+                    print(f"⚠ Could not release abandoned Gemini call: {str(e)}")
+        future.add_done_callback(release)
+    
+    def abandoned_in_flight(self):
+        with self._lock:
+            return len(self._abandoned)
+    
+    def _attempt(self, generate, estimated_tokens, discard=None):
+        deadline = time.monotonic() + self._timeout
+        # Attempts return (result, elapsed); discard only wants the result
+        release = (lambda attempt: discard(attempt[0])) if discard is not None else None
+        primary = self._executor.submit(self._run, generate)
+        pending = {primary}
+        hedge = None
+        error = None
+        
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is not None and hedge_delay < self._timeout:
+            done, _ = wait(pending, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+            if not done:
+                if self.abandoned_in_flight() >= self._max_abandoned:
+                    self._count('hedges_skipped')
+                elif vertex_rate_limiter.try_acquire(estimated_tokens):
+                    hedge = self._executor.submit(self._run, generate)
+                    pending.add(hedge)
+                    self._count('hedges')
+                else:
+                    self._count('hedges_skipped')
+        
+        while pending:
+            remaining = deadline - time.monotonic()
+            done, pending = wait(pending, timeout=max(0, remaining), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            winner = None
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                    self._count('errors')
+                elif winner is None:
+                    winner = future
+                elif release is not None:
+                    # Both attempts answered at once; release the spare result
+                    release(future.result())
+            if winner is not None:
+                result, elapsed = winner.result()
+                for loser in pending:
+                    self._abandon(loser, release)
+                with self._lock:
+                    self._latencies.append(elapsed)
+                    if winner is hedge:
+                        self._counters['hedge_wins'] += 1
+                return result
+        
+        if pending or error is None:
+            for future in pending:
+                self._abandon(future, release)
+            self._count('timeouts')
+            raise TimeoutError(f"Gemini call exceeded {self._timeout:.0f}s deadline")
+        raise error
+    
+    def generate(self, generate, estimated_tokens, discard=None):
+        """
+        Run generate() under the deadline/retry/hedge policy and rate limiter
+        discard(result) is called for results of abandoned attempts that
+        complete anyway, e.g. to close a response stream nobody will read
+        """
+        for attempt in range(self._max_retries + 1):
+            try:
+                return vertex_rate_limiter.call(lambda: self._attempt(generate, estimated_tokens, discard), estimated_tokens)
+            except Exception as e:
+                if not _is_transient_error(e) or attempt == self._max_retries:
+                    raise
+                backoff = min(self._max_backoff, self._base_backoff * (2 ** attempt)) * (0.5 + random.random())
+                self._count('retries')
+                print(f"⚠ Transient Gemini error, retrying in {backoff:.1f}s: {str(e)}")
+                time.sleep(backoff)
+    
+    def iter_stream(self, responses, idle_timeout, close=None):
+        """
+        Yield the rest of a response stream, aborting it when no chunk arrives
+        for idle_timeout seconds. Each chunk is awaited on the call pool, so a
+        stalled stream raises TimeoutError instead of hanging the caller;
+        close(responses) stops the stream once its pending read returns
+        """
+        end = object()
+        while True:
+            future = self._executor.submit(next, responses, end)
+            try:
+                chunk = future.result(timeout=idle_timeout)
+            except FutureTimeoutError:
+                self._abandon(future, (lambda _: close(responses)) if close is not None else None)
+                self._count('stream_idle_timeouts')
+                raise TimeoutError(f"Gemini stream sent nothing for {idle_timeout:.0f}s")
+            if chunk is end:
+                return
+            yield chunk
+    
+    def stats(self):
+        p50 = self._percentile(0.5)
+        p95 = self._percentile(0.95)
+        hedge_delay = self.hedge_delay()
+        with self._lock:
+            return {
+                'timeout_seconds': self._timeout,
+                'max_retries': self._max_retries,
+                'hedge_enabled': self._hedge_enabled,
+                'hedge_delay_seconds': round(hedge_delay, 2) if hedge_delay is not None else None,
+                'attempts': self._counters['attempts'],
+                'retries': self._counters['retries'],
+                'errors': self._counters['errors'],
+                'timeouts': self._counters['timeouts'],
+                'stream_idle_timeouts': self._counters['stream_idle_timeouts'],
+                'hedges': self._counters['hedges'],
+                'hedges_skipped': self._counters['hedges_skipped'],
+                'hedge_wins': self._counters['hedge_wins'],
+                'abandoned': self._counters['abandoned'],
+                'abandoned_in_flight': len(self._abandoned),
+                'max_abandoned': self._max_abandoned,
+                'latency_p50_seconds': round(p50, 2) if p50 is not None else None,
+                'latency_p95_seconds': round(p95, 2) if p95 is not None else None
+            }
+
+gemini_call_policy = GeminiCallPolicy(
+    GEMINI_CALL_TIMEOUT_SECONDS, GEMINI_CALL_MAX_RETRIES, GEMINI_HEDGE_ENABLED,
+    GEMINI_HEDGE_DELAY_SECONDS, pool_size=GEMINI_CALL_POOL_SIZE, max_abandoned=GEMINI_CALL_MAX_ABANDONED
+)
+
+# Warm up in the background so boot is not held up by Vertex AI
+if GEMINI_WARMUP_ON_BOOT and (PROJECT_ID or GEMINI_MODEL_BACKEND == 'fake'):
+    threading.Thread(target=model_registry.warm_up, args=([ANALYSIS_MODEL_NAME],), daemon=True).start()
+
+def generate_analysis_text(company, directive, bq_context, use_cache=True):
+    """
+    Run the analysis prompt through Gemini
+    The context is trimmed to PROMPT_INPUT_TOKEN_BUDGET first and the
+    response cache is consulted before calling the model. With
+    PROMPT_CACHE_ENABLED the instruction prefix is served from cached
+    content; otherwise (or on any caching error) the full prompt is sent
+    With STRUCTURED_OUTPUT_ENABLED Gemini returns JSON (ANALYSIS_RESPONSE_SCHEMA);
+    the markdown report is returned and the parsed fields are put in
+    generation_info['structured_fields'] (None when the JSON is unusable)
+    Returns (report text, generation info with prompt_stats and cache_hit)
+    """
+    budgeted_context, prompt_stats = apply_prompt_budget(company, directive, bq_context)
+    prompt_size_stats.record(prompt_stats)
+    generation_info = {'prompt_stats': prompt_stats, 'cache_hit': False, 'model': ANALYSIS_MODEL_NAME, 'structured_fields': None}
+    structured = STRUCTURED_OUTPUT_ENABLED
+    generation_config = analysis_generation_config(structured)
+    
+    cache_key = llm_cache_key(company, directive, budgeted_context, ANALYSIS_MODEL_NAME, _generation_config_key(structured))
+    if use_cache:
+        cached_text = llm_response_cache.get(cache_key)
+        if cached_text is not None:
+            print(f"✓ LLM response cache hit: {company}")
+            generation_info['cache_hit'] = True
+            if structured:
+                cached_text, generation_info['structured_fields'] = split_structured_response(cached_text)
+            return cached_text, generation_info
+    
+    prefix, suffix = build_analysis_prompt_parts(company, directive, budgeted_context)
+    if structured:
+        suffix += STRUCTURED_OUTPUT_NOTE
+    analysis_text = None
+    # TPM quotas count input and output tokens
+    estimated_tokens = prompt_stats['prompt_tokens'] + ANALYSIS_GENERATION_CONFIG.get('max_output_tokens', 0)
+    
+    if PROMPT_CACHE_ENABLED:
+        model = prompt_prefix_cache.model_for(ANALYSIS_MODEL_NAME, prefix)
+        if model is not None:
+            try:
+                analysis_text = gemini_call_policy.generate(
+                    lambda: model.generate_content(suffix, generation_config=generation_config).text,
+                    estimated_tokens
+                )
+            except Exception as e:
+                if _is_rate_limit_error(e) or _is_transient_error(e):
+                    raise
+                print(f"⚠ Cached-prefix generation failed, retrying with full prompt: {str(e)}")
+                prompt_prefix_cache.invalidate(ANALYSIS_MODEL_NAME, prefix, e)
+    
+    if analysis_text is None:
+        model = model_registry.get(ANALYSIS_MODEL_NAME)
+        analysis_text = gemini_call_policy.generate(
+            lambda: model.generate_content(prefix + suffix, generation_config=generation_config).text,
+            estimated_tokens
+        )
+    
+    llm_response_cache.put(cache_key, analysis_text, company, directive, ANALYSIS_MODEL_NAME)
+    if structured:
+        analysis_text, generation_info['structured_fields'] = split_structured_response(analysis_text)
+    return analysis_text, generation_info
+
+def _chunk_text(chunk):
+    # Stream chunks without candidates (safety/usage-only) raise on .text
+    try:
+        return chunk.text or ''
+    except (ValueError, AttributeError):
+        return ''
+
+def _close_stream(responses):
+    if hasattr(responses, 'close'):
+        try:
+            responses.close()
+        except Exception:
+            pass
+
+def _open_stream(model, contents, estimated_tokens):
+    """
+    Start a streamed generation; the first chunk is fetched through
+    gemini_call_policy, so it gets the per-call deadline, transient-error
+    retries and the rate limiter. Streams opened by abandoned attempts are closed
+    """
+    def start():
+        responses = iter(model.generate_content(contents, generation_config=ANALYSIS_GENERATION_CONFIG, stream=True))
+        return next(responses, None), responses
+    return gemini_call_policy.generate(start, estimated_tokens, discard=lambda opened: _close_stream(opened[1]))
+
+def stream_analysis_text(company, directive, bq_context, use_cache=True):
+    """
+    Streaming counterpart of generate_analysis_text
+    Returns (iterator of report text chunks, generation info). A response
+    cache hit is replayed as a single chunk; a completed stream is stored in
+    the response cache like a blocking call
+    """
+    budgeted_context, prompt_stats = apply_prompt_budget(company, directive, bq_context)
+    prompt_size_stats.record(prompt_stats)
+    generation_info = {'prompt_stats': prompt_stats, 'cache_hit': False, 'model': ANALYSIS_MODEL_NAME, 'structured_fields': None}
+    
+    cache_key = llm_cache_key(company, directive, budgeted_context, ANALYSIS_MODEL_NAME, ANALYSIS_GENERATION_CONFIG)
+    if use_cache:
+        cached_text = llm_response_cache.get(cache_key)
+        if cached_text is not None:
+            print(f"✓ LLM response cache hit: {company}")
+            generation_info['cache_hit'] = True
+            return iter([cached_text]), generation_info
+    
+    prefix, suffix = build_analysis_prompt_parts(company, directive, budgeted_context)
+    estimated_tokens = prompt_stats['prompt_tokens'] + ANALYSIS_GENERATION_CONFIG.get('max_output_tokens', 0)
+    
+    def chunks():
+        opened = None
+        if PROMPT_CACHE_ENABLED:
+            model = prompt_prefix_cache.model_for(ANALYSIS_MODEL_NAME, prefix)
+            if model is not None:
+                try:
+                    opened = _open_stream(model, suffix, estimated_tokens)
+                except Exception as e:
+                    if _is_rate_limit_error(e) or _is_transient_error(e):
+                        raise
+                    print(f"⚠ Cached-prefix generation failed, retrying with full prompt: {str(e)}")
+                    prompt_prefix_cache.invalidate(ANALYSIS_MODEL_NAME, prefix, e)
+        
+        if opened is None:
+            opened = _open_stream(model_registry.get(ANALYSIS_MODEL_NAME), prefix + suffix, estimated_tokens)
+        
+        first, rest = opened
+        parts = []
+        finished = False
+        try:
+            if first is not None:
+                parts.append(_chunk_text(first))
+                yield parts[-1]
+            for chunk in gemini_call_policy.iter_stream(rest, GEMINI_STREAM_IDLE_TIMEOUT_SECONDS, close=_close_stream):
+                text = _chunk_text(chunk)
+                if text:
+                    parts.append(text)
+                    yield text
+            finished = True
+        finally:
+            # A consumer that stops early closes us; cancel the response stream
+            # so the model stops generating (and billing) the rest of the report
+            if not finished:
+                _close_stream(rest)
+        
+        llm_response_cache.put(cache_key, ''.join(parts), company, directive, ANALYSIS_MODEL_NAME)
+    
+    return chunks(), generation_info
+
+def stream_report_fields(company, directive, bq_context, on_fields=None, stop_after=None, use_cache=True):
+    """
+    Stream a report through an IncrementalReportParser
+    on_fields(fields) is called with each batch of newly settled fields. With
+    stop_after (section numbers, e.g. ('3',)) generation is abandoned as soon
+    as those sections have closed and the partial report is not cached.
+    Returns (report text, parser, generation info); generation_info['stopped_early']
+    tells whether the text is partial
+    """
+    chunks, generation_info = stream_analysis_text(company, directive, bq_context, use_cache=use_cache)
+    parser = IncrementalReportParser()
+    generation_info['stopped_early'] = False
+    try:
+        for text in chunks:
+            fields = parser.feed(text)
+            if fields and on_fields:
+                on_fields(fields)
+            if stop_after and parser.sections_closed(stop_after):
+                generation_info['stopped_early'] = True
+                break
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    return parser.text, parser, generation_info
+
+# Two-stage batch triage: a fast model scores every company, only the best get the full report
+TRIAGE_MODEL_NAME = os.environ.get('TRIAGE_MODEL_NAME', 'gemini-2.5-flash')
+TRIAGE_GENERATION_CONFIG = {
+    'temperature': 0.0,
+    # 2.5 models count thinking tokens against this limit
+    'max_output_tokens': int(os.environ.get('TRIAGE_MAX_OUTPUT_TOKENS', 1024)),
+}
+TRIAGE_MIN_SCORE = int(os.environ.get('TRIAGE_MIN_SCORE', 70))
+TRIAGE_MAX_ITEMS = int(os.environ.get('TRIAGE_MAX_ITEMS', 3))
+# 'model': score with the compact prompt on TRIAGE_MODEL_NAME; 'stream': stream the
+# full report prompt on the analysis model and stop once section 3 has closed
+TRIAGE_STRATEGY = os.environ.get('TRIAGE_STRATEGY', 'model').lower()
+TRIAGE_STOP_SECTIONS = ('1', '2', '3')
+
+TRIAGE_INSTRUCTIONS = """You are screening companies as sales prospects before a full analysis.
+Each request gives you a COMPANY TO ANALYZE, an ANALYSIS DIRECTIVE and INTERNAL DATA FROM YOUR COMPANY SYSTEMS. Score the company against the directive with the same weights as the full analysis:
+- Strategic Fit: 30
+- Market Readiness: 25
+- Financial Capacity: 20
+- Competitive Position: 15
+- Urgency/Timing: 10
+
+Give higher scores if we have relevant products with strong competitive advantages, high-converting campaigns for the company's industry, or an existing customer relationship to expand. Do not write a report.
+
+Respond with exactly these three lines:
+**Prospect Level:** High/Medium/Low
+**Prospect Score:** [0-100 numeric value]
+**Rationale:** [one sentence]
+"""
+
+def triage_context(bq_context):
+    """Customer record plus the top TRIAGE_MAX_ITEMS of each context section"""
+    ranked = rank_context_items(bq_context)
+    return dict(bq_context, **{key: items[:TRIAGE_MAX_ITEMS] for key, items in ranked.items()})
+
+def build_triage_prompt(company, directive, compact):
+    """Compact scoring-only prompt for the triage stage"""
+    return TRIAGE_INSTRUCTIONS + f"""
+COMPANY TO ANALYZE: {company}
+ANALYSIS DIRECTIVE: {directive}
+
+{_format_customer_section(compact)}
+
+=== INTERNAL DATA FROM YOUR COMPANY SYSTEMS ===
+{_format_items_section('RELEVANT PRODUCTS FROM OUR CATALOG', compact['relevant_products'], _format_product)}
+{_format_items_section('RELEVANT MARKETING CAMPAIGNS', compact['relevant_campaigns'], _format_campaign)}
+{_format_items_section('RELEVANT SALES PLAYS', compact['relevant_sales_plays'], _format_sales_play)}
+==================================================="""
+
+def generate_triage_score(company, directive, bq_context, use_cache=True):
+    """
+    First-stage score from TRIAGE_MODEL_NAME
+    Returns a dict with score (int, or None if unparseable), level, rationale
+    and the raw response text
+    """
+    compact = triage_context(bq_context)
+    prompt = build_triage_prompt(company, directive, compact)
+    cache_key = llm_cache_key(
+        company, directive, compact, TRIAGE_MODEL_NAME, TRIAGE_GENERATION_CONFIG, instructions=TRIAGE_INSTRUCTIONS
+    )
+    
+    text = llm_response_cache.get(cache_key) if use_cache else None
+    if text is None:
+        model = model_registry.get(TRIAGE_MODEL_NAME)
+        text = gemini_call_policy.generate(
+            lambda: model.generate_content(prompt, generation_config=TRIAGE_GENERATION_CONFIG).text,
+            estimate_tokens(prompt) + TRIAGE_GENERATION_CONFIG['max_output_tokens']
+        )
+        llm_response_cache.put(cache_key, text, company, directive, TRIAGE_MODEL_NAME)
+    
+    score_match = re.search(r'Prospect\s+Score\*?\*?[:\s]*\*?\*?\s*(\d+)', text, re.IGNORECASE)
+    level_match = re.search(r'Prospect\s+Level\*?\*?[:\s]*\*?\*?\s*(High|Medium|Low)', text, re.IGNORECASE)
+    rationale_match = re.search(r'Rationale\*?\*?[:\s]*\*?\*?\s*([^\n]+)', text, re.IGNORECASE)
+    return {
+        'score': min(100, int(score_match.group(1))) if score_match else None,
+        'level': level_match.group(1).capitalize() if level_match else 'Unknown',
+        'rationale': rationale_match.group(1).strip() if rationale_match else '',
+        'text': text
+    }
+
+def stream_triage_score(company, directive, bq_context):
+    """
+    First-stage score read from the start of a streamed full report
+    Generation stops once sections 1-3 have closed, so only the overview and
+    prospect analysis are paid for. Returns a generate_triage_score dict
+    plus the model used and whether generation was stopped early
+    """
+    text, parser, generation_info = stream_report_fields(company, directive, bq_context, stop_after=TRIAGE_STOP_SECTIONS)
+    data = parser.finish()
+    score = data['prospect_score']
+    level = data['prospect_level'].capitalize()
+    return {
+        'score': min(100, score) if isinstance(score, int) else None,
+        'level': level if level in ('High', 'Medium', 'Low') else 'Unknown',
+        'rationale': '',
+        'text': text,
+        'model': ANALYSIS_MODEL_NAME,
+        'stopped_early': generation_info['stopped_early']
+    }
+
+def select_for_full_analysis(triaged, min_score=None, top_n=None):
+    """
+    Rows promoted to the full analysis: score >= min_score, then the best
+    top_n of those by score. triaged is a list of dicts with a 'score' key
+    """
+    scored = [row for row in triaged if isinstance(row.get('score'), int)]
+    if min_score is not None:
+        scored = [row for row in scored if row['score'] >= min_score]
+    scored.sort(key=lambda row: row['score'], reverse=True)
+    return scored[:top_n] if top_n else scored
+
+# [Previous Flask routes: /login, /auth/google, /logout remain the same]
+# [Copy lines 61-241 from main_session_auth.py]
+
+@app.route('/login')
+def login():
+    """Login page with Google Sign-In"""
+    if 'user_email' in session:
+        return redirect('/')
+    
+    login_html = '''
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <title>Login - Strategic GTM Agent</title>
+        <script src="https://accounts.google.com/gsi/client" async defer></script>
+        <style>
+            * { margin: 0; padding: 0; box-sizing: border-box; }
+            body {
+                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', sans-serif;
+                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+                min-height: 100vh;
+                display: flex;
+                align-items: center;
+                justify-content: center;
+                padding: 20px;
+            }
+            .login-card {
+                background: white;
+                border-radius: 20px;
+                box-shadow: 0 20px 60px rgba(0,0,0,0.3);
+                padding: 60px 40px;
+                max-width: 440px;
+                width: 100%;
                 text-align: center;
             }
             .logo {
@@ -626,205 +2763,598 @@ def logout():
     session.clear()
     return redirect('/login')
 
-def parse_structured_data(analysis_text):
-    """Parse structured data from analysis with enhanced extraction"""
-    data = {
-        'prospect_level': 'Medium',
-        'prospect_score': 'Unknown',
-        'industry': 'Unknown - needs manual research',
-        'location': 'Unknown - needs manual research',
-        'employees': 'Unknown - needs manual research',
-        'revenue': 'Unknown - needs manual research',
-        'auditor_status': 'Unknown - needs manual research',
-        'win_themes': 'Unknown - needs manual research',
-        'key_personnel': 'Unknown - needs manual research',
-        'engagement_strategy': 'Unknown - needs manual research',
-        'gtm_immediate': 'Unknown - needs manual research',
-        'gtm_short_term': 'Unknown - needs manual research',
-        'gtm_mid_term': 'Unknown - needs manual research',
-        'gtm_long_term': 'Unknown - needs manual research',
-        'recommended_solutions': 'Unknown - needs manual research'
-    }
-    
-    # Extract from Company Overview section
-    overview_match = re.search(r'## 1\. COMPANY OVERVIEW(.*?)(?=## \d+\.)', analysis_text, re.DOTALL | re.IGNORECASE)
-    if overview_match:
-        overview_text = overview_match.group(1)
-        
-        industry_match = re.search(r'Industry[:\s]*\*?\*?([^\n]+)', overview_text, re.IGNORECASE)
-        if industry_match:
-            data['industry'] = industry_match.group(1).strip().replace('*', '')
-        
-        location_match = re.search(r'Location[:\s]*\*?\*?([^\n]+)', overview_text, re.IGNORECASE)
-        if location_match:
-            data['location'] = location_match.group(1).strip().replace('*', '')
-        
-        employees_match = re.search(r'Employees[:\s]*\*?\*?([^\n]+)', overview_text, re.IGNORECASE)
-        if employees_match:
-            data['employees'] = employees_match.group(1).strip().replace('*', '')
-    
-    # Extract from Financial Health section
-    financial_match = re.search(r'## 2\. FINANCIAL HEALTH(.*?)(?=## \d+\.)', analysis_text, re.DOTALL | re.IGNORECASE)
-    if financial_match:
-        financial_text = financial_match.group(1)
-        revenue_match = re.search(r'Revenue[:\s]*\*?\*?([^\n]+)', financial_text, re.IGNORECASE)
+# Report parsing: precompiled patterns, applied to section slices found in one scan
+_SECTION_BOUNDARY = re.compile(r'## (\d+)\.')
+_SECTION_HEADERS = {
+    '1': re.compile(r'## 1\. COMPANY OVERVIEW', re.IGNORECASE),
+    '2': re.compile(r'## 2\. FINANCIAL HEALTH', re.IGNORECASE),
+    '3': re.compile(r'## 3\. PROSPECT ANALYSIS', re.IGNORECASE),
+    '4': re.compile(r'## 4\. WIN THEMES', re.IGNORECASE),
+    '5': re.compile(r'## 5\. RECOMMENDED SOLUTIONS', re.IGNORECASE),
+    '6': re.compile(r'## 6\. KEY PERSONNEL', re.IGNORECASE),
+    '7': re.compile(r'## 7\. ENGAGEMENT STRATEGY', re.IGNORECASE),
+    '8': re.compile(r'## 8\. GO-TO-MARKET ACTION PLAN', re.IGNORECASE),
+}
+# Sections 1-3 are only read when another numbered section follows them
+_SECTIONS_NEED_SUCCESSOR = {'1', '2', '3'}
+_GTM_SUBSECTIONS = [
+    ('gtm_immediate', re.compile(r'### Immediate Actions', re.IGNORECASE)),
+    ('gtm_short_term', re.compile(r'### Short-term Actions', re.IGNORECASE)),
+    ('gtm_mid_term', re.compile(r'### Mid-term Actions', re.IGNORECASE)),
+    ('gtm_long_term', re.compile(r'### Long-term Actions', re.IGNORECASE)),
+]
+_OVERVIEW_FIELDS = [
+    ('industry', re.compile(r'Industry[:\s]*\*?\*?([^\n]+)', re.IGNORECASE)),
+    ('location', re.compile(r'Location[:\s]*\*?\*?([^\n]+)', re.IGNORECASE)),
+    ('employees', re.compile(r'Employees[:\s]*\*?\*?([^\n]+)', re.IGNORECASE)),
+]
+_REVENUE_PATTERN = re.compile(r'Revenue[:\s]*\*?\*?([^\n]+)', re.IGNORECASE)
+_LEVEL_PATTERNS = [
+    re.compile(r'\*?\*?Prospect\s+Level\*?\*?[:\s]*\*?\*?\s*([A-Za-z]+)', re.IGNORECASE),
+    re.compile(r'Prospect\s+Level[:\s]+([A-Za-z]+)', re.IGNORECASE),
+    re.compile(r'Level[:\s]*\*?\*?\s*(High|Medium|Low)', re.IGNORECASE),
+]
+_SCORE_PATTERNS = [
+    re.compile(r'\*?\*?Prospect\s+Score\*?\*?[:\s]*\*?\*?\s*(\d+)', re.IGNORECASE),
+    re.compile(r'Prospect\s+Score[:\s]+(\d+)', re.IGNORECASE),
+    re.compile(r'Score[:\s]*\*?\*?\s*(\d+)/100', re.IGNORECASE),
+    re.compile(r'Score[:\s]*\*?\*?\s*(\d+)\s*/\s*100', re.IGNORECASE),
+]
+_AUDITOR_PATTERN = re.compile(r'\*?\*?Auditor Status\*?\*?[:\s]*([^\n]+)', re.IGNORECASE)
+
+def _text_end(text):
+    # Where a non-MULTILINE '$' first matches: before a single trailing newline
+    return len(text) - 1 if text.endswith('\n') else len(text)
+
+def _section_spans(analysis_text):
+    # {section number: (body start, body end, closed)}; a section is closed once
+    # a later '## N.' marker bounds it, so its body can no longer change
+    boundaries = [(match.start(), match.group(1)) for match in _SECTION_BOUNDARY.finditer(analysis_text)]
+    text_end = _text_end(analysis_text)
+    spans = {}
+    for position, (start, number) in enumerate(boundaries):
+        header = _SECTION_HEADERS.get(number)
+        if header is None or number in spans:
+            continue
+        header_match = header.match(analysis_text, start)
+        if not header_match:
+            continue
+        body_start = header_match.end()
+        following = next((b for b, _ in boundaries[position + 1:] if b >= body_start), None)
+        if following is None:
+            if number in _SECTIONS_NEED_SUCCESSOR:
+                continue
+            following = text_end if text_end >= body_start else len(analysis_text)
+            spans[number] = (body_start, following, False)
+        else:
+            spans[number] = (body_start, following, True)
+    return spans
+
+def split_report_sections(analysis_text):
+    """
+    Slice the report into its numbered '## N.' sections in one scan
+    Returns {section number: body}, where a body runs from the end of the
+    first matching header to the next '## N.' marker (or the end of the text
+    for sections 4-8), matching what the per-section regexes used to capture
+    """
+    return {number: analysis_text[start:end] for number, (start, end, _) in _section_spans(analysis_text).items()}
+
+def _normalize_auditor_status(status):
+    if 'CHECK' in status or 'DESC' in status or '⚠' in status:
+        return '⚠️ CHECK DESC'
+    elif 'Other' in status or '✓' in status:
+        return '✓ Other Auditor'
+    return status
+
+def _parse_gtm_subsections(gtm_text, data, extracted):
+    text_end = _text_end(gtm_text)
+    for field, header in _GTM_SUBSECTIONS:
+        header_match = header.search(gtm_text)
+        if not header_match:
+            continue
+        newline = gtm_text.find('\n', header_match.end())
+        if newline == -1:
+            continue
+        body_start = newline + 1
+        body_end = gtm_text.find('###', body_start)
+        if body_end == -1 or body_end > text_end:
+            body_end = text_end if text_end >= body_start else len(gtm_text)
+        data[field] = gtm_text[body_start:body_end].strip()
+        extracted.add(field)
+
+_STRUCTURED_DEFAULTS = {
+    'prospect_level': 'Medium',
+    'prospect_score': 'Unknown',
+    'industry': 'Unknown - needs manual research',
+    'location': 'Unknown - needs manual research',
+    'employees': 'Unknown - needs manual research',
+    'revenue': 'Unknown - needs manual research',
+    'auditor_status': 'Unknown - needs manual research',
+    'win_themes': 'Unknown - needs manual research',
+    'key_personnel': 'Unknown - needs manual research',
+    'engagement_strategy': 'Unknown - needs manual research',
+    'gtm_immediate': 'Unknown - needs manual research',
+    'gtm_short_term': 'Unknown - needs manual research',
+    'gtm_mid_term': 'Unknown - needs manual research',
+    'gtm_long_term': 'Unknown - needs manual research',
+    'recommended_solutions': 'Unknown - needs manual research'
+}
+_SECTION_TEXT_FIELDS = {'4': 'win_themes', '5': 'recommended_solutions', '6': 'key_personnel', '7': 'engagement_strategy'}
+
+def _extract_section_fields(number, body, data, extracted):
+    # Fields that come from a single section body; the full-text fallbacks for
+    # level, score and auditor status are applied by the callers
+    if number == '1':
+        # Company Overview
+        for field, pattern in _OVERVIEW_FIELDS:
+            field_match = pattern.search(body)
+            if field_match:
+                data[field] = field_match.group(1).strip().replace('*', '')
+                extracted.add(field)
+    elif number == '2':
+        # Financial Health
+        revenue_match = _REVENUE_PATTERN.search(body)
         if revenue_match:
             data['revenue'] = revenue_match.group(1).strip().replace('*', '')
-    
-    # Extract from Prospect Analysis section
-    prospect_match = re.search(r'## 3\. PROSPECT ANALYSIS(.*?)(?=## \d+\.)', analysis_text, re.DOTALL | re.IGNORECASE)
-    if prospect_match:
-        prospect_text = prospect_match.group(1)
-        
-        level_patterns = [
-            r'\*?\*?Prospect\s+Level\*?\*?[:\s]*\*?\*?\s*([A-Za-z]+)',
-            r'Prospect\s+Level[:\s]+([A-Za-z]+)',
-            r'Level[:\s]*\*?\*?\s*(High|Medium|Low)',
-        ]
-        
-        for pattern in level_patterns:
-            level_match = re.search(pattern, prospect_text, re.IGNORECASE)
+            extracted.add('revenue')
+    elif number == '3':
+        # Prospect Analysis
+        for pattern in _LEVEL_PATTERNS:
+            level_match = pattern.search(body)
             if level_match:
                 data['prospect_level'] = level_match.group(1).strip()
+                extracted.add('prospect_level')
                 break
         
-        score_patterns = [
-            r'\*?\*?Prospect\s+Score\*?\*?[:\s]*\*?\*?\s*(\d+)',
-            r'Prospect\s+Score[:\s]+(\d+)',
-            r'Score[:\s]*\*?\*?\s*(\d+)/100',
-            r'Score[:\s]*\*?\*?\s*(\d+)\s*/\s*100',
-        ]
-        
-        for pattern in score_patterns:
-            score_match = re.search(pattern, prospect_text, re.IGNORECASE)
+        for pattern in _SCORE_PATTERNS:
+            score_match = pattern.search(body)
             if score_match:
-                try:
-                    data['prospect_score'] = int(score_match.group(1))
-                    break
-                except:
-                    pass
+                data['prospect_score'] = int(score_match.group(1))
+                extracted.add('prospect_score')
+                break
+    elif number in _SECTION_TEXT_FIELDS:
+        data[_SECTION_TEXT_FIELDS[number]] = body.strip()
+        extracted.add(_SECTION_TEXT_FIELDS[number])
+    elif number == '8':
+        _parse_gtm_subsections(body, data, extracted)
+
+def parse_structured_data(analysis_text, extracted=None):
+    """
+    Parse structured data from analysis with enhanced extraction
+    Names of fields actually found in the text are added to extracted (a set)
+    """
+    extracted = set() if extracted is None else extracted
+    data = dict(_STRUCTURED_DEFAULTS)
+    
+    sections = split_report_sections(analysis_text)
+    
+    for number, body in sections.items():
+        _extract_section_fields(number, body, data, extracted)
     
-    # Fallback extractions
+    # Fallback extractions (search stops at the first hit, normally in section 3)
     if data['prospect_level'] == 'Medium':
-        level_patterns = [r'\*?\*?Prospect\s+Level\*?\*?[:\s]*\*?\*?\s*([A-Za-z]+)']
-        for pattern in level_patterns:
-            level_match = re.search(pattern, analysis_text, re.IGNORECASE)
-            if level_match:
-                data['prospect_level'] = level_match.group(1).strip()
-                break
+        level_match = _LEVEL_PATTERNS[0].search(analysis_text)
+        if level_match:
+            data['prospect_level'] = level_match.group(1).strip()
+            extracted.add('prospect_level')
     
     if data['prospect_score'] == 'Unknown':
-        score_patterns = [r'\*?\*?Prospect\s+Score\*?\*?[:\s]*\*?\*?\s*(\d+)']
-        for pattern in score_patterns:
-            score_match = re.search(pattern, analysis_text, re.IGNORECASE)
-            if score_match:
-                try:
-                    data['prospect_score'] = int(score_match.group(1))
-                    break
-                except:
-                    pass
+        score_match = _SCORE_PATTERNS[0].search(analysis_text)
+        if score_match:
+            data['prospect_score'] = int(score_match.group(1))
+            extracted.add('prospect_score')
     
     # Extract Auditor Status
-    auditor_match = re.search(r'\*?\*?Auditor Status\*?\*?[:\s]*([^\n]+)', analysis_text, re.IGNORECASE)
+    auditor_match = _AUDITOR_PATTERN.search(analysis_text)
     if auditor_match:
-        status = auditor_match.group(1).strip()
-        if 'CHECK' in status or 'DESC' in status or '⚠' in status:
-            data['auditor_status'] = '⚠️ CHECK DESC'
-        elif 'Other' in status or '✓' in status:
-            data['auditor_status'] = '✓ Other Auditor'
-        else:
-            data['auditor_status'] = status
+        data['auditor_status'] = _normalize_auditor_status(auditor_match.group(1).strip())
+        extracted.add('auditor_status')
     
-    # Extract sections
-    win_themes_match = re.search(r'## 4\. WIN THEMES(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
-    if win_themes_match:
-        data['win_themes'] = win_themes_match.group(1).strip()
-    
-    personnel_match = re.search(r'## 6\. KEY PERSONNEL(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
-    if personnel_match:
-        data['key_personnel'] = personnel_match.group(1).strip()
-    
-    engagement_match = re.search(r'## 7\. ENGAGEMENT STRATEGY(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
-    if engagement_match:
-        data['engagement_strategy'] = engagement_match.group(1).strip()
+    return data
+
+def _settled_match(pattern, text):
+    # First match of pattern that more streamed text can no longer change,
+    # i.e. one that is already followed by another character
+    match = pattern.search(text)
+    return match if match and match.end() < len(text) else None
+
+class IncrementalReportParser:
+    """
+    Extract parse_structured_data fields while a report is still streaming
+    feed() returns the fields settled by the new chunk: a section's fields are
+    emitted once the next '## N.' marker closes it, and the level/score
+    fallbacks and auditor status once their first match is complete. These are
+    provisional; finish() parses the whole text and is authoritative
+    """
+    def __init__(self):
+        self.text = ''
+        self.fields = {}
+        self.closed = set()
+        self._pending = {'auditor_status'}
     
-    gtm_match = re.search(r'## 8\. GO-TO-MARKET ACTION PLAN(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
-    if gtm_match:
-        gtm_text = gtm_match.group(1)
-        
-        immediate_match = re.search(r'### Immediate Actions.*?\n(.*?)(?=###|$)', gtm_text, re.DOTALL | re.IGNORECASE)
-        if immediate_match:
-            data['gtm_immediate'] = immediate_match.group(1).strip()
+    def feed(self, chunk):
+        if not chunk:
+            return {}
+        # A new boundary can only start in the new chunk or just before it
+        scan_from = max(0, len(self.text) - 16)
+        self.text += chunk
+        data, extracted = {}, set()
         
-        short_match = re.search(r'### Short-term Actions.*?\n(.*?)(?=###|$)', gtm_text, re.DOTALL | re.IGNORECASE)
-        if short_match:
-            data['gtm_short_term'] = short_match.group(1).strip()
+        if _SECTION_BOUNDARY.search(self.text, scan_from):
+            for number, (start, end, closed) in _section_spans(self.text).items():
+                if closed and number not in self.closed:
+                    self.closed.add(number)
+                    _extract_section_fields(number, self.text[start:end], data, extracted)
+                    if number == '3':
+                        # parse_structured_data falls back to the full text for these
+                        if data.get('prospect_level', 'Medium') == 'Medium':
+                            self._pending.add('prospect_level')
+                        if 'prospect_score' not in extracted:
+                            self._pending.add('prospect_score')
         
-        mid_match = re.search(r'### Mid-term Actions.*?\n(.*?)(?=###|$)', gtm_text, re.DOTALL | re.IGNORECASE)
-        if mid_match:
-            data['gtm_mid_term'] = mid_match.group(1).strip()
+        if self._pending:
+            self._settle_pending(data, extracted)
         
-        long_match = re.search(r'### Long-term Actions.*?\n(.*?)(?=###|$)', gtm_text, re.DOTALL | re.IGNORECASE)
-        if long_match:
-            data['gtm_long_term'] = long_match.group(1).strip()
+        new_fields = {field: data[field] for field in extracted}
+        self.fields.update(new_fields)
+        return new_fields
     
-    solutions_match = re.search(r'## 5\. RECOMMENDED SOLUTIONS(.*?)(?=## \d+\.|$)', analysis_text, re.DOTALL | re.IGNORECASE)
-    if solutions_match:
-        data['recommended_solutions'] = solutions_match.group(1).strip()
+    def _settle_pending(self, data, extracted):
+        if 'prospect_level' in self._pending:
+            level_match = _settled_match(_LEVEL_PATTERNS[0], self.text)
+            if level_match:
+                data['prospect_level'] = level_match.group(1).strip()
+                extracted.add('prospect_level')
+                self._pending.discard('prospect_level')
+        if 'prospect_score' in self._pending:
+            score_match = _settled_match(_SCORE_PATTERNS[0], self.text)
+            if score_match:
+                data['prospect_score'] = int(score_match.group(1))
+                extracted.add('prospect_score')
+                self._pending.discard('prospect_score')
+        if 'auditor_status' in self._pending:
+            auditor_match = _settled_match(_AUDITOR_PATTERN, self.text)
+            if auditor_match:
+                data['auditor_status'] = _normalize_auditor_status(auditor_match.group(1).strip())
+                extracted.add('auditor_status')
+                self._pending.discard('auditor_status')
     
-    return data
+    def sections_closed(self, numbers):
+        """True once every section in numbers has been closed by a later one"""
+        return self.closed.issuperset(numbers)
+    
+    def finish(self, extracted=None):
+        """Authoritative parse of everything fed so far"""
+        return parse_structured_data(self.text, extracted)
 
-def write_analysis_to_bigquery(analysis_data):
+# Write-back to analysis_complete: rows are queued and streamed in batches by a background thread
+WRITEBACK_BATCH_SIZE = max(1, int(os.environ.get('WRITEBACK_BATCH_SIZE', 50)))
+WRITEBACK_FLUSH_SECONDS = float(os.environ.get('WRITEBACK_FLUSH_SECONDS', 5))
+WRITEBACK_MAX_RETRIES = int(os.environ.get('WRITEBACK_MAX_RETRIES', 3))
+WRITEBACK_SPILL_PATH = os.environ.get('WRITEBACK_SPILL_PATH', '/tmp/gtm_writeback_spill.jsonl')
+WRITEBACK_DRAIN_SECONDS = float(os.environ.get('WRITEBACK_DRAIN_SECONDS', 30))
+
+class AnalysisWriteQueue:
     """
-    Write analysis results to analysis_complete table
+    Buffered, asynchronous insert_rows_json into analysis_complete
+    enqueue() only appends to an in-memory queue. A daemon thread flushes it
+    when batch_size rows are waiting or flush_seconds have passed, retrying
+    failed inserts with jittered backoff; each row carries an insert id so a
+    retried batch is not duplicated. Batches that still fail (or arrive while
+    there is no BigQuery client) are appended to a JSONL spill file and
+    replayed after the next successful flush or restart; rows BigQuery
+    rejects as invalid go to <spill>.rejected instead. close() drains the
+    queue and is registered with atexit
     """
-    if not bigquery_client:
-        print("BigQuery client not available")
-        return False
     
-    try:
+    def __init__(self, batch_size, flush_seconds, max_retries, spill_path, drain_seconds=30,
+                 base_backoff_seconds=1.0, max_backoff_seconds=30.0):
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_retries = max_retries
+        self.spill_path = spill_path
+        self.drain_seconds = drain_seconds
+        self._base_backoff = base_backoff_seconds
+        self._max_backoff = max_backoff_seconds
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._spill_lock = threading.Lock()
+        self._thread = None
+        self._closing = False
+        self._latencies = deque(maxlen=500)
+        self._batch_sizes = deque(maxlen=500)
+        self._counters = Counter()
+    
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='analysis-writeback', daemon=True)
+            self._thread.start()
+    
+    def enqueue(self, row):
+        """Queue one analysis_complete row; returns immediately"""
+        self.start()
+        with self._cond:
+            if self._closing:
+                # Shutting down: nothing will flush this row, keep it on disk
+                self._spill([(str(uuid.uuid4()), row)], 'queue closed')
+                return
+            self._queue.append((str(uuid.uuid4()), row))
+            self._counters['enqueued'] += 1
+            if len(self._queue) >= self.batch_size:
+                self._cond.notify()
+    
+    def _run(self):
+        self._replay_spill()
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_seconds
+                while not self._closing and len(self._queue) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                done = self._closing and not self._queue
+            if batch and self._flush(batch) and self.spill_backlog():
+                self._replay_spill()
+            if done:
+                return
+    
+    def _insert(self, batch):
+        # Returns the insert_rows_json error list; raises if the call itself fails
+        if not bigquery_client:
+            raise RuntimeError('BigQuery client not available')
         table_id = f"{PROJECT_ID}.{DATASET_ID}.analysis_complete"
+        return bigquery_client.insert_rows_json(
+            table_id, [row for _, row in batch], row_ids=[insert_id for insert_id, _ in batch]
+        )
+    
+    def _flush(self, batch):
+        """Insert one batch with retries; returns True when BigQuery accepted the request"""
+        started = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            try:
+                errors = self._insert(batch)
+                break
+            except Exception as e:
+                if attempt == self.max_retries or not bigquery_client:
+                    print(f"✗ Write-back of {len(batch)} rows failed: {str(e)}")
+                    self._spill(batch, str(e))
+                    with self._cond:
+                        self._counters['failed_flushes'] += 1
+                    return False
+                backoff = min(self._max_backoff, self._base_backoff * (2 ** attempt)) * (0.5 + random.random())
+                with self._cond:
+                    self._counters['retries'] += 1
+                print(f"⚠ Write-back failed, retrying in {backoff:.1f}s: {str(e)}")
+                time.sleep(backoff)
         
-        # Prepare row data matching the schema
-        row_data = {
-            'timestamp': datetime.utcnow().isoformat(),
-            'company_name': analysis_data.get('company', ''),
-            'prospect_level': analysis_data.get('prospect_level', 'Unknown'),
-            'prospect_score': analysis_data.get('prospect_score'),
-            'industry': analysis_data.get('industry', 'Unknown'),
-            'location': analysis_data.get('location', 'Unknown'),
-            'employees': analysis_data.get('employees', 'Unknown'),
-            'revenue': analysis_data.get('revenue', 'Unknown'),
-            'auditor_status': analysis_data.get('auditor_status', 'Unknown'),
-            'win_themes': analysis_data.get('win_themes', 'Unknown'),
-            'key_personnel': analysis_data.get('key_personnel', 'Unknown'),
-            'engagement_strategy': analysis_data.get('engagement_strategy', 'Unknown'),
-            'gtm_immediate': analysis_data.get('gtm_immediate', 'Unknown'),
-            'gtm_short_term': analysis_data.get('gtm_short_term', 'Unknown'),
-            'gtm_mid_term': analysis_data.get('gtm_mid_term', 'Unknown'),
-            'gtm_long_term': analysis_data.get('gtm_long_term', 'Unknown'),
-            'recommended_solutions': analysis_data.get('recommended_solutions', 'Unknown'),
-            'analysis_status': 'success',
-            'full_analysis': analysis_data.get('full_analysis', ''),
-            'analyzed_by': session.get('user_email', 'unknown'),
-            'directive': analysis_data.get('directive', '')
-        }
-        
-        # Insert row
-        errors = bigquery_client.insert_rows_json(table_id, [row_data])
-        
-        if errors:
-            print(f"✗ Error writing to BigQuery: {errors}")
-            return False
-        else:
-            print(f"✓ Analysis written to BigQuery for: {analysis_data.get('company')}")
-            return True
+        rejected = {error.get('index') for error in errors or []}
+        if rejected:
+            print(f"✗ BigQuery rejected {len(rejected)} analysis rows: {errors}")
+            self._spill([entry for i, entry in enumerate(batch) if i in rejected], str(errors), rejected=True)
+        with self._cond:
+            self._latencies.append(time.monotonic() - started)
+            self._batch_sizes.append(len(batch))
+            self._counters['flushes'] += 1
+            self._counters['rows_written'] += len(batch) - len(rejected)
+        print(f"✓ Analysis write-back: {len(batch) - len(rejected)} rows written to BigQuery")
+        return True
+    
+    def _spill(self, batch, reason, rejected=False):
+        if not self.spill_path:
+            with self._cond:
+                self._counters['rows_dropped'] += len(batch)
+            print(f"✗ Dropped {len(batch)} analysis rows (no spill file configured)")
+            return
+        path = self.spill_path + '.rejected' if rejected else self.spill_path
+        try:
+            with self._spill_lock, open(path, 'a', encoding='utf-8') as spill_file:
+                for insert_id, row in batch:
+                    spill_file.write(json.dumps({'insert_id': insert_id, 'row': row, 'reason': reason}, default=str) + '\n')
+                spill_file.flush()
+                os.fsync(spill_file.fileno())
+            with self._cond:
+                self._counters['rows_rejected' if rejected else 'rows_spilled'] += len(batch)
+        except OSError as e:
+            with self._cond:
+                self._counters['rows_dropped'] += len(batch)
+            print(f"✗ Could not spill {len(batch)} analysis rows to {path}: {str(e)}")
+    
+    def spill_backlog(self):
+        """Rows waiting in the spill file"""
+        if not self.spill_path:
+            return 0
+        with self._spill_lock:
+            try:
+                with open(self.spill_path, encoding='utf-8') as spill_file:
+                    return sum(1 for line in spill_file if line.strip())
+            except FileNotFoundError:
+                return 0
+    
+    def _replay_spill(self):
+        # Move spilled rows back into the queue; they are re-spilled if delivery fails again
+        if not self.spill_path or not bigquery_client:
+            return
+        with self._spill_lock:
+            try:
+                with open(self.spill_path, encoding='utf-8') as spill_file:
+                    entries = [json.loads(line) for line in spill_file if line.strip()]
+                os.remove(self.spill_path)
+            except FileNotFoundError:
+                return
+            except (OSError, ValueError) as e:
+                print(f"⚠ Could not replay write-back spill file: {str(e)}")
+                return
+        with self._cond:
+            self._queue.extend((entry['insert_id'], entry['row']) for entry in entries)
+            self._counters['rows_replayed'] += len(entries)
+        print(f"✓ Replaying {len(entries)} spilled analysis rows")
+    
+    def close(self):
+        """Flush everything still queued (bounded by drain_seconds); leftovers are spilled"""
+        with self._cond:
+            self._closing = True
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join(self.drain_seconds)
+        with self._cond:
+            leftover = list(self._queue)
+            self._queue.clear()
+        if leftover:
+            self._spill(leftover, 'shutdown before flush')
+    
+    def stats(self):
+        spilled = self.spill_backlog()
+        with self._cond:
+            latencies = sorted(self._latencies)
+            batches = list(self._batch_sizes)
             
-    except Exception as e:
-        print(f"✗ Error in write_analysis_to_bigquery: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return False
+            def percentile_ms(fraction):
+                if not latencies:
+                    return None
+                return round(latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] * 1000, 1)
+            
+            return {
+                'queued': len(self._queue),
+                'spilled_backlog': spilled,
+                'batch_size': self.batch_size,
+                'flush_seconds': self.flush_seconds,
+                'enqueued': self._counters['enqueued'],
+                'rows_written': self._counters['rows_written'],
+                'flushes': self._counters['flushes'],
+                'failed_flushes': self._counters['failed_flushes'],
+                'retries': self._counters['retries'],
+                'rows_spilled': self._counters['rows_spilled'],
+                'rows_replayed': self._counters['rows_replayed'],
+                'rows_rejected': self._counters['rows_rejected'],
+                'rows_dropped': self._counters['rows_dropped'],
+                'avg_batch_rows': round(sum(batches) / len(batches), 1) if batches else None,
+                'flush_latency_p50_ms': percentile_ms(0.5),
+                'flush_latency_p95_ms': percentile_ms(0.95)
+            }
+
+analysis_writer = AnalysisWriteQueue(
+    WRITEBACK_BATCH_SIZE, WRITEBACK_FLUSH_SECONDS, WRITEBACK_MAX_RETRIES, WRITEBACK_SPILL_PATH, WRITEBACK_DRAIN_SECONDS
+)
+atexit.register(analysis_writer.close)
+if WRITEBACK_SPILL_PATH and os.path.exists(WRITEBACK_SPILL_PATH):
+    # Deliver rows spilled by a previous run
+    analysis_writer.start()
+
+def write_analysis_to_bigquery(analysis_data):
+    """
+    Queue analysis results for the analysis_complete table
+    The insert happens in the background (see AnalysisWriteQueue);
+    analyzed_by must be in analysis_data since batch rows have no session
+    """
+    row_data = {
+        'timestamp': datetime.utcnow().isoformat(),
+        'company_name': analysis_data.get('company', ''),
+        'prospect_level': analysis_data.get('prospect_level', 'Unknown'),
+        'prospect_score': analysis_data.get('prospect_score'),
+        'industry': analysis_data.get('industry', 'Unknown'),
+        'location': analysis_data.get('location', 'Unknown'),
+        'employees': analysis_data.get('employees', 'Unknown'),
+        'revenue': analysis_data.get('revenue', 'Unknown'),
+        'auditor_status': analysis_data.get('auditor_status', 'Unknown'),
+        'win_themes': analysis_data.get('win_themes', 'Unknown'),
+        'key_personnel': analysis_data.get('key_personnel', 'Unknown'),
+        'engagement_strategy': analysis_data.get('engagement_strategy', 'Unknown'),
+        'gtm_immediate': analysis_data.get('gtm_immediate', 'Unknown'),
+        'gtm_short_term': analysis_data.get('gtm_short_term', 'Unknown'),
+        'gtm_mid_term': analysis_data.get('gtm_mid_term', 'Unknown'),
+        'gtm_long_term': analysis_data.get('gtm_long_term', 'Unknown'),
+        'recommended_solutions': analysis_data.get('recommended_solutions', 'Unknown'),
+        'analysis_status': 'success',
+        'full_analysis': analysis_data.get('full_analysis', ''),
+        'analyzed_by': analysis_data.get('analyzed_by') or 'unknown',
+        'directive': analysis_data.get('directive', '')
+    }
+    analysis_writer.enqueue(row_data)
+    return True
+
+def record_analysis(company, directive, analysis_text, bq_context, structured_fields=None, analyzed_by='unknown'):
+    """
+    Parse a finished report, merge the customer match and queue it for analysis_complete
+    structured_fields (from structured output) take precedence over the regex parse
+    """
+    # Parse structured data
+    regex_fields = set()
+    structured_data = parse_structured_data(analysis_text, regex_fields)
+    schema_fields = apply_structured_fields(structured_data, structured_fields) if structured_fields else set()
+    field_extraction_stats.record(schema_fields, regex_fields, structured_fields is not None)
+    
+    # Add customer match info
+    if bq_context['customer_match']:
+        structured_data['customer_match'] = bq_context['customer_match']
+        structured_data['existing_customer'] = True
+        structured_data.update(bq_context['customer_data'])
+    else:
+        structured_data['existing_customer'] = False
+    
+    # Write to BigQuery analysis_complete table
+    analysis_record = {
+        'company': company,
+        'directive': directive,
+        'prospect_level': structured_data.get('prospect_level', 'Unknown'),
+        'prospect_score': structured_data.get('prospect_score', 0),
+        'industry': structured_data.get('industry', 'Unknown'),
+        'location': structured_data.get('location', 'Unknown'),
+        'employees': structured_data.get('employees', 'Unknown'),
+        'revenue': structured_data.get('revenue', 'Unknown'),
+        'auditor_status': structured_data.get('auditor_status', 'Unknown'),
+        'win_themes': structured_data.get('win_themes', 'Unknown'),
+        'key_personnel': structured_data.get('key_personnel', 'Unknown'),
+        'engagement_strategy': structured_data.get('engagement_strategy', 'Unknown'),
+        'gtm_immediate': structured_data.get('gtm_immediate', 'Unknown'),
+        'gtm_short_term': structured_data.get('gtm_short_term', 'Unknown'),
+        'gtm_mid_term': structured_data.get('gtm_mid_term', 'Unknown'),
+        'gtm_long_term': structured_data.get('gtm_long_term', 'Unknown'),
+        'recommended_solutions': structured_data.get('recommended_solutions', 'Unknown'),
+        'full_analysis': analysis_text,
+        'analyzed_by': analyzed_by
+    }
+    write_analysis_to_bigquery(analysis_record)
+    
+    return structured_data
+
+def summarize_context(bq_context):
+    """BigQuery context summary returned alongside an analysis"""
+    return {
+        'customer_match': bq_context['customer_match'],
+        'match_confidence': bq_context.get('match_confidence', 0.0),
+        'products_found': len(bq_context['relevant_products']),
+        'campaigns_found': len(bq_context['relevant_campaigns']),
+        'sales_plays_found': len(bq_context['relevant_sales_plays'])
+    }
+
+def build_analysis_response(company, directive, analysis_text, structured_data, bq_context, generation_info):
+    """Response body shared by /api/analyze and the final /api/analyze-stream event"""
+    return {
+        'success': True,
+        'company': company,
+        'directive': directive,
+        'prospectLevel': structured_data['prospect_level'],
+        'score': structured_data['prospect_score'],
+        'auditorStatus': structured_data['auditor_status'],
+        'industry': structured_data.get('industry', 'Unknown'),
+        'location': structured_data.get('location', 'Unknown'),
+        'employees': structured_data.get('employees', 'Unknown'),
+        'analysis': analysis_text,
+        'structured_data': structured_data,
+        'bigquery_context': summarize_context(bq_context),
+        'prompt_stats': generation_info['prompt_stats'],
+        'cache_hit': generation_info['cache_hit'],
+        'structured_output': generation_info.get('structured_fields') is not None,
+        'source': 'vertex-ai-gemini-enhanced'
+    }
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
 
 @app.route('/')
 @login_required
@@ -843,6 +3373,26 @@ def user_info():
         'picture': session.get('user_picture')
     })
 
+@app.route('/api/metrics', methods=['GET'])
+@login_required
+def metrics():
+    """Runtime cache statistics"""
+    return jsonify({
+        'success': True,
+        'reference_cache': reference_cache.stats(),
+        'company_aliases': company_alias_store.stats(),
+        'prompt_cache': prompt_prefix_cache.stats(),
+        'prompt_size': prompt_size_stats.stats(),
+        'llm_response_cache': llm_response_cache.stats(),
+        'vertex_rate_limiter': vertex_rate_limiter.stats(),
+        'models': model_registry.stats(),
+        'gemini_calls': gemini_call_policy.stats(),
+        'field_extraction': field_extraction_stats.stats(),
+        'analysis_writeback': analysis_writer.stats(),
+        'batch_job_store': batch_job_store.stats(),
+        'batch_events': batch_events.stats()
+    })
+
 @app.route('/api/analyze', methods=['POST'])
 @login_required
 def analyze():
@@ -863,80 +3413,27 @@ def analyze():
         # Get BigQuery context with fuzzy matching
         bq_context = get_bigquery_context(company)
         
-        # Create enhanced prompt
-        prompt = create_enhanced_analysis_prompt(company, directive, bq_context)
-        
-        # Call Vertex AI (Gemini)
-        model = GenerativeModel('gemini-2.5-pro')
-        response = model.generate_content(
-            prompt,
-            generation_config={
-                'temperature': 0.2,
-                'max_output_tokens': 8000,
-            }
+        # Call Vertex AI (Gemini) with the enhanced prompt
+        analysis_text, generation_info = generate_analysis_text(
+            company, directive, bq_context, use_cache=not data.get('refresh', False)
         )
+        prompt_stats = generation_info['prompt_stats']
         
-        analysis_text = response.text
-        
-        # Parse structured data
-        structured_data = parse_structured_data(analysis_text)
-        
-        # Add customer match info
-        if bq_context['customer_match']:
-            structured_data['customer_match'] = bq_context['customer_match']
-            structured_data['existing_customer'] = True
-            structured_data.update(bq_context['customer_data'])
-        else:
-            structured_data['existing_customer'] = False
-        
-        # Write to BigQuery analysis_complete table
-        analysis_record = {
-            'company': company,
-            'directive': directive,
-            'prospect_level': structured_data.get('prospect_level', 'Unknown'),
-            'prospect_score': structured_data.get('prospect_score', 0),
-            'industry': structured_data.get('industry', 'Unknown'),
-            'location': structured_data.get('location', 'Unknown'),
-            'employees': structured_data.get('employees', 'Unknown'),
-            'revenue': structured_data.get('revenue', 'Unknown'),
-            'auditor_status': structured_data.get('auditor_status', 'Unknown'),
-            'win_themes': structured_data.get('win_themes', 'Unknown'),
-            'key_personnel': structured_data.get('key_personnel', 'Unknown'),
-            'engagement_strategy': structured_data.get('engagement_strategy', 'Unknown'),
-            'gtm_immediate': structured_data.get('gtm_immediate', 'Unknown'),
-            'gtm_short_term': structured_data.get('gtm_short_term', 'Unknown'),
-            'gtm_mid_term': structured_data.get('gtm_mid_term', 'Unknown'),
-            'gtm_long_term': structured_data.get('gtm_long_term', 'Unknown'),
-            'recommended_solutions': structured_data.get('recommended_solutions', 'Unknown'),
-            'full_analysis': analysis_text
-        }
-        write_analysis_to_bigquery(analysis_record)
+        # Parse, merge the customer match and write to analysis_complete
+        structured_data = record_analysis(
+            company, directive, analysis_text, bq_context, generation_info['structured_fields'],
+            analyzed_by=session.get('user_email', 'unknown')
+        )
         
         print(f"✓ Analysis complete: {company}")
         print(f"  Customer Match: {bq_context['customer_match'] or 'None'}")
         print(f"  Prospect Level: {structured_data['prospect_level']}")
         print(f"  Prospect Score: {structured_data['prospect_score']}")
+        print(f"  Prompt Size: ~{prompt_stats['prompt_tokens']} tokens")
         
-        return jsonify({
-            'success': True,
-            'company': company,
-            'directive': directive,
-            'prospectLevel': structured_data['prospect_level'],
-            'score': structured_data['prospect_score'],
-            'auditorStatus': structured_data['auditor_status'],
-            'industry': structured_data.get('industry', 'Unknown'),
-            'location': structured_data.get('location', 'Unknown'),
-            'employees': structured_data.get('employees', 'Unknown'),
-            'analysis': analysis_text,
-            'structured_data': structured_data,
-            'bigquery_context': {
-                'customer_match': bq_context['customer_match'],
-                'products_found': len(bq_context['relevant_products']),
-                'campaigns_found': len(bq_context['relevant_campaigns']),
-                'sales_plays_found': len(bq_context['relevant_sales_plays'])
-            },
-            'source': 'vertex-ai-gemini-enhanced'
-        })
+        return jsonify(build_analysis_response(
+            company, directive, analysis_text, structured_data, bq_context, generation_info
+        ))
         
     except Exception as e:
         print(f"✗ Error in analyze: {str(e)}")
@@ -944,6 +3441,61 @@ def analyze():
         traceback.print_exc()
         return jsonify({'success': False, 'error': f'Analysis failed: {str(e)}'}), 500
 
+@app.route('/api/analyze-stream', methods=['POST'])
+@login_required
+def analyze_stream():
+    """
+    Streaming variant of /api/analyze over Server-Sent Events
+    Emits a context event once BigQuery matching is done, chunk events with
+    report text as Gemini generates it, fields events with provisional
+    structured fields as each report section closes, then a done event
+    carrying the same body as /api/analyze (or an error event)
+    """
+    if not PROJECT_ID:
+        return jsonify({'success': False, 'error': 'GCP Project not configured'}), 500
+    
+    data = request.json or {}
+    company = data.get('company', '').strip()
+    directive = data.get('directive', '').strip()
+    use_cache = not data.get('refresh', False)
+    
+    if not company or not directive:
+        return jsonify({'success': False, 'error': 'Company and directive required'}), 400
+    
+    analyzed_by = session.get('user_email', 'unknown')
+    print(f"Streaming analysis: {company} (User: {analyzed_by})")
+    
+    def events():
+        try:
+            bq_context = get_bigquery_context(company)
+            yield _sse_event('context', summarize_context(bq_context))
+            
+            chunks, generation_info = stream_analysis_text(company, directive, bq_context, use_cache=use_cache)
+            parser = IncrementalReportParser()
+            for text in chunks:
+                yield _sse_event('chunk', {'text': text})
+                fields = parser.feed(text)
+                if fields:
+                    yield _sse_event('fields', fields)
+            analysis_text = parser.text
+            
+            structured_data = record_analysis(company, directive, analysis_text, bq_context, analyzed_by=analyzed_by)
+            print(f"✓ Streamed analysis complete: {company} (Score: {structured_data['prospect_score']})")
+            yield _sse_event('done', build_analysis_response(
+                company, directive, analysis_text, structured_data, bq_context, generation_info
+            ))
+        except Exception as e:
+            print(f"✗ Error in analyze_stream: {str(e)}")
+            import traceback
+            traceback.print_exc()
+            yield _sse_event('error', {'success': False, 'error': f'Analysis failed: {str(e)}'})
+    
+    return Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
 @app.route('/api/tables/list', methods=['GET'])
 @login_required
 def list_tables():
@@ -1002,56 +3554,596 @@ def get_table_data(table_name):
             FROM `{PROJECT_ID}.{DATASET_ID}.analysis_complete`
             """
             try:
-                scores_df = bigquery_client.query(score_query).to_dataframe()
-                
-                # Add prospect_score column with fuzzy matching
-                def get_prospect_score(row_company):
-                    if not row_company:
-                        return 'N/A'
-                    matched = fuzzy_match_company(row_company, scores_df['company_name'].tolist())
-                    if matched:
-                        score_row = scores_df[scores_df['company_name'] == matched]
-                        if not score_row.empty:
-                            return score_row.iloc[0]['prospect_score']
-                    return 'N/A'
-                
-                df['prospect_score'] = df['company_name'].apply(get_prospect_score)
-                
-            except Exception as e:
-                print(f"Could not add prospect scores: {str(e)}")
-                df['prospect_score'] = 'N/A'
-        
-        # Convert DataFrame to format suitable for JSON
-        columns = df.columns.tolist()
-        
-        # Convert date columns to strings BEFORE fillna
-        for col in df.columns:
-            if str(df[col].dtype).startswith('dbdate') or str(df[col].dtype).startswith('dbtime'):
-                # This is a db-dtypes date column - convert to string
-                df[col] = df[col].astype(str)
-        
-        # Now safe to fill NaN with 'N/A'
-        data_records = df.fillna('N/A').to_dict('records')
-        
-        return jsonify({
-            'success': True,
-            'table_name': table_name,
-            'columns': columns,
-            'data': data_records,
-            'row_count': len(df)
-        })
-        
-    except Exception as e:
-        print(f"✗ Error getting table data: {str(e)}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'success': False, 'error': str(e)}), 500
+                scores_df = bigquery_client.query(score_query).to_dataframe()
+                
+                # Add prospect_score column with fuzzy matching against one prebuilt index
+                score_index = CompanyMatchIndex(scores_df['company_name'].tolist())
+                scores = scores_df['prospect_score'].tolist()
+                matched_scores = {}
+                
+                def get_prospect_score(row_company):
+                    if not row_company:
+                        return 'N/A'
+                    if row_company not in matched_scores:
+                        position, _ = score_index.lookup(row_company)
+                        matched_scores[row_company] = scores[position] if position is not None else 'N/A'
+                    return matched_scores[row_company]
+                
+                df['prospect_score'] = df['company_name'].apply(get_prospect_score)
+                
+            except Exception as e:
+                print(f"Could not add prospect scores: {str(e)}")
+                df['prospect_score'] = 'N/A'
+        
+        # Convert DataFrame to format suitable for JSON
+        columns = df.columns.tolist()
+        
+        # Convert date columns to strings BEFORE fillna
+        for col in df.columns:
+            if str(df[col].dtype).startswith('dbdate') or str(df[col].dtype).startswith('dbtime'):
+                # This is a db-dtypes date column - convert to string
+                df[col] = df[col].astype(str)
+        
+        # Now safe to fill NaN with 'N/A'
+        data_records = df.fillna('N/A').to_dict('records')
+        
+        return jsonify({
+            'success': True,
+            'table_name': table_name,
+            'columns': columns,
+            'data': data_records,
+            'row_count': len(df)
+        })
+        
+    except Exception as e:
+        print(f"✗ Error getting table data: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/data-explorer.html')
+@login_required
+def data_explorer():
+    """Serve the data explorer page"""
+    return send_file('data-explorer.html')
+# Durable batch jobs: inputs, per-row checkpoints and final results survive restarts
+BATCH_JOB_STORE = os.environ.get('BATCH_JOB_STORE', 'sqlite').lower()
+BATCH_JOB_STORE_PATH = os.environ.get('BATCH_JOB_STORE_PATH', '/tmp/gtm_batch_jobs.db')
+BATCH_JOB_LEASE_SECONDS = int(os.environ.get('BATCH_JOB_LEASE_SECONDS', 60))
+# Rows are checkpointed as they finish; the job summary (counters, stages) is saved at most this often
+BATCH_JOB_SAVE_SECONDS = float(os.environ.get('BATCH_JOB_SAVE_SECONDS', 2))
+BATCH_RESUME_ON_START = os.environ.get('BATCH_RESUME_ON_START', 'true').lower() == 'true'
+BATCH_JOB_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+def _owner_is_dead(owner):
+    # Owners are host:pid:token; only a process on this host can be checked directly
+    try:
+        host, pid, token = owner.split(':')
+        pid = int(pid)
+    except (AttributeError, ValueError):
+        return False
+    if host != socket.gethostname():
+        return False
+    if pid == os.getpid():
+        # Same pid but another token: an earlier incarnation of this container's worker
+        return token != BATCH_JOB_OWNER.split(':')[-1]
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        return False
+    return False
+
+class SQLiteJobStore:
+    """
+    Batch job store on a local SQLite file
+    Holds each job's input rows and options, a summary snapshot, a checkpoint
+    per finished row and stage (the result entry, triage score or failure) and
+    the final results. The owning process heartbeats its jobs; a job still
+    'processing' whose lease expired (or whose owner on this host is gone) is
+    interrupted and can be claimed by claim_interrupted(). A shared store
+    (Firestore, Cloud SQL, ...) only needs the same methods, with claim as an
+    atomic conditional update, to let any instance serve polls and resumes
+    """
+    
+    name = 'sqlite'
+    
+    def __init__(self, path, lease_seconds, owner):
+        self._path = path
+        self._lease_seconds = lease_seconds
+        self._owner = owner
+        self._lock = threading.Lock()
+        self._conn = None
+        self._heartbeat = None
+        self._counters = Counter()
+        self.last_resume = None
+        if not path:
+            return
+        try:
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS batch_jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    mode TEXT,
+                    owner TEXT,
+                    heartbeat_at REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    input_json TEXT NOT NULL,
+                    summary_json TEXT,
+                    results_json TEXT
+                )
+            """)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS batch_job_rows (
+                    job_id TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    idx INTEGER NOT NULL,
+                    status TEXT NOT NULL,
+                    payload_json TEXT,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (job_id, stage, idx)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS batch_jobs_status ON batch_jobs (status)")
+            self._conn.commit()
+            print(f"✓ Batch job store: {path}")
+        except Exception as e:
+            print(f"⚠ Warning: Could not open batch job store {path}: {str(e)}")
+            self._conn = None
+    
+    @property
+    def enabled(self):
+        return self._conn is not None
+    
+    def _write(self, sql, params):
+        if self._conn is None:
+            return 0
+        try:
+            with self._lock:
+                cursor = self._conn.execute(sql, params)
+                self._conn.commit()
+                return cursor.rowcount
+        except Exception as e:
+            print(f"⚠ Could not write batch job store: {str(e)}")
+            return 0
+    
+    def _read(self, sql, params=()):
+        if self._conn is None:
+            return []
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+    
+    @staticmethod
+    def _summary(job):
+        return json.dumps({key: value for key, value in job.items() if key not in ('results', 'provisional')}, default=str)
+    
+    def create_job(self, job_id, job, companies, options):
+        now = time.time()
+        self._write(
+            "INSERT OR REPLACE INTO batch_jobs "
+            "(job_id, status, mode, owner, heartbeat_at, created_at, updated_at, input_json, summary_json) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (job_id, job['status'], options.get('mode', 'full'), self._owner, now, now, now,
+             json.dumps({'companies': companies, 'options': options}, default=str), self._summary(job))
+        )
+        self._start_heartbeat()
+    
+    def snapshot(self, job):
+        """Status and serialized summary, taken while the caller holds its job lock; written later by save_snapshot"""
+        return job['status'], self._summary(job)
+    
+    def save_job(self, job_id, job, results=None):
+        """Snapshot counters and status; results are stored once the job has finished"""
+        self.save_snapshot(job_id, self.snapshot(job), results)
+    
+    def save_snapshot(self, job_id, snapshot, results=None):
+        status, summary_json = snapshot
+        now = time.time()
+        if results is None:
+            self._write(
+                "UPDATE batch_jobs SET status = ?, summary_json = ?, updated_at = ?, heartbeat_at = ? WHERE job_id = ?",
+                (status, summary_json, now, now, job_id)
+            )
+        else:
+            self._write(
+                "UPDATE batch_jobs SET status = ?, summary_json = ?, results_json = ?, updated_at = ?, heartbeat_at = ? "
+                "WHERE job_id = ?",
+                (status, summary_json, json.dumps(results, default=str), now, now, job_id)
+            )
+    
+    def checkpoint_row(self, job_id, stage, idx, payload, status='completed'):
+        if self._write(
+            "INSERT OR REPLACE INTO batch_job_rows (job_id, stage, idx, status, payload_json, updated_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, stage, idx, status, json.dumps(payload, default=str), time.time())
+        ):
+            with self._lock:
+                self._counters['rows_checkpointed'] += 1
+    
+    def load_checkpoints(self, job_id):
+        """{stage: {row index: (status, payload)}}"""
+        checkpoints = {}
+        for stage, idx, status, payload_json in self._read(
+            "SELECT stage, idx, status, payload_json FROM batch_job_rows WHERE job_id = ?", (job_id,)
+        ):
+            checkpoints.setdefault(stage, {})[idx] = (status, json.loads(payload_json))
+        return checkpoints
+    
+    def load_input(self, job_id):
+        rows = self._read("SELECT input_json FROM batch_jobs WHERE job_id = ?", (job_id,))
+        if not rows:
+            return None, None
+        stored = json.loads(rows[0][0])
+        return stored['companies'], stored['options']
+    
+    def load_job(self, job_id):
+        """Job dict as batch_status reports it, or None; unfinished jobs list their checkpointed results"""
+        rows = self._read("SELECT status, summary_json, results_json FROM batch_jobs WHERE job_id = ?", (job_id,))
+        if not rows:
+            return None
+        job = json.loads(rows[0][1] or '{}')
+        job['status'] = rows[0][0]
+        if rows[0][2] is not None:
+            job['results'] = json.loads(rows[0][2])
+        else:
+            analysis = self.load_checkpoints(job_id).get('analysis', {})
+            job['results'] = [payload for status, payload in analysis.values() if status == 'completed']
+        return job
+    
+    def claim_interrupted(self):
+        """Take over 'processing' jobs whose owner stopped heartbeating; returns [(job_id, last heartbeat)]"""
+        now = time.time()
+        claimed = []
+        for job_id, owner, heartbeat_at in self._read(
+            "SELECT job_id, owner, heartbeat_at FROM batch_jobs WHERE status = 'processing' AND owner != ?", (self._owner,)
+        ):
+            if (heartbeat_at or 0) >= now - self._lease_seconds and not _owner_is_dead(owner):
+                continue
+            # Conditional on the owner we saw, so two claimants cannot both win
+            if self._write(
+                "UPDATE batch_jobs SET owner = ?, heartbeat_at = ? WHERE job_id = ? AND owner = ? AND status = 'processing'",
+                (self._owner, now, job_id, owner)
+            ):
+                claimed.append((job_id, heartbeat_at))
+        if claimed:
+            self._start_heartbeat()
+        return claimed
+    
+    def _start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None or self._conn is None:
+                return
+            self._heartbeat = threading.Thread(target=self._heartbeat_loop, name='batch-job-heartbeat', daemon=True)
+            self._heartbeat.start()
+    
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(max(1, self._lease_seconds / 3))
+            self._write(
+                "UPDATE batch_jobs SET heartbeat_at = ? WHERE owner = ? AND status = 'processing'", (time.time(), self._owner)
+            )
+    
+    def record_resume(self, job_id, rows_recovered, restart_to_resume_seconds, downtime_seconds):
+        with self._lock:
+            self._counters['jobs_resumed'] += 1
+            self._counters['rows_recovered'] += rows_recovered
+            self.last_resume = {
+                'job_id': job_id,
+                'rows_recovered': rows_recovered,
+                'restart_to_resume_seconds': round(restart_to_resume_seconds, 3),
+                'downtime_seconds': round(downtime_seconds, 3) if downtime_seconds is not None else None
+            }
+    
+    def stats(self):
+        by_status = dict(self._read("SELECT status, COUNT(*) FROM batch_jobs GROUP BY status"))
+        with self._lock:
+            return {
+                'backend': self.name,
+                'enabled': self._conn is not None,
+                'jobs': by_status,
+                'rows_checkpointed': self._counters['rows_checkpointed'],
+                'jobs_resumed': self._counters['jobs_resumed'],
+                'rows_recovered': self._counters['rows_recovered'],
+                'last_resume': self.last_resume
+            }
+
+JOB_STORE_BACKENDS = {'sqlite': SQLiteJobStore}
+batch_job_store = JOB_STORE_BACKENDS[BATCH_JOB_STORE](BATCH_JOB_STORE_PATH, BATCH_JOB_LEASE_SECONDS, BATCH_JOB_OWNER)
+
+def _new_batch_job(total):
+    return {
+        'status': 'processing',
+        'total': total,
+        'completed': 0,
+        'failed': 0,
+        'skipped': 0,
+        'dropped': {'count': 0, 'by_reason': {}, 'rows': []},
+        'progress': 0,
+        'results': [],
+        'error': None
+    }
+
+def resume_interrupted_jobs():
+    """Restart batch jobs left 'processing' by a process that died; finished rows come from their checkpoints"""
+    for job_id, heartbeat_at in batch_job_store.claim_interrupted():
+        companies, options = batch_job_store.load_input(job_id)
+        if companies is None and not (options or {}).get('upload'):
+            continue
+        batch_jobs[job_id] = _new_batch_job(len(companies) if companies is not None else 0)
+        batch_jobs[job_id]['resume'] = {'interrupted_at': heartbeat_at}
+        batch_events.open(job_id)
+        print(f"↻ Resuming interrupted batch job {job_id} "
+              f"({len(companies) if companies is not None else options['upload']['path']})")
+        thread = threading.Thread(target=process_batch_analysis, args=(job_id, companies, options))
+        thread.daemon = True
+        thread.start()
+
+# Server-pushed batch progress (/api/batch-events); streams end after BATCH_EVENTS_STREAM_SECONDS and the browser reconnects
+BATCH_EVENTS_STREAM_SECONDS = int(os.environ.get('BATCH_EVENTS_STREAM_SECONDS', 300))
+BATCH_EVENTS_KEEPALIVE_SECONDS = 15
+BATCH_EVENTS_MAX_JOBS = 200
+BATCH_EVENTS_MAX_PER_JOB = 10000
+# Each open stream holds a worker thread (32 in the Dockerfile); past this cap clients get 503 and poll instead
+BATCH_EVENTS_MAX_LISTENERS = int(os.environ.get('BATCH_EVENTS_MAX_LISTENERS', 8))
+
+class BatchEventLog:
+    """
+    Ordered event history per batch job, for Server-Sent Events
+    Event ids are 1-based per job, so a client reconnecting with
+    Last-Event-ID n is sent everything after n. Each job keeps its newest
+    max_events events; a client that resumes from an id older than that is
+    told how many it missed so it can resync. Only finished jobs (marked by
+    a 'done' event) are evicted, oldest first, once more than max_jobs are
+    held. Id counters outlive eviction, so a job's ids never restart
+    At most max_streams streams are attached at once
+    """
+    
+    def __init__(self, max_jobs, max_events=BATCH_EVENTS_MAX_PER_JOB, max_streams=BATCH_EVENTS_MAX_LISTENERS):
+        self._max_jobs = max_jobs
+        self._max_events = max_events
+        self._max_streams = max_streams
+        self._streams = 0
+        self._streams_refused = 0
+        self._cond = threading.Condition()
+        self._events = {}
+        self._last_ids = {}
+        self._finished = set()
+        self._listeners = 0
+        self._published = 0
+        self._dropped = 0
+    
+    def open(self, job_id):
+        with self._cond:
+            if job_id in self._events:
+                return
+            self._events[job_id] = deque(maxlen=self._max_events)
+            self._last_ids.setdefault(job_id, 0)
+            excess = len(self._events) - self._max_jobs
+            if excess > 0:
+                for finished_id in [other for other in self._events if other in self._finished][:excess]:
+                    del self._events[finished_id]
+                    self._finished.discard(finished_id)
+    
+    def has_job(self, job_id):
+        with self._cond:
+            return job_id in self._events
+    
+    def attach(self):
+        """Reserve a stream slot; False when max_streams are already open"""
+        with self._cond:
+            if self._streams >= self._max_streams:
+                self._streams_refused += 1
+                return False
+            self._streams += 1
+            return True
+    
+    def detach(self):
+        with self._cond:
+            self._streams -= 1
+    
+    def publish(self, job_id, event, payload):
+        self.open(job_id)
+        with self._cond:
+            events = self._events[job_id]
+            if len(events) == events.maxlen:
+                self._dropped += 1
+            self._last_ids[job_id] += 1
+            events.append((self._last_ids[job_id], event, payload))
+            self._published += 1
+            if event == 'done':
+                self._finished.add(job_id)
+            else:
+                # A failed bulk job can be ingested again
+                self._finished.discard(job_id)
+            self._cond.notify_all()
+    
+    def wait(self, job_id, after, timeout):
+        """
+        Events with id > after, blocking up to timeout for new ones
+        Returns (events, finished, missed); missed counts events after
+        `after` that are no longer kept
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self._listeners += 1
+            try:
+                while True:
+                    events = self._events.get(job_id, ())
+                    finished = job_id in self._finished
+                    remaining = deadline - time.monotonic()
+                    if self._last_ids.get(job_id, 0) > after or finished or remaining <= 0:
+                        first_id = events[0][0] if events else self._last_ids.get(job_id, 0) + 1
+                        pending = []
+                        for entry in reversed(events):
+                            if entry[0] <= after:
+                                break
+                            pending.append(entry)
+                        pending.reverse()
+                        return pending, finished, max(0, first_id - after - 1)
+                    self._cond.wait(remaining)
+            finally:
+                self._listeners -= 1
+    
+    def stats(self):
+        with self._cond:
+            return {
+                'jobs': len(self._events),
+                'finished_jobs': len(self._finished),
+                'running_jobs': len(self._events) - len(self._finished),
+                'events_published': self._published,
+                'events_dropped': self._dropped,
+                'listeners': self._listeners,
+                'streams': self._streams,
+                'max_streams': self._max_streams,
+                'streams_refused': self._streams_refused
+            }
+
+batch_events = BatchEventLog(BATCH_EVENTS_MAX_JOBS)
+
+def _progress_payload(job):
+    return {
+        'progress': job['progress'],
+        'completed': job['completed'],
+        'failed': job.get('failed', 0),
+        'skipped': job.get('skipped', 0),
+        'dropped': job.get('dropped', {}).get('count', 0),
+        'total': job['total']
+    }
+
+def publish_job_done(job_id, job):
+    batch_events.publish(job_id, 'done', dict(
+        _progress_payload(job), status=job['status'], error=job.get('error'), dedup=job.get('dedup')
+    ))
+
+# Uploads are spooled to disk and read back BATCH_UPLOAD_CHUNK_ROWS rows at a time
+BATCH_UPLOAD_DIR = os.environ.get('BATCH_UPLOAD_DIR', '/tmp/gtm_uploads')
+BATCH_UPLOAD_CHUNK_ROWS = max(1, int(os.environ.get('BATCH_UPLOAD_CHUNK_ROWS', 500)))
+BATCH_REQUIRED_COLUMNS = ['company_name', 'directive']
+BATCH_DROPPED_ROWS_LISTED = 100
+# Rows repeating a company (same customer match or normalized name) and directive share one analysis
+BATCH_DEDUP = os.environ.get('BATCH_DEDUP', 'true').lower() == 'true'
+
+def spool_upload(file, job_id):
+    """Save an uploaded CSV/Excel file under BATCH_UPLOAD_DIR; returns the upload spec {'path', 'kind'}"""
+    name = (file.filename or '').lower()
+    kind = next((kind for kind in ('csv', 'xlsx', 'xls') if name.endswith('.' + kind)), None)
+    if kind is None:
+        raise ValueError('Unsupported file type. Use CSV or Excel')
+    os.makedirs(BATCH_UPLOAD_DIR, exist_ok=True)
+    path = os.path.join(BATCH_UPLOAD_DIR, f'{job_id}.{kind}')
+    file.save(path)
+    return {'path': path, 'kind': kind}
+
+def discard_upload(upload):
+    if not upload:
+        return
+    try:
+        os.remove(upload['path'])
+    except OSError:
+        pass
+
+def _open_upload_workbook(path):
+    """Read-only openpyxl workbook; a corrupt or mislabeled .xlsx raises ValueError"""
+    try:
+        return openpyxl.load_workbook(path, read_only=True, data_only=True)
+    except (zipfile.BadZipFile, InvalidFileException, KeyError) as e:
+        raise ValueError(f"not a valid .xlsx workbook ({e.args[0] if e.args else type(e).__name__})") from e
+
+def read_upload_header(upload):
+    """Column names of a spooled upload, read without loading its rows"""
+    if upload['kind'] == 'csv':
+        return [str(column).strip() for column in pd.read_csv(upload['path'], nrows=0).columns]
+    if upload['kind'] == 'xlsx':
+        workbook = _open_upload_workbook(upload['path'])
+        try:
+            return [_cell_text(column) for column in next(workbook.active.iter_rows(max_row=1, values_only=True), ())]
+        finally:
+            workbook.close()
+    return [str(column).strip() for column in pd.read_excel(upload['path'], nrows=0).columns]
+
+def _chunk_records(records, chunk_rows):
+    chunk = []
+    for idx, record in enumerate(records):
+        chunk.append((idx, record))
+        if len(chunk) == chunk_rows:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_upload_chunks(upload, chunk_rows=None):
+    """
+    Rows of a spooled upload as lists of (row index, record), chunk_rows at a
+    time. CSV is read with a pandas chunked reader and .xlsx with openpyxl in
+    read-only mode, so only the current chunk is held in memory; legacy .xls
+    has no streaming reader and is loaded whole. Cells are read as text and
+    blank lines are kept so they can be reported as dropped rows
+    """
+    chunk_rows = chunk_rows or BATCH_UPLOAD_CHUNK_ROWS
+    if upload['kind'] == 'csv':
+        with pd.read_csv(upload['path'], chunksize=chunk_rows, dtype=str, keep_default_na=False,
+                         skip_blank_lines=False) as reader:
+            yield from _chunk_records(
+                ({str(key).strip(): value for key, value in record.items()}
+                 for frame in reader for record in frame.to_dict('records')),
+                chunk_rows
+            )
+    elif upload['kind'] == 'xlsx':
+        workbook = _open_upload_workbook(upload['path'])
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [_cell_text(column) for column in next(rows, ())]
+            yield from _chunk_records((dict(zip(header, values)) for values in rows), chunk_rows)
+        finally:
+            workbook.close()
+    else:
+        frame = pd.read_excel(upload['path'], dtype=str, keep_default_na=False)
+        frame.columns = [str(column).strip() for column in frame.columns]
+        yield from _chunk_records(frame.to_dict('records'), chunk_rows)
+
+def validate_batch_row(record):
+    """(company, directive, reason); reason is None for a usable row, else why the row is dropped"""
+    company = _cell_text(record.get('company_name'))
+    directive = _cell_text(record.get('directive'))
+    if company and directive:
+        return company, directive, None
+    if not any(_cell_text(value) for value in record.values()):
+        return company, directive, 'blank row'
+    return company, directive, 'missing company_name' if not company else 'missing directive'
+
+def drop_batch_row(job, idx, reason, company=''):
+    """Count a row that failed validation as skipped and list it (first BATCH_DROPPED_ROWS_LISTED) under job['dropped']"""
+    dropped = job['dropped']
+    dropped['count'] += 1
+    dropped['by_reason'][reason] = dropped['by_reason'].get(reason, 0) + 1
+    if len(dropped['rows']) < BATCH_DROPPED_ROWS_LISTED:
+        # Spreadsheet row number: the header is row 1
+        dropped['rows'].append({'row': idx + 2, 'reason': reason, 'company': company})
+    job['skipped'] += 1
+    job['completed'] += 1
+
+def batch_dedup_key(company, directive, bq_context=None):
+    """
+    Rows with equal keys are analyzed once per batch: the matched customer
+    when the pre-pass matched it with at least FUZZY_MATCH_THRESHOLD
+    confidence, else normalize_company_name, plus the directive folded for
+    case and whitespace. Weak "contains" matches (e.g. "GE" inside
+    "Orange Telecom") never merge rows
+    """
+    directive_key = ' '.join(directive.lower().split())
+    if (bq_context and bq_context.get('customer_match')
+            and bq_context.get('match_confidence', 0.0) >= FUZZY_MATCH_THRESHOLD):
+        return ('customer', bq_context['customer_match'], directive_key)
+    return ('name', normalize_company_name(company) or company.lower(), directive_key)
+
+def duplicate_result(result, duplicate):
+    """Copy of a finished result for a duplicate row, under the row's own company and directive"""
+    return dict(result, company=duplicate['company'], directive=duplicate['directive'], duplicate_of=result['company'])
 
-@app.route('/data-explorer.html')
-@login_required
-def data_explorer():
-    """Serve the data explorer page"""
-    return send_file('data-explorer.html')
 @app.route('/api/batch-analyze', methods=['POST'])
 @login_required
 def batch_analyze():
@@ -1065,44 +4157,63 @@ def batch_analyze():
         if file.filename == '':
             return jsonify({'success': False, 'error': 'No file selected'}), 400
         
-        # Read the file based on extension
-        if file.filename.endswith('.csv'):
-            df = pd.read_csv(file)
-        elif file.filename.endswith(('.xlsx', '.xls')):
-            df = pd.read_excel(file)
-        else:
-            return jsonify({'success': False, 'error': 'Unsupported file type. Use CSV or Excel'}), 400
+        # Spool the upload to disk; rows are parsed in chunks by the background job
+        job_id = str(uuid.uuid4())
+        try:
+            upload = spool_upload(file, job_id)
+        except ValueError as e:
+            return jsonify({'success': False, 'error': str(e)}), 400
         
-        # Validate required columns
-        required_columns = ['company_name', 'directive']
-        if not all(col in df.columns for col in required_columns):
-            return jsonify({'success': False, 'error': f'File must contain columns: {", ".join(required_columns)}'}), 400
+        # Validate required columns from the header row only
+        try:
+            header = read_upload_header(upload)
+        except ValueError as e:
+            discard_upload(upload)
+            return jsonify({'success': False, 'error': f'Could not read file: {str(e)}'}), 400
+        if not all(col in header for col in BATCH_REQUIRED_COLUMNS):
+            discard_upload(upload)
+            return jsonify({'success': False, 'error': f'File must contain columns: {", ".join(BATCH_REQUIRED_COLUMNS)}'}), 400
         
-        # Create job ID
-        job_id = str(uuid.uuid4())
+        # Optional two-stage triage: score everything with the fast model first;
+        # bulk renders all prompts into one offline batch prediction job
+        options = {'mode': request.form.get('mode', 'full'), 'analyzed_by': session.get('user_email', 'unknown')}
+        if options['mode'] not in ('full', 'triage', 'bulk'):
+            discard_upload(upload)
+            return jsonify({'success': False, 'error': 'mode must be full, triage or bulk'}), 400
+        if options['mode'] == 'triage':
+            try:
+                options['min_score'] = int(request.form.get('min_score') or TRIAGE_MIN_SCORE)
+                options['top_n'] = int(request.form['top_n']) if request.form.get('top_n') else None
+            except ValueError:
+                discard_upload(upload)
+                return jsonify({'success': False, 'error': 'min_score and top_n must be integers'}), 400
         
-        # Initialize job tracking
-        batch_jobs[job_id] = {
-            'status': 'processing',
-            'total': len(df),
-            'completed': 0,
-            'progress': 0,
-            'results': [],
-            'error': None
-        }
+        # Initialize job tracking; total grows as the upload is parsed
+        batch_jobs[job_id] = _new_batch_job(0)
+        batch_events.open(job_id)
         
         # Start batch processing in background thread
-        thread = threading.Thread(
-            target=process_batch_analysis,
-            args=(job_id, df.to_dict('records'))
-        )
+        if options['mode'] == 'bulk':
+            batch_jobs[job_id]['mode'] = 'bulk'
+            thread = threading.Thread(
+                target=process_bulk_analysis,
+                args=(job_id, None, request.form.get('wait', 'true').lower() != 'false', options['analyzed_by'], upload)
+            )
+        else:
+            # Bulk jobs keep their own state in BULK_WORK_DIR; the store keeps the spooled file's path for resume
+            options['upload'] = upload
+            batch_job_store.create_job(job_id, batch_jobs[job_id], None, options)
+            thread = threading.Thread(
+                target=process_batch_analysis,
+                args=(job_id, None, options)
+            )
         thread.daemon = True
         thread.start()
         
         return jsonify({
             'success': True,
             'job_id': job_id,
-            'total_companies': len(df)
+            'total_companies': None
         })
         
     except Exception as e:
@@ -1111,136 +4222,1055 @@ def batch_analyze():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
-def process_batch_analysis(job_id, companies):
-    """Process batch analysis in background"""
+def analyze_batch_company(company, directive, bq_context, on_fields=None, analyzed_by='unknown'):
+    """
+    Analyze one batch row, write it back to BigQuery and return its result entry
+    With on_fields the report is streamed and on_fields receives provisional
+    fields as sections close (see stream_report_fields)
+    """
+    # Call Vertex AI with the enhanced prompt
+    if on_fields is not None:
+        analysis_text, _, generation_info = stream_report_fields(company, directive, bq_context, on_fields=on_fields)
+    else:
+        analysis_text, generation_info = generate_analysis_text(company, directive, bq_context)
+    
+    structured_data = record_analysis(
+        company, directive, analysis_text, bq_context, generation_info['structured_fields'], analyzed_by=analyzed_by
+    )
+    
+    return {
+        'company': company,
+        'directive': directive,
+        'prospect_level': structured_data.get('prospect_level', 'Unknown'),
+        'score': structured_data.get('prospect_score', 0),
+        'analysis': analysis_text,
+        'structured_data': structured_data,
+        'prompt_stats': generation_info['prompt_stats'],
+        'cache_hit': generation_info['cache_hit']
+    }
+
+def _cell_text(value):
+    """Uploaded cell as stripped text; empty cells arrive from pandas as NaN"""
+    if value is None or (isinstance(value, float) and value != value):
+        return ''
+    return str(value).strip()
+
+def append_result(results, result):
+    """Add a finished row; seq is its position in completion order, the cursor for since= polls"""
+    result['seq'] = len(results)
+    results.append(result)
+
+def _triage_only_result(company, directive, bq_context, triage):
+    """Result entry for a row that stopped after the triage stage"""
+    structured_data = {
+        'prospect_level': triage['level'],
+        'prospect_score': triage['score'] if triage['score'] is not None else 'Unknown',
+        'triage_rationale': triage['rationale'],
+        'existing_customer': bool(bq_context['customer_match'])
+    }
+    if bq_context['customer_match']:
+        structured_data['customer_match'] = bq_context['customer_match']
+        structured_data.update(bq_context['customer_data'])
+    return {
+        'company': company,
+        'directive': directive,
+        'prospect_level': triage['level'],
+        'score': structured_data['prospect_score'],
+        'analysis': f"Triage score only ({triage.get('model', TRIAGE_MODEL_NAME)}); below the full-analysis cutoff.\n\n{triage['text']}",
+        'structured_data': structured_data,
+        'stage': 'triage'
+    }
+
+def process_batch_analysis(job_id, companies, options=None):
+    """
+    Process batch analysis in background
+    companies is a list of row dicts, or None to read options['upload'] (a
+    spooled file) chunk by chunk; rows of each chunk are validated, resolved
+    and handed to the workers while later chunks are still being parsed, and
+    rows failing validation are listed under job['dropped']
+    Rows run on a pool of BATCH_MAX_WORKERS threads; Gemini calls share
+    vertex_rate_limiter so concurrent rows (and jobs) stay within quota.
+    With options['mode'] == 'triage' every row is first scored by
+    TRIAGE_MODEL_NAME and only rows passing min_score / top_n get the full
+    report; each stage's counts are kept under job['stages']
+    completed counts rows that have their final result (or failed/skipped).
+    With BATCH_STREAMING, rows still being generated expose their
+    provisional score and level under job['provisional']
+    Every finished row is checkpointed in batch_job_store; rows that already
+    have a checkpoint (a resumed job) are restored instead of re-run
+    With BATCH_DEDUP, rows sharing a batch_dedup_key run once: stage counts
+    cover the unique rows, the first row's outcome is copied to its
+    duplicates and job['dedup'] reports the LLM calls saved
+    """
+    options = options or {}
+    job = batch_jobs[job_id]
+    upload = options.get('upload')
     try:
-        total = len(companies)
+        checkpoints = batch_job_store.load_checkpoints(job_id)
+        if 'resume' in job:
+            now = time.time()
+            rows_recovered = sum(len(saved) for saved in checkpoints.values())
+            interrupted_at = job['resume'].get('interrupted_at')
+            job['resume'].update({
+                'rows_recovered': rows_recovered,
+                'restart_to_resume_seconds': round(now - PROCESS_STARTED_AT, 3),
+                'downtime_seconds': round(now - interrupted_at, 3) if interrupted_at is not None else None
+            })
+            batch_job_store.record_resume(
+                job_id, rows_recovered, now - PROCESS_STARTED_AT, now - interrupted_at if interrupted_at is not None else None
+            )
+            print(f"↻ Batch job {job_id}: {rows_recovered} checkpointed rows recovered, "
+                  f"resumed {now - PROCESS_STARTED_AT:.1f}s after start")
+        triage_mode = options.get('mode') == 'triage'
+        # Readers see rows as they are appended (in seq order); the list is only ranked once the job is done
         results = []
+        job['results'] = results
+        progress_lock = threading.Lock()
+        last_saved_at = 0.0
+        batch_contexts = {}
+        prepass = {}
+        rows = []
+        leaders = {}
+        job['total'] = 0
+        job['parsing'] = True
+        job['dedup'] = {'enabled': BATCH_DEDUP, 'unique_rows': 0, 'duplicate_rows': 0, 'llm_calls_saved': 0}
         
-        for idx, company_data in enumerate(companies):
-            try:
-                company = company_data.get('company_name', '').strip()
-                directive = company_data.get('directive', '').strip()
-                
-                if not company or not directive:
+        stages = {'analysis': {'model': ANALYSIS_MODEL_NAME, 'status': 'pending', 'total': 0, 'completed': 0, 'failed': 0}}
+        if triage_mode:
+            stages['triage'] = {
+                'model': TRIAGE_MODEL_NAME, 'status': 'pending', 'total': 0, 'completed': 0, 'failed': 0,
+                'promoted': None, 'min_score': options.get('min_score'), 'top_n': options.get('top_n')
+            }
+            stages['analysis']['total'] = None
+        if triage_mode and TRIAGE_STRATEGY == 'stream':
+            stages['triage']['model'] = ANALYSIS_MODEL_NAME
+            stages['triage']['stopped_early'] = 0
+        job['mode'] = 'triage' if triage_mode else 'full'
+        job['stages'] = stages
+        job['provisional'] = {}
+        batch_events.publish(job_id, 'started', dict(_progress_payload(job), mode=job['mode']))
+        
+        def update_progress():
+            # Called with progress_lock held; triage and full analysis each weigh half in triage mode.
+            # While the upload is still being parsed this covers the rows read so far
+            done = job['skipped'] / job['total'] if job['total'] else 1
+            analysis = stages['analysis']
+            analysis_fraction = analysis['completed'] / analysis['total'] if analysis['total'] else 0
+            if triage_mode:
+                triage = stages['triage']
+                triage_fraction = triage['completed'] / triage['total'] if triage['total'] else 1
+                if analysis['total'] == 0:
+                    analysis_fraction = 1
+                job['progress'] = (done + (1 - done) * (triage_fraction + analysis_fraction) / 2) * 100
+            else:
+                job['progress'] = (done + (1 - done) * analysis_fraction) * 100
+        
+        def fan_out(leader, duplicates, calls, publish=True):
+            # Called with progress_lock held: duplicates take the leader's final outcome; calls is what each would have cost
+            for duplicate in duplicates:
+                job['completed'] += 1
+                job['dedup']['llm_calls_saved'] += calls
+                if leader.get('error') is not None:
+                    job['failed'] += 1
+                    if publish:
+                        batch_events.publish(job_id, 'row_failed', dict(
+                            _progress_payload(job), stage=leader['stage'], company=duplicate['company'],
+                            directive=duplicate['directive'], error=leader['error']
+                        ))
+                    continue
+                duplicate['result'] = duplicate_result(leader['result'], duplicate)
+                append_result(results, duplicate['result'])
+                if publish:
+                    batch_events.publish(job_id, 'row', dict(_progress_payload(job), result=summarize_batch_result(duplicate['result'])))
+            if duplicates:
+                update_progress()
+        
+        def collapse_duplicates(chunk_rows):
+            # Called with progress_lock held; returns the chunk's rows that need their own analysis
+            unique = []
+            for row in chunk_rows:
+                key = batch_dedup_key(row['company'], row['directive'], batch_contexts.get(row['company']))
+                leader = leaders.setdefault(key, row)
+                if leader is row:
+                    unique.append(row)
                     continue
+                leader.setdefault('duplicates', []).append(row)
+                job['dedup']['duplicate_rows'] += 1
+                if 'stage' in leader:
+                    # The leader already has its final outcome
+                    fan_out(leader, [row], leader['calls'])
+            return unique
+        
+        def read_rows():
+            """Valid rows, one parsed chunk at a time, each chunk resolved against the customer table before its LLM calls"""
+            chunks = iter_upload_chunks(upload) if companies is None else _chunk_records(companies, BATCH_UPLOAD_CHUNK_ROWS)
+            first_stage = stages['triage' if triage_mode else 'analysis']
+            for chunk in chunks:
+                chunk_rows = []
+                with progress_lock:
+                    job['total'] += len(chunk)
+                    for idx, company_data in chunk:
+                        company, directive, reason = validate_batch_row(company_data)
+                        if reason is None:
+                            chunk_rows.append({'idx': idx, 'company': company, 'directive': directive})
+                        else:
+                            drop_batch_row(job, idx, reason, company)
                 
-                print(f"Batch analyzing {idx+1}/{total}: {company}")
+                contexts, job['prepass'] = resolve_batch_contexts([row['company'] for row in chunk_rows], prepass)
+                with progress_lock:
+                    batch_contexts.update(contexts)
+                    if BATCH_DEDUP:
+                        chunk_rows = collapse_duplicates(chunk_rows)
+                    job['dedup']['unique_rows'] += len(chunk_rows)
+                    rows.extend(chunk_rows)
+                    first_stage['total'] += len(chunk_rows)
+                    update_progress()
+                batch_events.publish(job_id, 'progress', dict(_progress_payload(job), stage='upload'))
+                yield chunk_rows
+            
+            with progress_lock:
+                job['parsing'] = False
+                update_progress()
+            if job['dropped']['count']:
+                print(f"⚠ Batch job {job_id}: {job['dropped']['count']} rows dropped {job['dropped']['by_reason']}")
+        
+        def run_stage(name, row_chunks, work, restore):
+            stage = stages[name]
+            stage['status'] = 'processing'
+            saved = checkpoints.get(name, {})
+            
+            def finish_row(row, final, error=None):
+                # Called with progress_lock held; returns a job snapshot when one is due, for the caller
+                # to write after releasing the lock (the row itself is already checkpointed)
+                nonlocal last_saved_at
+                if error is not None:
+                    stage['failed'] += 1
+                    job['failed'] += 1
+                stage['completed'] += 1
+                if final:
+                    job['completed'] += 1
+                update_progress()
                 
-                # Get BigQuery context
-                bq_context = get_bigquery_context(company)
+                if error is not None:
+                    batch_events.publish(job_id, 'row_failed', dict(
+                        _progress_payload(job), stage=name, company=row['company'], directive=row['directive'], error=error
+                    ))
+                elif 'result' in row:
+                    batch_events.publish(job_id, 'row', dict(_progress_payload(job), result=summarize_batch_result(row['result'])))
+                else:
+                    batch_events.publish(job_id, 'progress', dict(_progress_payload(job), stage=name))
                 
-                # Create prompt
-                prompt = create_enhanced_analysis_prompt(company, directive, bq_context)
+                if final:
+                    # Duplicates skipped triage and, for promoted rows, the full analysis too
+                    row.update(stage=name, error=error, calls=2 if triage_mode and name == 'analysis' else 1)
+                    fan_out(row, row.get('duplicates', []), row['calls'])
                 
-                # Call Vertex AI
-                model = GenerativeModel('gemini-2.5-pro')
-                response = model.generate_content(
-                    prompt,
-                    generation_config={
-                        'temperature': 0.2,
-                        'max_output_tokens': 8000,
-                    }
+                now = time.monotonic()
+                if batch_job_store.enabled and now - last_saved_at >= BATCH_JOB_SAVE_SECONDS:
+                    last_saved_at = now
+                    return batch_job_store.snapshot(job)
+                return None
+            
+            def run_row(row):
+                final = True
+                error = None
+                try:
+                    print(f"Batch {name} {row['idx']+1}/{job['total']}: {row['company']}")
+                    bq_context = batch_contexts.get(row['company']) or get_bigquery_context(row['company'])
+                    final = work(row, bq_context)
+                except Exception as e:
+                    print(f"✗ Error in batch {name} for {row['company']}: {str(e)}")
+                    error = str(e)
+                    batch_job_store.checkpoint_row(job_id, name, row['idx'], {'error': error}, status='failed')
+                finally:
+                    with progress_lock:
+                        snapshot = finish_row(row, final, error)
+                    if snapshot is not None:
+                        batch_job_store.save_snapshot(job_id, snapshot)
+            
+            # Rows are submitted chunk by chunk as they arrive; rows finished
+            # before a restart come back from their checkpoints
+            futures = []
+            with ThreadPoolExecutor(max_workers=BATCH_MAX_WORKERS, thread_name_prefix=f'batch-{job_id[:8]}') as executor:
+                for stage_rows in row_chunks:
+                    for row in stage_rows:
+                        if row['idx'] not in saved:
+                            futures.append(executor.submit(run_row, row))
+                            continue
+                        status, payload = saved[row['idx']]
+                        with progress_lock:
+                            if status == 'failed':
+                                snapshot = finish_row(row, True, payload.get('error', 'failed'))
+                            else:
+                                snapshot = finish_row(row, restore(row, payload))
+                        if snapshot is not None:
+                            batch_job_store.save_snapshot(job_id, snapshot)
+                for future in futures:
+                    future.result()
+            stage['status'] = 'completed'
+        
+        def publish_provisional(row):
+            def on_fields(fields):
+                if 'prospect_score' not in fields and 'prospect_level' not in fields:
+                    return
+                with progress_lock:
+                    entry = job['provisional'].setdefault(
+                        str(row['idx']), {'company': row['company'], 'directive': row['directive']}
+                    )
+                    if 'prospect_score' in fields:
+                        entry['score'] = fields['prospect_score']
+                    if 'prospect_level' in fields:
+                        entry['prospect_level'] = fields['prospect_level']
+            return on_fields
+        
+        def analyze_row(row, bq_context):
+            on_fields = publish_provisional(row) if BATCH_STREAMING else None
+            try:
+                result = analyze_batch_company(
+                    row['company'], row['directive'], bq_context, on_fields, analyzed_by=options.get('analyzed_by', 'unknown')
                 )
+            finally:
+                with progress_lock:
+                    job['provisional'].pop(str(row['idx']), None)
+            result['stage'] = 'analysis'
+            if 'triage' in row:
+                result['triage_score'] = row['triage']['score']
+            with progress_lock:
+                append_result(results, result)
+                row['result'] = result
+            batch_job_store.checkpoint_row(job_id, 'analysis', row['idx'], result)
+            print(f"✓ Batch analysis complete {row['idx']+1}/{job['total']}: {row['company']}")
+            return True
+        
+        def restore_analysis(row, result):
+            append_result(results, result)
+            row['result'] = result
+            return True
+        
+        def triage_row(row, bq_context):
+            if TRIAGE_STRATEGY == 'stream':
+                row['triage'] = stream_triage_score(row['company'], row['directive'], bq_context)
+                if row['triage']['stopped_early']:
+                    with progress_lock:
+                        stages['triage']['stopped_early'] += 1
+            else:
+                row['triage'] = generate_triage_score(row['company'], row['directive'], bq_context)
+            row['score'] = row['triage']['score']
+            batch_job_store.checkpoint_row(job_id, 'triage', row['idx'], row['triage'])
+            return False
+        
+        def restore_triage(row, triage):
+            row['triage'] = triage
+            row['score'] = triage['score']
+            return False
+        
+        if triage_mode:
+            run_stage('triage', read_rows(), triage_row, restore_triage)
+            
+            analysis_rows = select_for_full_analysis(
+                [row for row in rows if 'triage' in row], options.get('min_score'), options.get('top_n')
+            )
+            promoted = {row['idx'] for row in analysis_rows}
+            with progress_lock:
+                for row in rows:
+                    if 'triage' in row and row['idx'] not in promoted:
+                        bq_context = batch_contexts.get(row['company']) or _empty_context()
+                        row['result'] = _triage_only_result(row['company'], row['directive'], bq_context, row['triage'])
+                        append_result(results, row['result'])
+                        job['completed'] += 1
+                        row.update(stage='triage', error=None, calls=1)
+                        fan_out(row, row.get('duplicates', []), 1, publish=False)
+                stages['triage']['promoted'] = len(analysis_rows)
+                stages['analysis']['total'] = len(analysis_rows)
+                update_progress()
+                for result in results:
+                    batch_events.publish(job_id, 'row', dict(_progress_payload(job), result=summarize_batch_result(result)))
+            print(f"✓ Triage complete for job {job_id}: {len(analysis_rows)}/{len(rows)} promoted to full analysis")
+            run_stage('analysis', [analysis_rows], analyze_row, restore_analysis)
+        else:
+            run_stage('analysis', read_rows(), analyze_row, restore_analysis)
+        
+        # Sort results by score (descending) into a new list, so polls in progress never see a half-sorted one
+        results = sorted(results, key=lambda x: x.get('score', 0) if isinstance(x.get('score'), (int, float)) else 0, reverse=True)
+        
+        # Mark job as complete
+        job['results'] = results
+        job['status'] = 'completed'
+        job['progress'] = 100
+        batch_job_store.save_job(job_id, job, results)
+        publish_job_done(job_id, job)
+        discard_upload(upload)
+        
+        print(f"✓ Batch job {job_id} completed: {len(results)} results, {stages['analysis']['completed']} full analyses, "
+              f"{job['failed']} failed, {job['dedup']['llm_calls_saved']} LLM calls saved by deduplication")
+        
+    except Exception as e:
+        print(f"✗ Error in process_batch_analysis: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        job['parsing'] = False
+        batch_job_store.save_job(job_id, job)
+        publish_job_done(job_id, job)
+        discard_upload(upload)
+
+# Offline bulk inference: render prompts to JSONL, run them as one batch prediction job, ingest the results
+BULK_BACKEND = os.environ.get('BULK_BACKEND', 'vertex').lower()
+BULK_WORK_DIR = os.environ.get('BULK_WORK_DIR', '/tmp/gtm_bulk')
+BULK_GCS_BUCKET = os.environ.get('BULK_GCS_BUCKET', '')
+BULK_POLL_SECONDS = int(os.environ.get('BULK_POLL_SECONDS', 60))
+
+def _prompt_digest(prompt):
+    return hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+
+def _bulk_request_line(key, prompt):
+    """One request in the Vertex AI Gemini batch prediction JSONL format"""
+    return json.dumps({
+        'key': key,
+        'request': {
+            'contents': [{'role': 'user', 'parts': [{'text': prompt}]}],
+            'generationConfig': {
+                'temperature': ANALYSIS_GENERATION_CONFIG['temperature'],
+                'maxOutputTokens': ANALYSIS_GENERATION_CONFIG['max_output_tokens']
+            }
+        }
+    })
+
+def _bulk_request_text(request_body):
+    return ''.join(
+        part.get('text', '')
+        for content in request_body.get('contents', [])
+        for part in content.get('parts', [])
+    )
+
+def _bulk_response_text(line):
+    """Report text from one prediction line, or None if the request failed"""
+    candidates = (line.get('response') or {}).get('candidates') or []
+    if not candidates:
+        return None
+    parts = (candidates[0].get('content') or {}).get('parts') or []
+    text = ''.join(part.get('text', '') for part in parts)
+    return text or None
+
+class LocalBulkBackend:
+    """
+    File-based stand-in for Vertex AI batch prediction (BULK_BACKEND=local)
+    Answers each request with FakeGenerativeModel on a background thread and
+    writes predictions.jsonl in the Vertex output format, so the bulk
+    pipeline can run end to end without network access
+    """
+    
+    name = 'local'
+    
+    def submit(self, job_id, request_path, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        thread = threading.Thread(target=self._run, args=(request_path, output_dir), daemon=True)
+        thread.start()
+        return output_dir
+    
+    def _run(self, request_path, output_dir):
+        try:
+            with open(request_path, encoding='utf-8') as requests_file, \
+                    open(os.path.join(output_dir, 'predictions.jsonl'), 'w', encoding='utf-8') as output:
+                for raw in requests_file:
+                    line = json.loads(raw)
+                    text = FakeGenerativeModel._report(_bulk_request_text(line['request']))
+                    line['response'] = {'candidates': [{'content': {'role': 'model', 'parts': [{'text': text}]}}]}
+                    line['status'] = ''
+                    output.write(json.dumps(line) + '\n')
+            open(os.path.join(output_dir, '_SUCCESS'), 'w').close()
+        except Exception as e:
+            with open(os.path.join(output_dir, '_FAILED'), 'w') as marker:
+                marker.write(str(e))
+    
+    def status(self, handle):
+        if os.path.exists(os.path.join(handle, '_SUCCESS')):
+            return 'succeeded'
+        if os.path.exists(os.path.join(handle, '_FAILED')):
+            return 'failed'
+        return 'running'
+    
+    def iter_response_lines(self, handle):
+        with open(os.path.join(handle, 'predictions.jsonl'), encoding='utf-8') as predictions:
+            for raw in predictions:
+                yield raw
+
+class VertexBulkBackend:
+    """Vertex AI batch prediction: request file staged in BULK_GCS_BUCKET, results read back from GCS"""
+    
+    name = 'vertex'
+    
+    def submit(self, job_id, request_path, output_dir):
+        if not BULK_GCS_BUCKET:
+            raise ValueError('BULK_GCS_BUCKET is required for Vertex AI batch prediction')
+        prefix = f"gtm-bulk/{job_id}"
+        bucket = storage.Client(project=PROJECT_ID).bucket(BULK_GCS_BUCKET)
+        bucket.blob(f"{prefix}/requests.jsonl").upload_from_filename(request_path)
+        remote_job = BatchPredictionJob.submit(
+            source_model=ANALYSIS_MODEL_NAME,
+            input_dataset=f"gs://{BULK_GCS_BUCKET}/{prefix}/requests.jsonl",
+            output_uri_prefix=f"gs://{BULK_GCS_BUCKET}/{prefix}/output"
+        )
+        return remote_job.resource_name
+    
+    def status(self, handle):
+        remote_job = BatchPredictionJob(handle)
+        if not remote_job.has_ended:
+            return 'running'
+        return 'succeeded' if remote_job.has_succeeded else 'failed'
+    
+    def iter_response_lines(self, handle):
+        location = BatchPredictionJob(handle).output_location
+        bucket_name, _, prefix = location[len('gs://'):].partition('/')
+        client = storage.Client(project=PROJECT_ID)
+        for blob in client.list_blobs(bucket_name, prefix=prefix):
+            if blob.name.endswith('.jsonl'):
+                with blob.open('r') as predictions:
+                    for raw in predictions:
+                        yield raw
+
+BULK_BACKENDS = {'local': LocalBulkBackend(), 'vertex': VertexBulkBackend()}
+
+# One lock per bulk job: the waiter and response uploads claim the job under it
+_bulk_job_locks = {}
+_bulk_job_locks_guard = threading.Lock()
+
+def bulk_job_lock(job_id):
+    with _bulk_job_locks_guard:
+        return _bulk_job_locks.setdefault(job_id, threading.Lock())
+
+def _bulk_dir(job_id):
+    return os.path.join(BULK_WORK_DIR, job_id)
+
+def _save_bulk_state(state):
+    path = os.path.join(_bulk_dir(state['job_id']), 'job.json')
+    with open(path + '.tmp', 'w') as handle:
+        json.dump(state, handle)
+    os.replace(path + '.tmp', path)
+
+def load_bulk_state(job_id):
+    path = os.path.join(_bulk_dir(job_id), 'job.json')
+    if not re.fullmatch(r'[0-9a-f-]{36}', job_id) or not os.path.exists(path):
+        return None
+    with open(path) as handle:
+        return json.load(handle)
+
+def _bulk_results_path(job_id):
+    return os.path.join(_bulk_dir(job_id), 'results.jsonl')
+
+def _terminate_last_line(path):
+    # A crash mid-write leaves a torn last line; the next record must start on a line of its own
+    if not os.path.exists(path) or not os.path.getsize(path):
+        return
+    with open(path, 'rb+') as handle:
+        handle.seek(-1, os.SEEK_END)
+        if handle.read(1) != b'\n':
+            handle.write(b'\n')
+
+def load_bulk_results(job_id):
+    """{manifest key: result} for rows an earlier (possibly interrupted) ingest already wrote back"""
+    written = {}
+    path = _bulk_results_path(job_id)
+    if not os.path.exists(path):
+        return written
+    with open(path, encoding='utf-8') as handle:
+        for raw in handle:
+            try:
+                line = json.loads(raw)
+            except ValueError:
+                # Torn last line from a crash mid-write; that row was not recorded
+                continue
+            written[line['key']] = line['result']
+    return written
+
+def _valid_bulk_rows(job, chunks, batch_contexts):
+    """(idx, company, directive) for each valid row; each chunk is resolved into batch_contexts first"""
+    prepass = {}
+    for chunk in chunks:
+        job['total'] += len(chunk)
+        chunk_rows = []
+        for idx, company_data in chunk:
+            company, directive, reason = validate_batch_row(company_data)
+            if reason is None:
+                chunk_rows.append((idx, company, directive))
+            else:
+                drop_batch_row(job, idx, reason, company)
+        contexts, job['prepass'] = resolve_batch_contexts([company for _, company, _ in chunk_rows], prepass)
+        batch_contexts.update(contexts)
+        yield from chunk_rows
+
+def prepare_bulk_job(job_id, companies, analyzed_by='unknown', upload=None):
+    """
+    Render every prompt with create_enhanced_analysis_prompt into
+    requests.jsonl plus a manifest (company, directive, customer match) used
+    when ingesting, then submit the request file to BULK_BACKEND
+    companies is a list of row dicts, or None to read the spooled upload in chunks
+    """
+    job = batch_jobs[job_id]
+    work_dir = _bulk_dir(job_id)
+    os.makedirs(work_dir, exist_ok=True)
+    request_path = os.path.join(work_dir, 'requests.jsonl')
+    manifest_path = os.path.join(work_dir, 'manifest.jsonl')
+    
+    chunks = iter_upload_chunks(upload) if companies is None else _chunk_records(companies, BATCH_UPLOAD_CHUNK_ROWS)
+    batch_contexts = {}
+    job['total'] = 0
+    
+    requests_written = 0
+    with open(request_path, 'w', encoding='utf-8') as requests_file, \
+            open(manifest_path, 'w', encoding='utf-8') as manifest_file:
+        for idx, company, directive in _valid_bulk_rows(job, chunks, batch_contexts):
+            bq_context = batch_contexts.get(company) or get_bigquery_context(company)
+            prompt = create_enhanced_analysis_prompt(company, directive, bq_context)
+            key = str(idx)
+            requests_file.write(_bulk_request_line(key, prompt) + '\n')
+            manifest_file.write(json.dumps({
+                'key': key,
+                'company': company,
+                'directive': directive,
+                'prompt_sha256': _prompt_digest(prompt),
+                'customer_match': bq_context['customer_match'],
+                'customer_data': bq_context['customer_data'],
+                'match_confidence': bq_context.get('match_confidence', 0.0)
+            }, default=str) + '\n')
+            requests_written += 1
+    
+    backend = BULK_BACKENDS[BULK_BACKEND]
+    state = {
+        'job_id': job_id,
+        'backend': backend.name,
+        'handle': None,
+        'state': 'rendered',
+        'total': job['total'],
+        'skipped': job['skipped'],
+        'requests': requests_written,
+        'analyzed_by': analyzed_by,
+        'created_at': datetime.now().isoformat()
+    }
+    _save_bulk_state(state)
+    
+    state['handle'] = backend.submit(job_id, request_path, os.path.join(work_dir, 'output'))
+    state['state'] = 'submitted'
+    _save_bulk_state(state)
+    print(f"✓ Bulk job {job_id}: {requests_written} requests submitted to {backend.name} backend")
+    return state
+
+def ingest_bulk_responses(job_id, response_lines):
+    """
+    Single streaming pass over prediction lines: match each to its manifest
+    row (by key, or by prompt hash when the backend drops extra fields),
+    parse, write back to BigQuery and rank. Rows without a usable response
+    are counted as failed
+    Each written row is appended to results.jsonl, so a re-run after an
+    interrupted ingest only writes the rows still missing; a completed job
+    is never ingested again
+    """
+    job = batch_jobs[job_id]
+    state = load_bulk_state(job_id)
+    if state['state'] == 'completed':
+        raise ValueError(f"bulk job {job_id} has already been ingested")
+    state['state'] = 'ingesting'
+    _save_bulk_state(state)
+    job['status'] = 'processing'
+    job['failed'] = 0
+    
+    manifest = {}
+    by_digest = {}
+    with open(os.path.join(_bulk_dir(job_id), 'manifest.jsonl'), encoding='utf-8') as manifest_file:
+        for raw in manifest_file:
+            row = json.loads(raw)
+            manifest[row['key']] = row
+            by_digest[row['prompt_sha256']] = row['key']
+    
+    written = load_bulk_results(job_id)
+    results = []
+    for result in written.values():
+        append_result(results, result)
+    seen = set(written)
+    job['results'] = results
+    _terminate_last_line(_bulk_results_path(job_id))
+    with open(_bulk_results_path(job_id), 'a', encoding='utf-8') as written_file:
+        for raw in response_lines:
+            if not raw.strip():
+                continue
+            try:
+                line = json.loads(raw)
+                key = line.get('key')
+                if key not in manifest:
+                    key = by_digest.get(_prompt_digest(_bulk_request_text(line.get('request') or {})))
+                if key is None or key in seen:
+                    continue
+                seen.add(key)
+                row = manifest[key]
                 
-                analysis_text = response.text
-                
-                # Parse structured data
-                structured_data = parse_structured_data(analysis_text)
-                
-                # Add customer match info
-                if bq_context['customer_match']:
-                    structured_data['customer_match'] = bq_context['customer_match']
-                    structured_data['existing_customer'] = True
-                    structured_data.update(bq_context['customer_data'])
-                else:
-                    structured_data['existing_customer'] = False
-                
-                # Write to BigQuery
-                analysis_record = {
-                    'company': company,
-                    'directive': directive,
-                    'prospect_level': structured_data.get('prospect_level', 'Unknown'),
-                    'prospect_score': structured_data.get('prospect_score', 0),
-                    'industry': structured_data.get('industry', 'Unknown'),
-                    'location': structured_data.get('location', 'Unknown'),
-                    'employees': structured_data.get('employees', 'Unknown'),
-                    'revenue': structured_data.get('revenue', 'Unknown'),
-                    'auditor_status': structured_data.get('auditor_status', 'Unknown'),
-                    'win_themes': structured_data.get('win_themes', 'Unknown'),
-                    'key_personnel': structured_data.get('key_personnel', 'Unknown'),
-                    'engagement_strategy': structured_data.get('engagement_strategy', 'Unknown'),
-                    'gtm_immediate': structured_data.get('gtm_immediate', 'Unknown'),
-                    'gtm_short_term': structured_data.get('gtm_short_term', 'Unknown'),
-                    'gtm_mid_term': structured_data.get('gtm_mid_term', 'Unknown'),
-                    'gtm_long_term': structured_data.get('gtm_long_term', 'Unknown'),
-                    'recommended_solutions': structured_data.get('recommended_solutions', 'Unknown'),
-                    'full_analysis': analysis_text
-                }
-                write_analysis_to_bigquery(analysis_record)
+                analysis_text = _bulk_response_text(line)
+                if analysis_text is None:
+                    raise ValueError(line.get('status') or 'empty response')
                 
-                # Add to results
-                results.append({
-                    'company': company,
-                    'directive': directive,
+                bq_context = dict(_empty_context(), customer_match=row['customer_match'], customer_data=row['customer_data'])
+                structured_data = record_analysis(
+                    row['company'], row['directive'], analysis_text, bq_context, analyzed_by=state.get('analyzed_by', 'unknown')
+                )
+                append_result(results, {
+                    'company': row['company'],
+                    'directive': row['directive'],
                     'prospect_level': structured_data.get('prospect_level', 'Unknown'),
                     'score': structured_data.get('prospect_score', 0),
                     'analysis': analysis_text,
-                    'structured_data': structured_data
+                    'structured_data': structured_data,
+                    'stage': 'bulk'
                 })
-                
-                # Update progress
-                batch_jobs[job_id]['completed'] = idx + 1
-                batch_jobs[job_id]['progress'] = ((idx + 1) / total) * 100
-                batch_jobs[job_id]['results'] = results
-                
-                print(f"✓ Batch analysis complete {idx+1}/{total}: {company}")
-                
+                written_file.write(json.dumps({'key': key, 'result': results[-1]}, default=str) + '\n')
+                written_file.flush()
+                event = ('row', {'result': summarize_batch_result(results[-1])})
             except Exception as e:
-                print(f"✗ Error analyzing {company}: {str(e)}")
-                continue
-        
-        # Sort results by score (descending)
-        results.sort(key=lambda x: x.get('score', 0) if isinstance(x.get('score'), (int, float)) else 0, reverse=True)
-        
-        # Mark job as complete
-        batch_jobs[job_id]['status'] = 'completed'
-        batch_jobs[job_id]['results'] = results
-        batch_jobs[job_id]['progress'] = 100
-        
-        print(f"✓ Batch job {job_id} completed: {len(results)} companies analyzed")
-        
+                print(f"✗ Bulk response error in job {job_id}: {str(e)}")
+                job['failed'] += 1
+                event = ('row_failed', {'stage': 'bulk', 'error': str(e)})
+            job['completed'] = job['skipped'] + len(results) + job['failed']
+            job['progress'] = job['completed'] / job['total'] * 100 if job['total'] else 100
+            batch_events.publish(job_id, event[0], dict(_progress_payload(job), **event[1]))
+    
+    # Requests that never came back
+    missing = len(manifest) - len(seen)
+    job['failed'] += missing
+    
+    job['results'] = sorted(results, key=lambda x: x.get('score', 0) if isinstance(x.get('score'), (int, float)) else 0, reverse=True)
+    job['completed'] = job['total']
+    job['progress'] = 100
+    job['status'] = 'completed'
+    job['bulk']['missing'] = missing
+    state['state'] = 'completed'
+    state['failed'] = job['failed']
+    state['missing'] = missing
+    _save_bulk_state(state)
+    publish_job_done(job_id, job)
+    print(f"✓ Bulk job {job_id} ingested: {len(results)} analyses, {job['failed']} failed ({missing} missing)")
+
+def wait_for_bulk_job(job_id):
+    """Poll the backend until the batch prediction ends, then ingest its output"""
+    job = batch_jobs[job_id]
+    try:
+        state = load_bulk_state(job_id)
+        backend = BULK_BACKENDS[state['backend']]
+        job['status'] = 'waiting'
+        while True:
+            remote_status = backend.status(state['handle'])
+            job['bulk']['remote_status'] = remote_status
+            if remote_status != 'running':
+                break
+            time.sleep(BULK_POLL_SECONDS if backend.name != 'local' else 0.2)
+        if remote_status != 'succeeded':
+            raise RuntimeError(f"batch prediction {state['handle']} {remote_status}")
+        ingest_bulk_responses(job_id, backend.iter_response_lines(state['handle']))
     except Exception as e:
-        print(f"✗ Error in process_batch_analysis: {str(e)}")
+        print(f"✗ Error in bulk job {job_id}: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        publish_job_done(job_id, job)
+
+def process_bulk_analysis(job_id, companies, wait=True, analyzed_by='unknown', upload=None):
+    """Background entry point for mode=bulk: render and submit, then (optionally) wait and ingest"""
+    job = batch_jobs[job_id]
+    try:
+        try:
+            state = prepare_bulk_job(job_id, companies, analyzed_by, upload)
+        finally:
+            discard_upload(upload)
+        with bulk_job_lock(job_id):
+            job['bulk'] = {'backend': state['backend'], 'handle': state['handle'], 'requests': state['requests'], 'remote_status': 'submitted'}
+            job['status'] = 'waiting'
+            job['waiter_active'] = wait
+    except Exception as e:
+        print(f"✗ Error preparing bulk job {job_id}: {str(e)}")
         import traceback
         traceback.print_exc()
-        batch_jobs[job_id]['status'] = 'failed'
-        batch_jobs[job_id]['error'] = str(e)
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        publish_job_done(job_id, job)
+        return
+    if wait:
+        try:
+            wait_for_bulk_job(job_id)
+        finally:
+            job['waiter_active'] = False
+
+def restore_bulk_job(job_id):
+    """
+    Rebuild the in-memory job entry for a bulk job from its work directory (e.g. after a restart)
+    Completed jobs come back completed with their results; a job whose
+    ingest was interrupted comes back waiting with the rows it already wrote
+    """
+    if job_id in batch_jobs:
+        return batch_jobs[job_id]
+    state = load_bulk_state(job_id)
+    if state is None:
+        return None
+    results = []
+    for result in load_bulk_results(job_id).values():
+        append_result(results, result)
+    completed = state['state'] == 'completed'
+    if completed:
+        results.sort(key=lambda x: x.get('score', 0) if isinstance(x.get('score'), (int, float)) else 0, reverse=True)
+    # setdefault: two requests restoring the same job must share one entry
+    return batch_jobs.setdefault(job_id, {
+        'status': 'completed' if completed else 'waiting',
+        'total': state['total'],
+        'completed': state['total'] if completed else state['skipped'] + len(results),
+        'failed': state.get('failed', 0),
+        'skipped': state['skipped'],
+        'progress': 100 if completed else 0,
+        'results': results,
+        'error': None,
+        'mode': 'bulk',
+        'bulk': {
+            'backend': state['backend'], 'handle': state['handle'], 'requests': state['requests'],
+            'remote_status': 'succeeded' if completed else None, 'missing': state.get('missing')
+        }
+    })
+
+@app.route('/api/bulk-jobs/<job_id>/requests', methods=['GET'])
+@login_required
+def bulk_requests_file(job_id):
+    """Download the rendered JSONL request file of a bulk job"""
+    if restore_bulk_job(job_id) is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    return send_file(os.path.join(_bulk_dir(job_id), 'requests.jsonl'), mimetype='application/jsonl',
+                     as_attachment=True, download_name=f'bulk_requests_{job_id}.jsonl')
+
+@app.route('/api/bulk-jobs/<job_id>/responses', methods=['POST'])
+@login_required
+def bulk_responses_upload(job_id):
+    """Ingest a JSONL prediction file produced outside this service for a bulk job"""
+    job = restore_bulk_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    if 'file' not in request.files:
+        return jsonify({'success': False, 'error': 'No file uploaded'}), 400
+    
+    # Claim the job before saving anything: a running waiter or another
+    # upload would otherwise ingest (and write back) the same rows again
+    with bulk_job_lock(job_id):
+        if job['status'] in ('processing', 'completed'):
+            return jsonify({'success': False, 'error': f"Job is already {job['status']}"}), 409
+        if job.get('waiter_active'):
+            return jsonify({'success': False, 'error': 'Job is waiting on its batch prediction'}), 409
+        job['status'] = 'processing'
+        job['error'] = None
+    
+    response_path = os.path.join(_bulk_dir(job_id), 'uploaded_predictions.jsonl')
+    try:
+        request.files['file'].save(response_path)
+    except Exception as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        publish_job_done(job_id, job)
+        return jsonify({'success': False, 'error': str(e)}), 500
+    
+    def ingest():
+        try:
+            with open(response_path, encoding='utf-8') as predictions:
+                ingest_bulk_responses(job_id, predictions)
+        except Exception as e:
+            print(f"✗ Error ingesting bulk responses for {job_id}: {str(e)}")
+            job['status'] = 'failed'
+            job['error'] = str(e)
+            publish_job_done(job_id, job)
+    
+    thread = threading.Thread(target=ingest)
+    thread.daemon = True
+    thread.start()
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'processing'})
+
+@app.route('/api/bulk-jobs/<job_id>/resume', methods=['POST'])
+@login_required
+def bulk_resume(job_id):
+    """Resume waiting on a submitted bulk job, e.g. after a restart or one started with wait=false"""
+    job = restore_bulk_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    with bulk_job_lock(job_id):
+        if job['status'] in ('processing', 'completed') or job.get('waiter_active'):
+            return jsonify({'success': True, 'job_id': job_id, 'status': job['status']})
+        job['waiter_active'] = True
+        job['error'] = None
+    
+    def resume():
+        try:
+            wait_for_bulk_job(job_id)
+        finally:
+            job['waiter_active'] = False
+    
+    thread = threading.Thread(target=resume)
+    thread.daemon = True
+    thread.start()
+    return jsonify({'success': True, 'job_id': job_id, 'status': 'waiting'})
+
+BATCH_SUMMARY_FIELDS = ['industry', 'location', 'employees', 'revenue', 'auditor_status', 'existing_customer', 'customer_match']
+
+def _lookup_batch_job(job_id):
+    # Jobs this process is not running (finished before a restart, or
+    # running elsewhere with a shared store) are read from batch_job_store
+    return batch_jobs.get(job_id) or restore_bulk_job(job_id) or batch_job_store.load_job(job_id)
+
+def summarize_batch_result(result):
+    """Result row without the report text: enough for the ranked table and the Excel export"""
+    structured = result.get('structured_data') or {}
+    summary = {key: result[key] for key in ('seq', 'company', 'directive', 'prospect_level', 'score', 'stage', 'triage_score') if key in result}
+    summary['structured_data'] = {key: structured[key] for key in BATCH_SUMMARY_FIELDS if key in structured}
+    return summary
+
+def _batch_status_etag(job, since, fields):
+    # Everything the response depends on except the result bodies, which only change when they are added
+    state = [
+        job['status'], job['progress'], job['completed'], job.get('failed', 0), job.get('skipped', 0), job['total'],
+        job.get('parsing'), len(job['results']), job.get('stages'), job.get('bulk'), job.get('provisional'), job.get('error'), since, fields
+    ]
+    return hashlib.sha1(json.dumps(state, sort_keys=True, default=str).encode('utf-8')).hexdigest()
 
 @app.route('/api/batch-status/<job_id>', methods=['GET'])
 @login_required
 def batch_status(job_id):
-    """Get status of batch analysis job"""
+    """
+    Get status of batch analysis job
+    since=<n> returns only results with seq >= n (cursor is the next value
+    to send); fields=summary drops report text and long fields, which
+    /api/batch-status/<job_id>/results/<seq> serves on demand. Responses
+    carry an ETag and unchanged jobs answer If-None-Match with 304
+    """
     try:
-        if job_id not in batch_jobs:
+        job = _lookup_batch_job(job_id)
+        if job is None:
             return jsonify({'success': False, 'error': 'Job not found'}), 404
         
-        job = batch_jobs[job_id]
+        try:
+            since = max(0, int(request.args.get('since', 0)))
+        except ValueError:
+            return jsonify({'success': False, 'error': 'since must be an integer'}), 400
+        fields = request.args.get('fields', 'full')
         
-        return jsonify({
+        etag = _batch_status_etag(job, since, fields)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        
+        results = job['results']
+        if since:
+            if job['status'] == 'processing' and batch_jobs.get(job_id) is job:
+                # A running job's list is in seq order (seq == position)
+                results = results[since:]
+            else:
+                results = [result for result in results if result.get('seq', 0) >= since]
+        if fields == 'summary':
+            results = [summarize_batch_result(result) for result in results]
+        
+        response = jsonify({
             'success': True,
             'status': job['status'],
             'progress': job['progress'],
             'completed': job['completed'],
+            'failed': job.get('failed', 0),
+            'skipped': job.get('skipped', 0),
             'total': job['total'],
-            'results': job['results'],
+            'parsing': job.get('parsing', False),
+            'dropped': job.get('dropped'),
+            'results': results,
+            'cursor': len(job['results']),
+            'prepass': job.get('prepass'),
+            'dedup': job.get('dedup'),
+            'mode': job.get('mode', 'full'),
+            'stages': job.get('stages'),
+            'bulk': job.get('bulk'),
+            'provisional': list(job.get('provisional', {}).values()),
+            'resume': job.get('resume'),
             'error': job.get('error')
         })
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
         
     except Exception as e:
         print(f"✗ Error in batch_status: {str(e)}")
         return jsonify({'success': False, 'error': str(e)}), 500
 
+@app.route('/api/batch-status/<job_id>/results/<int:seq>', methods=['GET'])
+@login_required
+def batch_result(job_id, seq):
+    """One full result row (report text and all parsed fields) of a batch job"""
+    job = _lookup_batch_job(job_id)
+    if job is None:
+        return jsonify({'success': False, 'error': 'Job not found'}), 404
+    result = next((result for result in job['results'] if result.get('seq') == seq), None)
+    if result is None:
+        return jsonify({'success': False, 'error': 'Result not found'}), 404
+    return jsonify({'success': True, 'result': result})
+
+@app.route('/api/batch-events/<job_id>', methods=['GET'])
+@login_required
+def batch_events_stream(job_id):
+    """
+    Server-Sent Events for a batch job: started, row (result summary as in
+    fields=summary), row_failed, progress (rows that are not final, e.g.
+    triage scores) and done; every event also carries the job counters.
+    Each event has an id, so EventSource resumes with Last-Event-ID after a
+    reconnect; if the events after that id are no longer kept, a 'resync'
+    event says how many were missed. A stream closes after
+    BATCH_EVENTS_STREAM_SECONDS to free the worker thread; the browser
+    reconnects on its own. Jobs not running in this process answer 409
+    unless finished (then replayed from their results), and once
+    BATCH_EVENTS_MAX_LISTENERS streams are open new ones answer 503;
+    clients fall back to polling /api/batch-status
+    """
+    if not batch_events.has_job(job_id):
+        job = _lookup_batch_job(job_id)
+        if job is None:
+            return jsonify({'success': False, 'error': 'Job not found'}), 404
+        if job['status'] not in ('completed', 'failed'):
+            return jsonify({'success': False, 'error': 'Job is not running on this instance; poll /api/batch-status'}), 409
+        for result in sorted(job['results'], key=lambda result: result.get('seq', 0)):
+            batch_events.publish(job_id, 'row', dict(_progress_payload(job), result=summarize_batch_result(result)))
+        publish_job_done(job_id, job)
+    
+    try:
+        after = int(request.headers.get('Last-Event-ID') or request.args.get('last_event_id') or 0)
+    except ValueError:
+        after = 0
+    
+    if not batch_events.attach():
+        return jsonify({'success': False, 'error': 'Too many open event streams; poll /api/batch-status'}), 503
+    
+    def events():
+        cursor = after
+        deadline = time.monotonic() + BATCH_EVENTS_STREAM_SECONDS
+        yield "retry: 2000\n\n"
+        while time.monotonic() < deadline:
+            pending, finished, missed = batch_events.wait(
+                job_id, cursor, min(BATCH_EVENTS_KEEPALIVE_SECONDS, max(0, deadline - time.monotonic()))
+            )
+            if missed:
+                # Older events were trimmed from the log; the client re-reads the job from /api/batch-status
+                yield _sse_event('resync', {'missed': missed})
+            for event_id, event, payload in pending:
+                cursor = event_id
+                yield f"id: {event_id}\n" + _sse_event(event, payload)
+            if finished and not pending:
+                return
+            if not pending:
+                yield ": keep-alive\n\n"
+    
+    response = Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # Runs when the server closes the response, even if the generator never started
+    response.call_on_close(batch_events.detach)
+    return response
+
 @app.route('/api/export-excel', methods=['POST'])
 @login_required
 def export_excel():
@@ -1327,6 +5357,9 @@ def export_excel():
         traceback.print_exc()
         return jsonify({'success': False, 'error': str(e)}), 500
 
+if BATCH_RESUME_ON_START and batch_job_store.enabled:
+    threading.Thread(target=resume_interrupted_jobs, daemon=True).start()
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# main reads its configuration at import time: use the offline model and keep every store in memory
+os.environ['GEMINI_MODEL_BACKEND'] = 'fake'
+for variable in ('LLM_CACHE_PATH', 'ALIAS_DB_PATH', 'WRITEBACK_SPILL_PATH', 'BATCH_JOB_STORE_PATH'):
+    os.environ[variable] = ''
+os.environ['VERTEX_REQUESTS_PER_MINUTE'] = '0'
+os.environ['GEMINI_WARMUP_ON_BOOT'] = 'false'
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
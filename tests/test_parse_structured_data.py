@@ -0,0 +1,34 @@
+"""parse_structured_data must return exactly what the original regex-per-field parser returned"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import main
+from bench_parse_structured_data import legacy_parse_structured_data, make_report
+
+SAVED_RESPONSES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'saved_responses.jsonl')
+
+def _saved_responses():
+    with open(SAVED_RESPONSES, encoding='utf-8') as handle:
+        return [json.loads(line) for line in handle if line.strip()]
+
+@pytest.mark.parametrize('response', _saved_responses(), ids=lambda response: response['name'])
+def test_saved_response_matches_legacy_parser(response):
+    assert main.parse_structured_data(response['text']) == legacy_parse_structured_data(response['text'])
+
+def test_full_length_report_matches_legacy_parser():
+    report = make_report(7)
+    assert main.parse_structured_data(report) == legacy_parse_structured_data(report)
+
+def test_fallbacks_are_exercised():
+    responses = {response['name']: response['text'] for response in _saved_responses()}
+    # Level found only before section 1, score only in a closing summary, no section 3 at all
+    assert main.parse_structured_data(responses['level_outside_section_3'])['prospect_level'] == 'High'
+    assert main.parse_structured_data(responses['score_only_in_closing_summary'])['prospect_score'] == 63
+    missing = main.parse_structured_data(responses['missing_prospect_section'])
+    assert (missing['prospect_level'], missing['prospect_score']) == ('Low', 35)
@@ -0,0 +1,68 @@
+"""The analysis prompt's instruction prefix must be byte-stable so it can be served from cached content"""
+
+import pytest
+
+import main
+
+def _customer_context():
+    context = main._empty_context()
+    context['customer_match'] = 'Globex Corporation'
+    context['customer_data'] = {
+        'company_name': 'Globex Corporation',
+        'industry': 'Manufacturing',
+        'annual_revenue': 120000000,
+        'auditor_firm': 'Deloitte'
+    }
+    context['match_confidence'] = 1.0
+    return context
+
+CASES = [
+    ('Initech', 'Expand audit services', main._empty_context()),
+    ('Globex', 'Cross-sell advisory', _customer_context())
+]
+
+@pytest.fixture
+def fake_requests(monkeypatch):
+    monkeypatch.setattr(main, 'PROMPT_CACHE_ENABLED', True)
+    monkeypatch.setattr(main, 'prompt_prefix_cache', main.PromptPrefixCache(ttl_seconds=3600))
+    main.FakeGenerativeModel.requests.clear()
+    return main.FakeGenerativeModel.requests
+
+def test_prefix_is_identical_for_different_companies():
+    (first_prefix, first_suffix), (second_prefix, second_suffix) = [
+        main.build_analysis_prompt_parts(company, directive, context) for company, directive, context in CASES
+    ]
+    assert first_prefix.encode('utf-8') == second_prefix.encode('utf-8') == main.ANALYSIS_INSTRUCTIONS.encode('utf-8')
+    assert 'Initech' in first_suffix and 'Initech' not in first_prefix
+    assert 'Globex Corporation' in second_suffix and 'Globex' not in second_prefix
+
+def test_cached_calls_send_the_same_prefix_bytes(fake_requests):
+    for company, directive, context in CASES:
+        main.generate_analysis_text(company, directive, context, use_cache=False)
+    
+    assert len(fake_requests) == 2
+    prefixes = {request['system_instruction'].encode('utf-8') for request in fake_requests}
+    assert prefixes == {main.ANALYSIS_INSTRUCTIONS.encode('utf-8')}
+    for request, (company, _, _) in zip(fake_requests, CASES):
+        assert request['contents'].lstrip().startswith(f'COMPANY TO ANALYZE: {company}')
+        assert main.ANALYSIS_INSTRUCTIONS not in request['contents']
+    
+    stats = main.prompt_prefix_cache.stats()
+    assert stats['creates'] == 1
+    assert stats['hits'] == 1
+    assert stats['distinct_prefixes'] == 1
+
+def test_full_prompt_is_sent_when_caching_is_unavailable(fake_requests, monkeypatch):
+    def unavailable(model_name, system_instruction):
+        raise RuntimeError('cached content below the minimum size')
+    monkeypatch.setattr(main, 'FakeCachedContent', unavailable)
+    
+    company, directive, context = CASES[1]
+    main.generate_analysis_text(company, directive, context, use_cache=False)
+    
+    budgeted_context, _ = main.apply_prompt_budget(company, directive, context)
+    prefix, suffix = main.build_analysis_prompt_parts(company, directive, budgeted_context)
+    assert len(fake_requests) == 1
+    assert fake_requests[0]['system_instruction'] is None
+    assert fake_requests[0]['contents'] == prefix + suffix
+    assert main.prompt_prefix_cache.stats()['fallbacks'] == 1